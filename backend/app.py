@@ -1,19 +1,36 @@
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import shutil
 import os
 import uuid
 import cv2
 import base64
-from video_processor import VideoProcessor
+import hashlib
+import json
+import threading
+import time
+import asyncio
+import re
+from pipeline import PipelineConfig
+from encoder import EncoderConfig, OUTPUT_FORMATS, HLS_PLAYLIST
+from frame_reuse import FrameReuseConfig
+from roi import SubjectROIConfig
+from scheduler import JobScheduler, SchedulerFull
+from cache import OutputCache, cache_key
+from matte_store import MatteStore
+from backgrounds import shared_cache
+from preview import PreviewSessionManager
+from task_store import TaskStore, ProgressBroker, FINISHED
+from metrics import MetricsRegistry
+from model_registry import DEFAULT_TIER, TIERS
+from model_loader import ModelLoader, ModelNotReady, parse_sizes
+from ranges import file_response
 from datetime import datetime, timedelta
 
 app = FastAPI()
 
-# Task storage with timestamps
-tasks = {}
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -28,53 +45,386 @@ UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 OUTPUT_DIR = r"C:\Users\HP\Downloads"
 MODEL_PATH = os.path.join(BASE_DIR, "model", "rvm_mobilenetv3.pth")
 
+# Per-stage job timings feed /metrics; with VEDITOR_METRICS=0 they are not
+# collected at all. VEDITOR_TRACE_DIR additionally writes a trace per job.
+METRICS_ENABLED = os.environ.get("VEDITOR_METRICS", "1") != "0"
+TRACE_DIR = os.environ.get("VEDITOR_TRACE_DIR")
+if TRACE_DIR:
+    os.makedirs(TRACE_DIR, exist_ok=True)
+
+# Run decode, inference, compositing and encoding as overlapping stages
+USE_PIPELINE = os.environ.get("VEDITOR_PIPELINE", "1") != "0"
+PIPELINE_CONFIG = PipelineConfig(
+    batch_size=int(os.environ.get("VEDITOR_BATCH_SIZE", 4)),
+    decode_queue_size=int(os.environ.get("VEDITOR_DECODE_QUEUE", 4)),
+    inference_queue_size=int(os.environ.get("VEDITOR_INFERENCE_QUEUE", 4)),
+    encode_queue_size=int(os.environ.get("VEDITOR_ENCODE_QUEUE", 16)),
+    collect_timings=METRICS_ENABLED or bool(TRACE_DIR),
+    report_timings=os.environ.get("VEDITOR_STAGE_TIMINGS", "1") != "0",
+    # 'ffmpeg' decodes through a rawvideo pipe (needs ffprobe next to ffmpeg)
+    decoder=os.environ.get("VEDITOR_DECODER", "opencv"),
+)
+
+# Single-pass libx264 encode settings (used when ffmpeg is installed)
+ENCODER_CONFIG = EncoderConfig(
+    preset=os.environ.get("VEDITOR_X264_PRESET", "fast"),
+    crf=int(os.environ.get("VEDITOR_X264_CRF", 23)),
+    threads=int(os.environ.get("VEDITOR_X264_THREADS", 0)),
+    hls_segment_seconds=float(os.environ.get("VEDITOR_STREAM_SEGMENT_SECONDS", 2)),
+)
+
+# Jobs also write HLS segments under VEDITOR_STREAM_DIR while they encode,
+# served by /stream so the result can be watched before the job is done
+# (VEDITOR_STREAM_OUTPUT=0 or the `stream` form field turns it off)
+STREAM_OUTPUT = os.environ.get("VEDITOR_STREAM_OUTPUT", "1") != "0"
+STREAM_DIR = os.environ.get("VEDITOR_STREAM_DIR", os.path.join(BASE_DIR, "cache", "streams"))
+os.makedirs(STREAM_DIR, exist_ok=True)
+
+# Long videos are split into this many segments processed in parallel
+# (segments shorter than segments.MIN_SEGMENT_SECONDS are not split off).
+# Segmented jobs record no matte in MATTE_STORE, so they are not reused
+VIDEO_SEGMENTS = int(os.environ.get("VEDITOR_SEGMENTS", 1))
+SEGMENT_OVERLAP = int(os.environ.get("VEDITOR_SEGMENT_OVERLAP", 16))
+
+# RVM downsample_ratio: 'auto' picks it from the frame size (0.25 at 1080p,
+# 0.125 at 4K), or a fixed number. Frames with a long side above
+# VEDITOR_MAX_INFERENCE_SIDE are matted at that size and the matte is
+# guided-upsampled back (0 = always full resolution)
+DOWNSAMPLE_RATIO = os.environ.get("VEDITOR_DOWNSAMPLE_RATIO", "auto")
+if DOWNSAMPLE_RATIO != "auto":
+    DOWNSAMPLE_RATIO = float(DOWNSAMPLE_RATIO)
+MAX_INFERENCE_SIDE = int(os.environ.get("VEDITOR_MAX_INFERENCE_SIDE", 0))
+
+# Opt-in for static shots: frames that barely differ from the last inferred
+# one reuse its matte; a real inference still runs every max_interval frames
+FRAME_REUSE = os.environ.get("VEDITOR_FRAME_REUSE", "0") != "0"
+FRAME_REUSE_CONFIG = FrameReuseConfig(
+    threshold=float(os.environ.get("VEDITOR_REUSE_THRESHOLD", 1.0)),
+    max_interval=int(os.environ.get("VEDITOR_REUSE_MAX_INTERVAL", 8)),
+)
+
+# Opt-in: run the model only on a padded box around the tracked subject
+SUBJECT_ROI = os.environ.get("VEDITOR_SUBJECT_ROI", "0") != "0"
+SUBJECT_ROI_CONFIG = SubjectROIConfig(
+    padding=float(os.environ.get("VEDITOR_ROI_PADDING", 0.15)),
+    max_area=float(os.environ.get("VEDITOR_ROI_MAX_AREA", 0.7)),
+)
+
+# Jobs running side by side in one worker (VEDITOR_WORKER_CONCURRENCY > 1)
+# share its model: their next frames go through one batched run, waiting
+# at most VEDITOR_BATCH_WINDOW_MS for each other (VEDITOR_CROSS_JOB_BATCHING=0
+# gives every job a model of its own instead)
+CROSS_JOB_BATCHING = os.environ.get("VEDITOR_CROSS_JOB_BATCHING", "1") != "0"
+BATCH_WINDOW = float(os.environ.get("VEDITOR_BATCH_WINDOW_MS", 5)) / 1000 if CROSS_JOB_BATCHING else None
+
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-processor = VideoProcessor(MODEL_PATH)
+# Task records live in SQLite so they survive restarts and are shared by
+# API processes; finished tasks and their files expire after the TTL
+os.makedirs(os.path.join(BASE_DIR, "cache"), exist_ok=True)
+task_store = TaskStore(
+    os.environ.get("VEDITOR_TASK_DB", os.path.join(BASE_DIR, "cache", "tasks.sqlite3")),
+    ttl_seconds=int(float(os.environ.get("VEDITOR_TASK_TTL_HOURS", 24)) * 3600),
+)
+TASK_CLEANUP_INTERVAL = int(os.environ.get("VEDITOR_TASK_CLEANUP_INTERVAL", 600))
+# Workers send progress at most every VEDITOR_PROGRESS_INTERVAL seconds and
+# VEDITOR_PROGRESS_STEP percent; subscribers get it at the same pace
+PROGRESS_INTERVAL = float(os.environ.get("VEDITOR_PROGRESS_INTERVAL", 0.5))
+PROGRESS_STEP = float(os.environ.get("VEDITOR_PROGRESS_STEP", 1))
+progress_broker = ProgressBroker(min_interval=PROGRESS_INTERVAL)
+
+# Finished outputs keyed by the content of the inputs and the effect settings
+output_cache = OutputCache(
+    os.environ.get("VEDITOR_CACHE_DIR", os.path.join(BASE_DIR, "cache", "outputs")),
+    max_bytes=int(float(os.environ.get("VEDITOR_CACHE_MAX_GB", 10)) * 1024 ** 3),
+    ttl_seconds=int(float(os.environ.get("VEDITOR_CACHE_TTL_HOURS", 168)) * 3600),
+)
+# Per-video RVM output, so changing only the background skips inference
+MATTE_STORE = MatteStore(
+    os.environ.get("VEDITOR_MATTE_DIR", os.path.join(BASE_DIR, "cache", "mattes")),
+    max_bytes=int(float(os.environ.get("VEDITOR_MATTE_MAX_GB", 20)) * 1024 ** 3),
+)
+# Background images stored once by content, with prepared variants per
+# frame size and blur shared by jobs (worker processes) and previews
+BACKGROUNDS = shared_cache(
+    os.environ.get("VEDITOR_BACKGROUND_DIR", os.path.join(BASE_DIR, "cache", "backgrounds")),
+    max_disk_bytes=int(float(os.environ.get("VEDITOR_BACKGROUND_MAX_GB", 2)) * 1024 ** 3),
+    max_memory_bytes=int(float(os.environ.get("VEDITOR_BACKGROUND_MEMORY_MB", 512)) * 1024 ** 2),
+)
+# cache key -> task_id of the job currently producing it. Guarded by
+# inflight_lock: requests claim keys from the threadpool, the scheduler's
+# event thread releases them
+inflight = {}
+inflight_lock = threading.Lock()
+
+def claim_job(key, task_id):
+    """
+    Decides in one step how a request for key is served: ('cached', path),
+    ('inflight', task_id of the job producing it) or ('new', task_id) after
+    registering task_id as that job.
+    """
+    with inflight_lock:
+        shared = inflight.get(key)
+        if shared:
+            return "inflight", shared
+        # Completed jobs are in the cache before they leave inflight
+        cached_path = output_cache.lookup(key)
+        if cached_path:
+            return "cached", cached_path
+        inflight[key] = task_id
+        return "new", task_id
 
-async def run_processing_task(task_id, video_path, output_path, bg_path, bg_color, blur_radius, lighting_strength):
+def release_job(key):
+    with inflight_lock:
+        inflight.pop(key, None)
+
+# Models are loaded in the background at startup (or on the first preview
+# with VEDITOR_PRELOAD_MODEL=0) and run once at every VEDITOR_WARMUP_SIZES
+# frame size, so the first request does not pay for session setup
+PRELOAD_MODEL = os.environ.get("VEDITOR_PRELOAD_MODEL", "1") != "0"
+WARMUP_SIZES = parse_sizes(os.environ.get("VEDITOR_WARMUP_SIZES", "1280x720,1920x1080"))
+PREVIEW_MODEL_WAIT = float(os.environ.get("VEDITOR_PREVIEW_MODEL_WAIT", 30))
+
+def load_preview_model():
+    # Imported here so starting the API does not wait for the model stack
+    from video_processor import VideoProcessor
+    processor = VideoProcessor(MODEL_PATH, downsample_ratio=DOWNSAMPLE_RATIO, max_inference_side=MAX_INFERENCE_SIDE)
+    processor.background_cache = BACKGROUNDS
+    seconds = processor.prewarm(WARMUP_SIZES)
+    print(f"Preview model warmed up at {len(WARMUP_SIZES)} frame size(s) in {seconds:.2f}s")
+    return processor
+
+# In-process model used only for single-frame previews
+preview_model = ModelLoader(load_preview_model, "Preview model")
+preview_lock = threading.Lock()
+
+def get_preview_processor():
+    """The preview VideoProcessor; 503 if it is not loaded within PREVIEW_MODEL_WAIT seconds."""
     try:
-        def progress_update(current, total):
-            progress = int((current / total) * 100)
-            tasks[task_id]["progress"] = progress
-            print(f"Task {task_id} - Progress: {progress}% ({current}/{total})")
-        
+        return preview_model.get(timeout=PREVIEW_MODEL_WAIT)
+    except ModelNotReady as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+# Uploaded videos kept for repeated previews at any timestamp
+preview_sessions = PreviewSessionManager(
+    UPLOAD_DIR, ttl_seconds=int(os.environ.get("VEDITOR_PREVIEW_TTL", 1800))
+)
+PREVIEW_WARMUP_FRAMES = int(os.environ.get("VEDITOR_PREVIEW_WARMUP", 8))
+
+metrics = MetricsRegistry()
+JOBS = metrics.counter("veditor_jobs_total", "Finished jobs by outcome", ("status",))
+JOB_SECONDS = metrics.histogram("veditor_job_duration_seconds", "Processing time of completed jobs")
+CANCEL_PROGRESS = metrics.histogram("veditor_job_cancel_progress_percent", "Progress of jobs when they were cancelled",
+                                    buckets=(0, 10, 25, 50, 75, 90, 100))
+QUEUE_WAIT = metrics.histogram("veditor_job_queue_wait_seconds", "Time jobs spent queued before a worker took them")
+FRAMES = metrics.counter("veditor_frames_processed_total", "Frames written by completed jobs")
+STAGE_BUSY = metrics.counter("veditor_stage_seconds_total", "Busy time per processing stage", ("stage",))
+STAGE_WAIT = metrics.counter("veditor_stage_wait_seconds_total", "Time stages spent waiting on their queues", ("stage",))
+MATTE_REUSE = metrics.counter("veditor_matte_reuse_total", "Jobs re-composited from a stored matte")
+FRAMES_REUSED = metrics.counter("veditor_frames_reused_total", "Frames that reused the previous matte instead of running the model")
+BATCH_SIZE = metrics.histogram("veditor_job_stream_batch_size", "Mean number of jobs sharing each model run of a job",
+                               buckets=(1, 1.5, 2, 3, 4, 6, 8, 16))
+JOB_BACKEND = metrics.counter("veditor_jobs_by_backend_total", "Completed jobs per inference backend", ("backend", "model"))
+UPLOAD_SECONDS = metrics.histogram("veditor_upload_seconds", "Time to receive and hash an upload",
+                                   buckets=(0.05, 0.25, 1, 5, 15, 60, 300))
+UPLOAD_BYTES = metrics.counter("veditor_upload_bytes_total", "Bytes received in uploads")
+REQUESTS_DEDUPED = metrics.counter("veditor_requests_deduplicated_total", "Requests joined to an identical in-flight job")
+QUEUE_LENGTH = metrics.gauge("veditor_queue_length", "Jobs waiting for a worker")
+RUNNING_JOBS = metrics.gauge("veditor_running_jobs", "Jobs being processed")
+OUTPUT_CACHE = metrics.counter("veditor_output_cache_total", "Output cache lookups and maintenance", ("event",))
+CACHE_BYTES = metrics.gauge("veditor_cache_bytes", "Bytes held by each cache", ("cache",))
+MODEL_INFO = metrics.gauge("veditor_model_info", "Inference backend and model loaded by the API process", ("backend", "model"))
+
+def collect_metrics():
+    stats = scheduler.stats()
+    QUEUE_LENGTH.set(stats["queued"])
+    RUNNING_JOBS.set(stats["running"])
+    cache = output_cache.stats()
+    for event in ("hits", "misses", "stores", "evictions"):
+        OUTPUT_CACHE.set_total(cache[event], (event,))
+    CACHE_BYTES.set(cache["bytes"], ("output",))
+    CACHE_BYTES.set(MATTE_STORE.stats()["bytes"], ("matte",))
+    CACHE_BYTES.set(BACKGROUNDS.stats()["disk_bytes"], ("background",))
+    if preview_model.ready:
+        processor = preview_model.get()
+        MODEL_INFO.set(1, (processor.inference.backend, processor.inference.model_id))
+
+def record_job_metrics(stats):
+    FRAMES.inc(stats["frames"])
+    JOB_SECONDS.observe(stats["seconds"])
+    JOB_BACKEND.inc(1, (stats["backend"], stats["model"]))
+    if stats.get("matte_reused"):
+        MATTE_REUSE.inc()
+    if stats.get("frame_reuse"):
+        FRAMES_REUSED.inc(stats["frame_reuse"]["reused"])
+    if stats.get("batching"):
+        BATCH_SIZE.observe(stats["batching"]["mean_batch_size"])
+    for stage, t in (stats.get("stages") or {}).items():
+        STAGE_BUSY.inc(t["busy_s"], (stage,))
+        STAGE_WAIT.inc(t["wait_s"], (stage,))
+
+def public_task(task):
+    return {k: v for k, v in task.items()
+            if k not in ("video_path", "bg_path", "cache_key", "started_at", "queued_at", "stream_dir")}
+
+def remove_files(*paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def remove_stream(task):
+    if task and task.get("stream_dir"):
+        shutil.rmtree(task["stream_dir"], ignore_errors=True)
+
+def on_job_event(task_id, kind, payload):
+    """Scheduler callback: mirrors worker events into the task store."""
+    task = task_store.get(task_id)
+    if task is None:
+        return
+    upload = task.get("video_path")
+    if kind == "started":
         print(f"Starting processing for task {task_id}")
-        print(f"Output path: {output_path}")
-        
-        # Initial progress update
-        tasks[task_id]["progress"] = 1
-        print(f"Task {task_id} - Initial progress set to 1%")
-        
-        processor.process_video(
-            video_path, output_path, 
-            background_path=bg_path, 
-            background_color=bg_color, 
-            blur_radius=blur_radius, 
-            lighting_strength=lighting_strength,
-            progress_callback=progress_update
-        )
-        tasks[task_id]["status"] = "completed"
-        tasks[task_id]["progress"] = 100
-        tasks[task_id]["output_path"] = output_path
-        tasks[task_id]["output_url"] = f"/download/{os.path.basename(output_path)}"
+        if "queued_at" in task:
+            QUEUE_WAIT.observe(time.time() - task["queued_at"])
+        # A task cancelled on its way to the worker stays 'cancelling'
+        task = task_store.update(task_id, only_if_status=("queued",), status="processing", progress=1,
+                                 started_at=time.time())
+    elif kind == "progress":
+        # fps and ETA come from the worker's smoothed frame rate
+        task = task_store.update(task_id, progress=max(1, payload["progress"]),
+                                 fps=payload.get("fps"), eta_seconds=payload.get("eta_seconds"))
+    elif kind == "completed":
+        output_path = payload["output_path"]
+        JOBS.inc(1, ("completed",))
+        if payload.get("stats"):
+            record_job_metrics(payload["stats"])
+        cache_id = task.get("cache_key")
+        if cache_id:
+            try:
+                output_cache.put(cache_id, output_path)
+            except Exception as e:
+                print(f"Could not cache output for task {task_id}: {e}")
+            # Only now: a duplicate request in between shares this task
+            # instead of finding neither the job nor its output
+            release_job(cache_id)
+        task = task_store.update(task_id, status="completed", progress=100, eta_seconds=0,
+                                 output_path=output_path,
+                                 output_url=f"/download/{os.path.basename(output_path)}",
+                                 cache_key=None, video_path=None)
         print(f"Task {task_id} completed successfully.")
-    except Exception as e:
-        print(f"Task {task_id} failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        tasks[task_id]["status"] = "failed"
-        tasks[task_id]["error"] = str(e)
-    finally:
-        if os.path.exists(video_path):
-            os.remove(video_path)
-        if bg_path and os.path.exists(bg_path):
-            os.remove(bg_path)
+    elif kind == "failed":
+        print(f"Task {task_id} failed: {payload['error']}")
+        JOBS.inc(1, ("failed",))
+        release_job(task.get("cache_key"))
+        remove_stream(task)
+        task = task_store.update(task_id, status="failed", error=payload["error"],
+                                 cache_key=None, video_path=None, stream_dir=None, stream_url=None)
+    elif kind == "cancelled":
+        print(f"Task {task_id} cancelled")
+        JOBS.inc(1, ("cancelled",))
+        CANCEL_PROGRESS.observe(task.get("progress", 0))
+        release_job(task.get("cache_key"))
+        remove_stream(task)
+        task = task_store.update(task_id, status="cancelled", cache_key=None, video_path=None,
+                                 fps=None, eta_seconds=None, stream_dir=None, stream_url=None)
+
+    if kind in FINISHED:
+        remove_files(upload)
+    if task is not None:
+        progress_broker.publish(task_id, public_task(task))
+
+def cleanup_tasks():
+    """Drops expired finished tasks along with their output files."""
+    for task in task_store.expire():
+        remove_stream(task)
+        output_path = task.get("output_path")
+        # Outputs served from the output cache are owned by the cache
+        if output_path and os.path.dirname(os.path.abspath(output_path)) != os.path.abspath(output_cache.cache_dir):
+            try:
+                remove_files(output_path)
+            except OSError as e:
+                print(f"Could not remove expired output {output_path}: {e}")
+    preview_sessions.cleanup()
+
+def cleanup_loop():
+    while True:
+        time.sleep(TASK_CLEANUP_INTERVAL)
+        try:
+            cleanup_tasks()
+        except Exception as e:
+            print(f"Task cleanup failed: {e}")
+
+# Inference runs in worker processes that each load their own model, so
+# the API event loop stays free for uploads, previews and status polls
+# Clients pick a job priority within [-MAX_PRIORITY, MAX_PRIORITY]
+MAX_PRIORITY = int(os.environ.get("VEDITOR_MAX_PRIORITY", 10))
+
+scheduler = JobScheduler(
+    MODEL_PATH,
+    num_workers=int(os.environ.get("VEDITOR_WORKERS", 1)),
+    max_queue=int(os.environ.get("VEDITOR_MAX_QUEUE", 16)),
+    worker_concurrency=int(os.environ.get("VEDITOR_WORKER_CONCURRENCY", 1)),
+    on_event=on_job_event,
+    batch_window=BATCH_WINDOW,
+    max_batch=int(os.environ.get("VEDITOR_MAX_STREAM_BATCH", 8)),
+    processor_options={"downsample_ratio": DOWNSAMPLE_RATIO, "max_inference_side": MAX_INFERENCE_SIDE},
+    warmup_sizes=WARMUP_SIZES,
+    progress_interval=PROGRESS_INTERVAL,
+    progress_step=PROGRESS_STEP,
+)
+metrics.add_collector(collect_metrics)
+
+@app.on_event("startup")
+def start_scheduler():
+    # Jobs queued before a restart are gone with the old scheduler
+    for task in task_store.fail_unfinished("Server restarted before the task finished"):
+        remove_files(task.get("video_path"))
+        remove_stream(task)
+    cleanup_tasks()
+    threading.Thread(target=cleanup_loop, name="task-cleanup", daemon=True).start()
+    scheduler.start()
+    if PRELOAD_MODEL:
+        preview_model.start()
+
+@app.on_event("shutdown")
+def stop_scheduler():
+    scheduler.shutdown()
+
+def save_upload(upload, path):
+    """Writes an upload to disk and returns the SHA-256 of its contents."""
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as buffer:
+        while True:
+            chunk = upload.file.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            buffer.write(chunk)
+            size += len(chunk)
+    UPLOAD_SECONDS.observe(time.perf_counter() - start)
+    UPLOAD_BYTES.inc(size)
+    return digest.hexdigest()
+
+def store_background(upload):
+    """Saves an uploaded background into the background cache; returns (path, digest)."""
+    tmp_path = os.path.join(UPLOAD_DIR, f"bg_{uuid.uuid4()}{os.path.splitext(os.path.basename(upload.filename))[1]}")
+    digest = save_upload(upload, tmp_path)
+    return BACKGROUNDS.store(tmp_path, digest), digest
+
+def resolve_background(background_id):
+    """Path of a background uploaded before, by the background_id returned then."""
+    if len(background_id) != 64 or any(c not in "0123456789abcdef" for c in background_id):
+        raise HTTPException(status_code=400, detail="Invalid background_id")
+    path = BACKGROUNDS.lookup(background_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Background not found, upload it again")
+    return path
 
 @app.post("/remove-background")
 async def remove_background(
-    background_tasks: BackgroundTasks,
     video: UploadFile = File(...),
     background: UploadFile = File(None),
     color_r: int = Form(0),
@@ -82,64 +432,239 @@ async def remove_background(
     color_b: int = Form(0),
     blur_radius: int = Form(0),
     lighting_strength: float = Form(0.0),
-    output_dir: str = Form(None)
+    output_dir: str = Form(None),
+    priority: int = Form(0),
+    model_tier: str = Form(None),
+    frame_reuse: bool = Form(None),
+    subject_roi: bool = Form(None),
+    background_id: str = Form(None),
+    output_format: str = Form("composite"),
+    stream: bool = Form(None)
 ):
+    if model_tier and model_tier not in TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown model_tier, expected one of {sorted(TIERS)}")
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown output_format, expected one of {sorted(OUTPUT_FORMATS)}")
+    # Checked before anything is saved
+    known_bg_path = None
+    if background_id and not background:
+        known_bg_path = await run_in_threadpool(resolve_background, background_id)
+    claimed_key = None
     try:
         task_id = str(uuid.uuid4())
         video_path = os.path.join(UPLOAD_DIR, f"{task_id}_{video.filename}")
         
-        # Check if output file already exists with same settings
         final_output_dir = OUTPUT_DIR
         if output_dir and os.path.isdir(output_dir):
             final_output_dir = output_dir
         
-        output_path = os.path.join(final_output_dir, f"out_{task_id}_{video.filename}")
-        
-        # Check if file already exists (skip reprocessing)
-        if os.path.exists(output_path):
-            print(f"Output file already exists: {output_path}")
-            return {
-                "task_id": task_id,
-                "status": "completed",
-                "output_url": f"/download/{os.path.basename(output_path)}",
-                "cached": True
-            }
+        # Outputs get the container their codec is written for, not the
+        # upload's: H.264 cannot go into e.g. a .webm
+        output_name = os.path.splitext(f"out_{task_id}_{video.filename}")[0] + OUTPUT_FORMATS[output_format]["ext"]
+        output_path = os.path.join(final_output_dir, output_name)
         
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
+        video_hash = await run_in_threadpool(save_upload, video, video_path)
 
+        # Background images live in the shared cache, not with the upload
         bg_path = None
+        bg_id = ("color", color_r, color_g, color_b)
         if background:
-            bg_path = os.path.join(UPLOAD_DIR, f"bg_{task_id}_{background.filename}")
-            with open(bg_path, "wb") as buffer:
-                shutil.copyfileobj(background.file, buffer)
+            bg_path, digest = await run_in_threadpool(store_background, background)
+            bg_id = ("image", digest)
+        elif known_bg_path:
+            bg_path = known_bg_path
+            bg_id = ("image", background_id)
 
-        tasks[task_id] = {"status": "processing", "progress": 0, "created_at": datetime.now().isoformat()}
-        
-        background_tasks.add_task(
-            run_processing_task, 
-            task_id, video_path, output_path, bg_path, 
-            (color_b, color_g, color_r), blur_radius, lighting_strength
+        # Lets the client send background_id instead of the image next time
+        bg_info = {"background_id": bg_id[1]} if bg_path else {}
+
+        reuse_config = FRAME_REUSE_CONFIG if (FRAME_REUSE if frame_reuse is None else frame_reuse) else None
+        roi_config = SUBJECT_ROI_CONFIG if (SUBJECT_ROI if subject_roi is None else subject_roi) else None
+
+        # Same inputs and settings -> same output: skip reprocessing
+        key = cache_key(video_hash, bg_id, blur_radius, lighting_strength,
+                        os.path.splitext(video.filename)[1].lower(),
+                        ENCODER_CONFIG.preset, ENCODER_CONFIG.crf, model_tier or DEFAULT_TIER,
+                        DOWNSAMPLE_RATIO, MAX_INFERENCE_SIDE, reuse_config and reuse_config.key(),
+                        roi_config and roi_config.key(), output_format)
+        outcome, found = await run_in_threadpool(claim_job, key, task_id)
+        if outcome == "new":
+            claimed_key = key
+        else:
+            await run_in_threadpool(remove_files, video_path)
+        if outcome == "cached":
+            print(f"Cache hit for task {task_id}: {found}")
+            task = {
+                "status": "completed", "progress": 100, "created_at": datetime.now().isoformat(),
+                "output_path": found,
+                "output_url": f"/download/{os.path.basename(found)}",
+                "cached": True,
+            }
+            await run_in_threadpool(task_store.create, task_id, task)
+            return {"task_id": task_id, **task, **bg_info}
+        if outcome == "inflight":
+            # The same job is already queued or running; share its task
+            REQUESTS_DEDUPED.inc()
+            shared = await run_in_threadpool(task_store.get, found) or {"status": "queued"}
+            stream_info = {"stream_url": shared["stream_url"]} if shared.get("stream_url") else {}
+            return {"task_id": found, "status": shared["status"], "deduplicated": True,
+                    **stream_info, **bg_info}
+
+        # Progressive output: HLS segments to watch while the job runs
+        stream_dir = None
+        stream_info = {}
+        if (STREAM_OUTPUT if stream is None else stream) and OUTPUT_FORMATS[output_format]["stream"]:
+            stream_dir = os.path.join(STREAM_DIR, task_id)
+            stream_info = {"stream_url": f"/stream/{task_id}/{HLS_PLAYLIST}"}
+
+        await run_in_threadpool(task_store.create, task_id, {
+            "status": "queued", "progress": 0, "created_at": datetime.now().isoformat(),
+            "video_path": video_path, "cache_key": key, "queued_at": time.time(),
+            "stream_dir": stream_dir, **stream_info,
+        })
+
+        job = dict(
+            input_path=video_path,
+            output_path=output_path,
+            background_path=bg_path,
+            background_color=(color_b, color_g, color_r),
+            blur_radius=blur_radius,
+            lighting_strength=lighting_strength,
+            pipelined=USE_PIPELINE,
+            pipeline_config=PIPELINE_CONFIG,
+            encoder_config=ENCODER_CONFIG,
+            matte_store=MATTE_STORE,
+            matte_key=video_hash,
+            segments=VIDEO_SEGMENTS,
+            segment_overlap=SEGMENT_OVERLAP,
+            trace_path=os.path.join(TRACE_DIR, f"{task_id}.json") if TRACE_DIR else None,
+            model_tier=model_tier,
+            downsample_ratio=DOWNSAMPLE_RATIO,
+            max_inference_side=MAX_INFERENCE_SIDE,
+            frame_reuse=reuse_config,
+            roi=roi_config,
+            background_cache=BACKGROUNDS,
+            output_format=output_format,
+            stream_dir=stream_dir,
         )
+        try:
+            position = await run_in_threadpool(scheduler.submit, task_id, job,
+                                               priority=max(-MAX_PRIORITY, min(priority, MAX_PRIORITY)))
+        except SchedulerFull as e:
+            await run_in_threadpool(task_store.delete, task_id)
+            release_job(key)
+            await run_in_threadpool(remove_files, video_path)
+            return JSONResponse(status_code=429, headers={"Retry-After": "30"}, content={
+                "error": "Server busy, try again later",
+                "queue_position": e.queue_length + 1,
+                "max_queue": e.max_queue,
+            })
 
-        return {"task_id": task_id}
+        return {"task_id": task_id, "status": "queued", "queue_position": position, **stream_info, **bg_info}
     except Exception as e:
         print(f"Error in /remove-background: {str(e)}")
+        if claimed_key:
+            # No job was queued for it, so later requests must not wait on it
+            release_job(claimed_key)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    if task_id not in tasks:
+    task = await run_in_threadpool(task_store.get, task_id)
+    if task is None:
         # Return a default "not found" response that won't cause polling to fail
         return {
             "status": "not_found",
             "progress": 0,
             "error": "Task not found or expired"
         }
-    task_data = tasks[task_id]
-    print(f"Status request for {task_id}: progress={task_data.get('progress', 0)}%, status={task_data.get('status', 'unknown')}")
+    task_data = public_task(task)
+    if task_data.get("status") == "queued":
+        task_data["queue_position"] = scheduler.position(task_id)
     return task_data
 
+@app.post("/cancel/{task_id}")
+async def cancel_task(task_id: str):
+    """
+    Cancels a queued or running task. A queued task is dropped at once; a
+    running one is 'cancelling' until its worker stops at the next batch,
+    removes the partial output and frees its slot.
+    """
+    task = await run_in_threadpool(task_store.get, task_id)
+    if task is None:
+        return JSONResponse(status_code=404, content={"error": "Task not found or expired"})
+    if task["status"] in FINISHED:
+        return JSONResponse(status_code=409, content={"error": f"Task already {task['status']}",
+                                                      "status": task["status"]})
+    if scheduler.cancel(task_id) == "running":
+        # Unless the worker has reported back in the meantime
+        task = await run_in_threadpool(task_store.update, task_id, only_if_status=("queued", "processing"),
+                                       status="cancelling", eta_seconds=None)
+        if task is not None:
+            progress_broker.publish(task_id, public_task(task))
+    task = await run_in_threadpool(task_store.get, task_id)
+    return {"task_id": task_id, "status": (task or {"status": "cancelled"})["status"]}
+
+@app.get("/events/{task_id}")
+async def task_events(task_id: str):
+    """Server-sent events with throttled progress, fps and ETA until the task finishes."""
+    updates = progress_broker.subscribe(task_id)
+    task = await run_in_threadpool(task_store.get, task_id)
+    if task is None:
+        progress_broker.unsubscribe(task_id, updates)
+        return JSONResponse(status_code=404, content={"error": "Task not found or expired"})
+
+    async def stream():
+        try:
+            data = public_task(task)
+            while True:
+                if data.get("status") == "queued":
+                    data["queue_position"] = scheduler.position(task_id)
+                yield f"data: {json.dumps(data)}\n\n"
+                if data.get("status") in FINISHED:
+                    return
+                try:
+                    data = await asyncio.wait_for(updates.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    data = public_task(await run_in_threadpool(task_store.get, task_id) or {"status": "not_found"})
+                    if data["status"] == "not_found":
+                        yield f"data: {json.dumps(data)}\n\n"
+                        return
+        finally:
+            progress_broker.unsubscribe(task_id, updates)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/ready")
+async def readiness():
+    """200 once a worker can take jobs and the preview model is loaded, 503 until then."""
+    stats = await run_in_threadpool(scheduler.stats)
+    model = preview_model.status()
+    ready = stats["ready_workers"] > 0 and (model["state"] == "ready" or not PRELOAD_MODEL)
+    body = {"ready": ready, "preview_model": model,
+            "workers": stats["workers"], "ready_workers": stats["ready_workers"]}
+    return body if ready else JSONResponse(status_code=503, content=body)
+
+@app.get("/queue")
+async def queue_stats():
+    stats = await run_in_threadpool(lambda: {**scheduler.stats(), "tasks": task_store.stats()})
+    return stats
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition."""
+    body = await run_in_threadpool(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+@app.get("/cache")
+async def cache_stats():
+    stats = await run_in_threadpool(lambda: {**output_cache.stats(), "mattes": MATTE_STORE.stats(),
+                                             "backgrounds": BACKGROUNDS.stats()})
+    return stats
+
 @app.post("/preview")
 async def preview_frame(
     video: UploadFile = File(...),
@@ -148,14 +673,14 @@ async def preview_frame(
     color_g: int = Form(255),
     color_b: int = Form(0),
     blur_radius: int = Form(0),
-    lighting_strength: float = Form(0.0)
+    lighting_strength: float = Form(0.0),
+    background_id: str = Form(None)
 ):
     try:
         temp_id = str(uuid.uuid4())
         video_path = os.path.join(UPLOAD_DIR, f"temp_preview_{temp_id}_{video.filename}")
         
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
+        await run_in_threadpool(save_upload, video, video_path)
 
         cap = cv2.VideoCapture(video_path)
         ret, frame = cap.read()
@@ -165,35 +690,145 @@ async def preview_frame(
         if not ret:
             return JSONResponse(status_code=400, content={"error": "Could not read video"})
 
-        bg_path = None
+        bg_path = digest = None
         if background:
-            bg_path = os.path.join(UPLOAD_DIR, f"temp_bg_{temp_id}_{background.filename}")
-            with open(bg_path, "wb") as buffer:
-                shutil.copyfileobj(background.file, buffer)
+            bg_path, digest = await run_in_threadpool(store_background, background)
+        elif background_id:
+            bg_path, digest = await run_in_threadpool(resolve_background, background_id), background_id
 
-        processed_frame = processor.process_single_frame(
-            frame, bg_path, (color_b, color_g, color_r), blur_radius, lighting_strength
-        )
-        
-        if bg_path and os.path.exists(bg_path):
-            os.remove(bg_path)
+        # Off the event loop; the lock keeps concurrent previews from
+        # interleaving on the single preview model's recurrent state
+        def render():
+            processor = get_preview_processor()
+            with preview_lock:
+                return processor.process_single_frame(
+                    frame, bg_path, (color_b, color_g, color_r), blur_radius, lighting_strength
+                )
+        processed_frame = await run_in_threadpool(render)
 
         _, buffer = cv2.imencode('.jpg', processed_frame)
         img_str = base64.b64encode(buffer).decode('utf-8')
         
-        return {"preview_url": f"data:image/jpeg;base64,{img_str}"}
+        return {"preview_url": f"data:image/jpeg;base64,{img_str}", **({"background_id": digest} if digest else {})}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in /preview: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/preview/sessions")
+async def create_preview_session(video: UploadFile = File(...)):
+    """Uploads a video once; previews are then rendered from the session."""
+    session_id, video_path = preview_sessions.new_video_path(video.filename)
+    await run_in_threadpool(save_upload, video, video_path)
+    try:
+        session = await run_in_threadpool(preview_sessions.create, session_id, video_path)
+    except Exception as e:
+        if os.path.exists(video_path):
+            os.remove(video_path)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return {**session.info(), "expires_in": preview_sessions.ttl_seconds}
+
+@app.post("/preview/sessions/{session_id}/render")
+async def render_preview(
+    session_id: str,
+    timestamp: float = Form(0.0),
+    background: UploadFile = File(None),
+    color_r: int = Form(0),
+    color_g: int = Form(255),
+    color_b: int = Form(0),
+    blur_radius: int = Form(0),
+    lighting_strength: float = Form(0.0),
+    background_id: str = Form(None)
+):
+    session = preview_sessions.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Preview session not found or expired"})
+    try:
+        bg_path = digest = None
+        if background:
+            bg_path, digest = await run_in_threadpool(store_background, background)
+        elif background_id:
+            bg_path, digest = await run_in_threadpool(resolve_background, background_id), background_id
+
+        def render():
+            processor = get_preview_processor()
+            with preview_lock:
+                return session.render(
+                    processor, timestamp, bg_path, (color_b, color_g, color_r),
+                    blur_radius, lighting_strength, warmup_frames=PREVIEW_WARMUP_FRAMES
+                )
+        frame_index, processed_frame = await run_in_threadpool(render)
+
+        _, buffer = cv2.imencode('.jpg', processed_frame)
+        img_str = base64.b64encode(buffer).decode('utf-8')
+        return {
+            "preview_url": f"data:image/jpeg;base64,{img_str}",
+            "frame_index": frame_index,
+            "timestamp": frame_index / session.fps,
+            **({"background_id": digest} if digest else {}),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in /preview/sessions/{session_id}/render: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/preview/sessions/{session_id}")
+async def delete_preview_session(session_id: str):
+    if not await run_in_threadpool(preview_sessions.delete, session_id):
+        return JSONResponse(status_code=404, content={"error": "Preview session not found or expired"})
+    return {"deleted": session_id}
+
+# Names ffmpeg gives the playlist, init section and segments of a stream
+STREAM_FILE = re.compile(r"^(index\.m3u8|init\.mp4|segment_\d+\.m4s)$")
+TASK_OUTPUT = re.compile(r"^out_([0-9a-f-]{36})_")
+
+def find_output(filename):
+    """Path of a finished output by its /download name, or None."""
+    filename = os.path.basename(filename)
+    # Outputs may be in a per-request output_dir: look them up by their task
+    match = TASK_OUTPUT.match(filename)
+    if match:
+        task = task_store.get(match.group(1))
+        path = task and task.get("status") == "completed" and task.get("output_path")
+        if path and os.path.basename(path) == filename and os.path.isfile(path):
+            return path
+    path = os.path.join(OUTPUT_DIR, filename)
+    if os.path.isfile(path):
+        return path
+    return output_cache.path_for(filename)
+
+@app.get("/stream/{task_id}/{name}")
+async def stream_file(task_id: str, name: str, request: Request):
+    """
+    The HLS playlist and segments of a task's progressive output. The
+    playlist grows while the job runs and is final once it ends with
+    #EXT-X-ENDLIST; segments never change once listed.
+    """
+    if not STREAM_FILE.match(name):
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+    task = await run_in_threadpool(task_store.get, task_id)
+    if task is None or not task.get("stream_dir"):
+        return JSONResponse(status_code=404, content={"error": "No stream for this task"})
+    path = os.path.join(task["stream_dir"], name)
+    if not os.path.isfile(path):
+        # Nothing encoded yet
+        return JSONResponse(status_code=404, headers={"Retry-After": "2"}, content={"error": "Not available yet"})
+    if name == HLS_PLAYLIST:
+        return file_response(path, media_type="application/vnd.apple.mpegurl", headers={"Cache-Control": "no-cache"})
+    return file_response(path, request.headers.get("range"), request.headers.get("if-range"),
+                         media_type="video/mp4", headers={"Cache-Control": "public, max-age=3600"})
+
 @app.get("/download/{filename}")
-async def download_video(filename: str):
-    file_path = os.path.join(OUTPUT_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    return JSONResponse(status_code=404, content={"error": "File not found"})
+async def download_video(filename: str, request: Request):
+    """Finished outputs, with Range support so downloads can resume and players seek."""
+    path = await run_in_threadpool(find_output, filename)
+    if path is None:
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+    return file_response(path, request.headers.get("range"), request.headers.get("if-range"))
 
 if __name__ == "__main__":
     import uvicorn
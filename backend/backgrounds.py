@@ -0,0 +1,217 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from lighting import background_lab_stats
+
+
+def render_background(background_path, background_color, blur_radius, width, height):
+    """Background image (or solid color) at the frame size, with blur applied."""
+    if background_path:
+        _check_exists(background_path)
+        bg_img = cv2.imread(background_path)
+        bg_img = cv2.resize(bg_img, (width, height))
+    else:
+        bg_img = np.full((height, width, 3), background_color, dtype=np.uint8)
+
+    # Apply Blur if needed
+    if blur_radius > 0:
+        ksize = int(blur_radius * 2 + 1)
+        bg_img = cv2.GaussianBlur(bg_img, (ksize, ksize), 0)
+    return bg_img
+
+
+def _check_exists(background_path):
+    # A job queued with an image must not quietly get the solid color
+    # because the cache evicted its asset in the meantime
+    if not os.path.exists(background_path):
+        raise Exception(f"Background image {os.path.basename(background_path)} is no longer available")
+
+
+class PreparedBackground:
+    """A background at one frame size and blur, with what compositing needs from it."""
+
+    def __init__(self, image):
+        self.image = image
+        # Float copy in [0, 1] as the Compositor blends it
+        self.image_f = image.astype(np.float32) / 255.0
+        self._lab_stats = None
+
+    @property
+    def lab_stats(self):
+        # Only lighting matching needs these
+        if self._lab_stats is None:
+            self._lab_stats = background_lab_stats(self.image)
+        return self._lab_stats
+
+    @property
+    def nbytes(self):
+        return self.image.nbytes + self.image_f.nbytes
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(cache_dir, max_disk_bytes, max_memory_bytes):
+    """The process-wide BackgroundCache for cache_dir."""
+    with _shared_lock:
+        cache = _shared.get(cache_dir)
+        if cache is None:
+            cache = _shared[cache_dir] = BackgroundCache(cache_dir, max_disk_bytes, max_memory_bytes)
+        return cache
+
+
+class BackgroundCache:
+    """
+    Content-addressed background images and their prepared variants.
+
+    Uploaded images are stored once under their SHA-256, so repeated
+    uploads of the same background share one file. Each (image or color,
+    frame size, blur radius) is decoded, resized and blurred once: the
+    result stays in an in-memory LRU bounded by max_memory_bytes, and image
+    variants are also written next to the asset as .npy so other processes
+    skip the decode. Files are evicted least recently used first once the
+    directory exceeds max_disk_bytes.
+
+    Pickling (e.g. into a worker's job) resolves to the receiving process's
+    shared instance for the same directory, so workers keep their memory
+    cache across jobs.
+    """
+
+    def __init__(self, cache_dir, max_disk_bytes=2 * 1024 ** 3, max_memory_bytes=512 * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._prepared = OrderedDict()
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        return shared_cache, (self.cache_dir, self.max_disk_bytes, self.max_memory_bytes)
+
+    def store(self, src_path, digest):
+        """Moves an uploaded image into the cache as its asset; returns the asset path."""
+        ext = os.path.splitext(src_path)[1].lower()
+        dest = os.path.join(self.cache_dir, digest + ext)
+        if os.path.exists(dest):
+            os.remove(src_path)
+            os.utime(dest)
+        else:
+            shutil.move(src_path, dest)
+            self.evict()
+        return dest
+
+    def lookup(self, digest):
+        """Path of a stored asset by its SHA-256, or None."""
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(digest) and not name.endswith(".npy") and ".tmp-" not in name:
+                return os.path.join(self.cache_dir, name)
+        return None
+
+    def asset_id(self, path):
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.cache_dir):
+            return os.path.splitext(os.path.basename(path))[0]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, background_path, background_color, blur_radius, width, height):
+        """PreparedBackground for the arguments of render_background."""
+        if background_path:
+            _check_exists(background_path)
+            asset = self.asset_id(background_path)
+            key = ("image", asset, width, height, blur_radius)
+        else:
+            asset = None
+            key = ("color", tuple(background_color), width, height, blur_radius)
+
+        with self._lock:
+            prepared = self._prepared.get(key)
+            if prepared is not None:
+                self._prepared.move_to_end(key)
+                self.hits += 1
+                return prepared
+            self.misses += 1
+
+        image = None
+        variant_path = None
+        if asset:
+            variant_path = os.path.join(self.cache_dir, f"{asset}_{width}x{height}_b{blur_radius}.npy")
+            try:
+                image = np.load(variant_path)
+                os.utime(variant_path)
+            except (OSError, ValueError):
+                image = None
+        if image is None:
+            image = render_background(background_path, background_color, blur_radius, width, height)
+            if variant_path:
+                self._save_variant(variant_path, image)
+        prepared = PreparedBackground(image)
+
+        with self._lock:
+            if key not in self._prepared:
+                self._prepared[key] = prepared
+                self._memory_bytes += prepared.nbytes
+            while self._memory_bytes > self.max_memory_bytes and len(self._prepared) > 1:
+                _, old = self._prepared.popitem(last=False)
+                self._memory_bytes -= old.nbytes
+            return self._prepared.get(key, prepared)
+
+    def _save_variant(self, path, image):
+        tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}.npy"
+        try:
+            np.save(tmp, image)
+            # Atomic publish, so a reader never loads a half-written variant
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not store background variant: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._prepared)
+            memory = self._memory_bytes
+        disk = 0
+        for name in os.listdir(self.cache_dir):
+            try:
+                disk += os.path.getsize(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+        return {
+            "prepared": entries,
+            "memory_bytes": memory,
+            "disk_bytes": disk,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
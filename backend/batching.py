@@ -0,0 +1,365 @@
+import threading
+import time
+
+import numpy as np
+
+from inference import RVMInference
+from model_registry import DEFAULT_TIER
+from refine import ResolutionPolicy
+
+
+class _Request:
+    """
+    One frame of one stream waiting for a batched model run. The run writes
+    pha and fgr into the stream's output slots and the new state into rec
+    (in place, or into new arrays for a fresh stream).
+    """
+
+    def __init__(self, src, rec, key, pha_out, fgr_out):
+        self.src = src
+        self.rec = rec
+        self.key = key
+        self.pha_out = pha_out
+        self.fgr_out = fgr_out
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.error = None
+        self.batch_size = 0
+
+
+class _BatchBuffers:
+    """
+    Stacked inputs and outputs for one (height, width, ratio), bound to the
+    session for every run. The state buffers are allocated once a run has
+    reported the state shapes.
+    """
+
+    def __init__(self, n, height, width, dtype):
+        self.src = np.empty((n, 3, height, width), dtype=dtype)
+        self.fgr = np.empty((n, 3, height, width), dtype=dtype)
+        self.pha = np.empty((n, 1, height, width), dtype=dtype)
+        self.rec_in = None
+        self.rec_out = None
+
+    def allocate_states(self, shapes):
+        n = self.src.shape[0]
+        self.rec_in = [np.empty((n,) + tuple(shape[1:]), dtype=self.src.dtype) for shape in shapes]
+        self.rec_out = [np.empty_like(buf) for buf in self.rec_in]
+
+
+# Frame sizes whose batch buffers a batcher keeps at once
+_MAX_BUFFER_SETS = 4
+
+
+class StreamBatcher:
+    """
+    Shares one ONNX session between several videos (streams) with the same
+    model. Each stream keeps its own recurrent state; the next frame of
+    every stream that is inferring at the same resolution and downsample
+    ratio goes into one run with the streams as the batch dimension, and
+    the outputs and new states are copied back to each stream's buffers.
+    The stacked inputs and outputs are preallocated per frame size and
+    bound to the session, like RVMInference's buffers.
+
+    A batch starts once every busy stream has a frame waiting, max_batch
+    frames are ready, or the oldest frame has waited `window` seconds,
+    whichever comes first. A single busy stream never waits.
+    """
+
+    def __init__(self, engine, window=0.005, max_batch=8):
+        self.engine = engine
+        self.sess = engine.sess
+        self.binding = self.sess.io_binding()
+        self._ratio_buf = np.empty_like(engine._ratio_buf)
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._buffers = {}
+        self._cond = threading.Condition()
+        self._pending = []
+        # Streams currently inside process_batch; only they can add frames soon
+        self._busy = 0
+        self._thread = None
+        self.batches = 0
+        self.frames = 0
+
+    def stream(self):
+        return BatchedStream(self)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "batches": self.batches,
+                "frames": self.frames,
+                "mean_batch_size": round(self.frames / self.batches, 3) if self.batches else 0.0,
+                "max_batch": self.max_batch,
+                "window_ms": round(self.window * 1000, 3),
+            }
+
+    def enter(self):
+        with self._cond:
+            self._busy += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="stream-batcher", daemon=True)
+                self._thread.start()
+
+    def leave(self):
+        with self._cond:
+            self._busy -= 1
+            # The streams left may all be waiting already
+            self._cond.notify_all()
+
+    def infer(self, src, rec, key, pha_out, fgr_out):
+        """
+        Runs one frame of a stream: src [3, H, W] in, pha [1, H, W] and
+        fgr [3, H, W] written to pha_out and fgr_out. Returns the new state
+        (rec itself, updated in place, unless the stream was fresh) and the
+        size of the batch the frame ran in.
+        """
+        request = _Request(src, rec, key, pha_out, fgr_out)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.rec, request.batch_size
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0].queued + self.window
+                while len(self._pending) < min(self._busy, self.max_batch):
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                # Oldest frame first, with whatever matches its shape and ratio
+                key = self._pending[0].key
+                group = [r for r in self._pending if r.key == key][:self.max_batch]
+                self._pending = [r for r in self._pending if r not in group]
+            self._run_group(group)
+
+    def _run_group(self, group):
+        try:
+            try:
+                self._run(group)
+            except Exception as e:
+                if len(group) == 1:
+                    raise
+                # Some exports only take a batch of one
+                print(f"Batched inference failed ({e}), running streams one at a time")
+                self.max_batch = 1
+                for request in group:
+                    self._run_group([request])
+                return
+        except Exception as e:
+            for request in group:
+                request.error = e
+                request.done.set()
+            return
+
+        with self._cond:
+            self.batches += 1
+            self.frames += len(group)
+        for request in group:
+            request.batch_size = len(group)
+            request.done.set()
+
+    def _buffers_for(self, key):
+        buf = self._buffers.get(key)
+        if buf is None or buf.src.shape[0] < self.max_batch:
+            if len(self._buffers) >= _MAX_BUFFER_SETS:
+                self._buffers.pop(next(iter(self._buffers)))
+            buf = self._buffers[key] = _BatchBuffers(self.max_batch, key[0], key[1], self.engine.dtype)
+        return buf
+
+    def _bind_ptr(self, name, arr, output=False):
+        bind = self.binding.bind_output if output else self.binding.bind_input
+        bind(name, 'cpu', 0, arr.dtype, list(arr.shape), arr.ctypes.data)
+
+    def _run(self, group):
+        n = len(group)
+        buf = self._buffers_for(group[0].key)
+        for i, request in enumerate(group):
+            np.copyto(buf.src[i], request.src)
+
+        binding = self.binding
+        self._ratio_buf[0] = group[0].key[2]
+        binding.bind_cpu_input('downsample_ratio', self._ratio_buf)
+        self._bind_ptr('src', buf.src[:n])
+        self._bind_ptr('fgr', buf.fgr[:n], output=True)
+        self._bind_ptr('pha', buf.pha[:n], output=True)
+
+        known = next((r.rec for r in group if r.rec is not None), None)
+        if buf.rec_in is None and known is not None:
+            buf.allocate_states([state.shape for state in known])
+        if buf.rec_in is None:
+            # Every stream is fresh and the state shapes are not known yet:
+            # 1x1 zero states broadcast in the model, and ORT sizes the outputs
+            for k in range(1, 5):
+                binding.bind_cpu_input(f'r{k}i', np.repeat(self.engine.rec[f'r{k}i'], n, axis=0))
+                binding.bind_output(f'r{k}o', 'cpu')
+            self.sess.run_with_iobinding(binding)
+            states = binding.copy_outputs_to_cpu()[2:]
+            buf.allocate_states([state.shape for state in states])
+            for state, out in zip(states, buf.rec_out):
+                out[:n] = state
+        else:
+            for i, request in enumerate(group):
+                for k in range(4):
+                    if request.rec is None:
+                        buf.rec_in[k][i].fill(0)
+                    else:
+                        np.copyto(buf.rec_in[k][i], request.rec[k][0])
+            for k in range(4):
+                self._bind_ptr(f'r{k + 1}i', buf.rec_in[k][:n])
+                self._bind_ptr(f'r{k + 1}o', buf.rec_out[k][:n], output=True)
+            self.sess.run_with_iobinding(binding)
+
+        for i, request in enumerate(group):
+            np.copyto(request.pha_out, buf.pha[i])
+            np.copyto(request.fgr_out, buf.fgr[i])
+            if request.rec is None:
+                request.rec = [state[i:i + 1].copy() for state in buf.rec_out]
+            else:
+                for state, out in zip(request.rec, buf.rec_out):
+                    np.copyto(state, out[i:i + 1])
+
+
+class BatchedStream:
+    """
+    The inference engine of one video, with RVMInference's interface, whose
+    frames run through a shared StreamBatcher instead of a session of its
+    own. The model and its metadata are batcher.engine's; the recurrent
+    state, the output ring and the resolution policy belong to the stream,
+    so resolution capping and upsampling work as in RVMInference.
+    """
+
+    use_onnx = True
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.engine = batcher.engine
+        self.backend = self.engine.backend
+        self.tier = self.engine.tier
+        self.timings = None
+        self.output_ring_size = 2
+        self._buffers_key = None
+        self.resolution = ResolutionPolicy(ring_size=self.output_ring_size)
+        self.set_resolution_policy(self.engine.downsample_ratio, self.engine.max_inference_side)
+        self.reset_states()
+        self.reset_stats()
+
+    def set_resolution_policy(self, downsample_ratio=0.25, max_inference_side=None):
+        self.resolution.set(downsample_ratio, max_inference_side)
+        self.downsample_ratio = self.resolution.downsample_ratio
+        self.max_inference_side = self.resolution.max_inference_side
+        self.model_id = self.resolution.model_id(self.engine._model_name)
+
+    def reset_states(self):
+        self.rec = None
+        self._rec_shape_for = None
+
+    def reset_stats(self):
+        self.frames = 0
+        self._batched = 0
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "mean_batch_size": round(self._batched / self.frames, 3) if self.frames else 0.0,
+        }
+
+    def set_output_ring_size(self, size):
+        """Number of process_batch results that may be alive at once."""
+        if size != self.output_ring_size:
+            self.output_ring_size = max(1, size)
+            self._buffers_key = None
+            self.resolution.set_ring_size(self.output_ring_size)
+
+    def _ensure_buffers(self, n, height, width):
+        # The batcher stacks _src into its input, so one frame buffer does
+        key = self._buffers_key
+        if key is not None and key[0] >= n and key[1:] == (height, width, self.output_ring_size):
+            return
+        n = max(n, key[0]) if key is not None and key[1:3] == (height, width) else n
+        dtype = self.engine.dtype
+        self._src = np.empty((3, height, width), dtype=dtype)
+        self._fgr_ring = [np.empty((n, 3, height, width), dtype=dtype) for _ in range(self.output_ring_size)]
+        self._pha_ring = [np.empty((n, 1, height, width), dtype=dtype) for _ in range(self.output_ring_size)]
+        self._ring_pos = 0
+        self._buffers_key = (n, height, width, self.output_ring_size)
+
+    def process_batch(self, frames_bgr):
+        if not frames_bgr:
+            return []
+        return self.resolution.process_batch(frames_bgr, self._run, self.timings)
+
+    def _run(self, frames_bgr):
+        n = len(frames_bgr)
+        height, width = frames_bgr[0].shape[:2]
+        if self._rec_shape_for != (height, width):
+            self.rec = None
+            self._rec_shape_for = (height, width)
+        self._ensure_buffers(n, height, width)
+        fgr_out = self._fgr_ring[self._ring_pos]
+        pha_out = self._pha_ring[self._ring_pos]
+        self._ring_pos = (self._ring_pos + 1) % self.output_ring_size
+        key = (height, width, self.resolution.ratio_for(height, width))
+
+        timings = self.timings
+        preprocess = model_run = 0.0
+        start = time.perf_counter()
+        self.batcher.enter()
+        try:
+            for i, frame in enumerate(frames_bgr):
+                t0 = time.perf_counter()
+                np.multiply(frame[:, :, 2::-1].transpose(2, 0, 1), np.float32(1 / 255.0),
+                            out=self._src, casting='unsafe')
+                t1 = time.perf_counter()
+                self.rec, batch_size = self.batcher.infer(self._src, self.rec, key, pha_out[i], fgr_out[i])
+                model_run += time.perf_counter() - t1
+                preprocess += t1 - t0
+                self._batched += batch_size
+        finally:
+            self.batcher.leave()
+        self.frames += n
+        if timings is not None:
+            timings.add("preprocess", busy=preprocess, items=n, start=start)
+            timings.add("model_run", busy=model_run, items=n, start=start)
+        # Views into the ring slot, as RVMInference returns them
+        return [(pha_out[i, 0], fgr_out[i].transpose(1, 2, 0)) for i in range(n)]
+
+
+class BatcherPool:
+    """
+    The StreamBatchers of one process, one per tier, created on first use.
+    stream(tier) hands out a new BatchedStream; for engines without ONNX
+    (the PyTorch fallback) it returns a private RVMInference instead.
+    """
+
+    def __init__(self, model_path, intra_op_threads=None, window=0.005, max_batch=8):
+        self.model_path = model_path
+        self.intra_op_threads = intra_op_threads
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._batchers = {}
+
+    def stream(self, tier=None):
+        tier = tier or DEFAULT_TIER
+        with self._lock:
+            batcher = self._batchers.get(tier)
+            if batcher is None:
+                engine = RVMInference(self.model_path, intra_op_threads=self.intra_op_threads, tier=tier)
+                if not engine.use_onnx:
+                    return engine
+                batcher = self._batchers[tier] = StreamBatcher(engine, self.window, self.max_batch)
+        return batcher.stream()
+
+    def stats(self):
+        with self._lock:
+            batchers = dict(self._batchers)
+        return {tier: b.stats() for tier, b in batchers.items()}
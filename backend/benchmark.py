@@ -0,0 +1,364 @@
+"""
+Offline CPU benchmark for the matting pipeline.
+
+Generates synthetic clips, runs process_video and process_single_frame
+over a matrix of settings and writes the results as JSON. With --baseline
+the results are compared against an earlier run and the exit code is 1 if
+any case got slower than the threshold allows.
+
+    python benchmark.py --resolutions 480p,720p --frames 90 --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.10
+
+When the model directory has no usable ONNX variant, a small stand-in ONNX
+model with the RVM inputs and outputs is generated (needs the `onnx`
+package). It exercises the whole pipeline, but its cost is not the real
+network's, so only compare runs made with the same model.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+
+RESOLUTIONS = {
+    "480p": (854, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+
+# name -> process_video / process_single_frame settings
+SCENARIOS = {
+    "color": dict(),
+    "image": dict(background="image"),
+    "image_blur": dict(background="image", blur_radius=15),
+    "color_lighting": dict(lighting_strength=0.5),
+    "image_blur_lighting": dict(background="image", blur_radius=15, lighting_strength=0.5),
+}
+
+MODEL_DIR = os.path.join(os.path.dirname(__file__), "model")
+
+
+def make_video(path, width, height, frames, fps=30):
+    """A moving blob over a drifting gradient, so every frame differs."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    if not writer.isOpened():
+        raise Exception(f"Could not create {path}")
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    for i in range(frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:, :, 0] = (xs + i * 3) % 256
+        frame[:, :, 1] = (ys + i * 2) % 256
+        frame[:, :, 2] = 96
+        center = (int(width * (0.3 + 0.4 * (i % 60) / 60)), height // 2)
+        cv2.ellipse(frame, center, (width // 8, height // 3), 0, 0, 360, (40, 160, 220), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def make_background(path, width, height):
+    rng = np.random.default_rng(0)
+    img = cv2.resize(rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8),
+                     (width, height), interpolation=cv2.INTER_CUBIC)
+    cv2.imwrite(path, img)
+
+
+def make_standin_model(path):
+    """
+    Writes an ONNX model with RVM's signature: a downsample, two small
+    convolutions and an upsample produce pha, fgr passes src through, and
+    the recurrent states decay.
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(0)
+    init = [
+        numpy_helper.from_array(np.array([1, 1], dtype=np.float32), "ones"),
+        numpy_helper.from_array(np.array(0.5, dtype=np.float32), "half"),
+        numpy_helper.from_array(rng.normal(0, 0.3, (16, 3, 3, 3)).astype(np.float32), "w1"),
+        numpy_helper.from_array(rng.normal(0, 0.3, (1, 16, 3, 3)).astype(np.float32), "w2"),
+    ]
+    nodes = [
+        helper.make_node("Identity", ["src"], ["fgr"]),
+        helper.make_node("Concat", ["ones", "downsample_ratio", "downsample_ratio"], ["scales"], axis=0),
+        helper.make_node("Resize", ["src", "", "scales"], ["small"], mode="linear"),
+        helper.make_node("Conv", ["small", "w1"], ["c1"], pads=[1, 1, 1, 1]),
+        helper.make_node("Relu", ["c1"], ["r1"]),
+        helper.make_node("Conv", ["r1", "w2"], ["c2"], pads=[1, 1, 1, 1]),
+        helper.make_node("Shape", ["src"], ["src_shape"]),
+        helper.make_node("Slice", ["src_shape", "hw_start", "hw_end"], ["hw"]),
+        helper.make_node("Concat", ["nc", "hw"], ["sizes"], axis=0),
+        helper.make_node("Resize", ["c2", "", "", "sizes"], ["up"], mode="linear"),
+        helper.make_node("Sigmoid", ["up"], ["pha"]),
+    ]
+    init += [
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "hw_start"),
+        numpy_helper.from_array(np.array([4], dtype=np.int64), "hw_end"),
+        numpy_helper.from_array(np.array([1, 1], dtype=np.int64), "nc"),
+    ]
+    inputs = [helper.make_tensor_value_info("src", TensorProto.FLOAT, ["b", 3, "h", "w"])]
+    outputs = [
+        helper.make_tensor_value_info("fgr", TensorProto.FLOAT, ["b", 3, "h", "w"]),
+        helper.make_tensor_value_info("pha", TensorProto.FLOAT, ["b", 1, "h", "w"]),
+    ]
+    for i, channels in enumerate([16, 20, 40, 64], start=1):
+        inputs.append(helper.make_tensor_value_info(f"r{i}i", TensorProto.FLOAT, ["b", channels, f"h{i}", f"w{i}"]))
+        outputs.append(helper.make_tensor_value_info(f"r{i}o", TensorProto.FLOAT, ["b", channels, f"h{i}", f"w{i}"]))
+        nodes.append(helper.make_node("Mul", [f"r{i}i", "half"], [f"r{i}o"]))
+    inputs.append(helper.make_tensor_value_info("downsample_ratio", TensorProto.FLOAT, [1]))
+
+    graph = helper.make_graph(nodes, "rvm_standin", inputs, outputs, init)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+
+def resolve_model(work_dir):
+    """Returns (model_path, kind): the real RVM weights if present, else a stand-in."""
+    from model_registry import ModelRegistry
+
+    if ModelRegistry(MODEL_DIR).candidates():
+        return os.path.join(MODEL_DIR, "rvm_mobilenetv3.pth"), "rvm"
+    standin_dir = os.path.join(work_dir, "model")
+    os.makedirs(standin_dir, exist_ok=True)
+    onnx_path = os.path.join(standin_dir, "rvm_mobilenetv3_fp32.onnx")
+    if not os.path.exists(onnx_path):
+        print(f"RVM weights not found, generating stand-in model at {onnx_path}")
+        make_standin_model(onnx_path)
+    return os.path.join(standin_dir, "rvm_mobilenetv3.pth"), "standin"
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def _snapshot():
+    # Leaves out the memory of the snapshots themselves
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+class FrameAllocations:
+    """
+    tracemalloc figures for a frame loop, with frame(current, total) called
+    after every frame (it fits process_video's progress_callback). The
+    traced peak between two calls, above the memory in use at the first,
+    is that frame's transient allocation; snapshots at the first and last
+    call give the bytes and blocks the loop kept per frame.
+    """
+
+    def __init__(self):
+        self.transient = []
+        self.peak = 0
+        self._base = tracemalloc.get_traced_memory()[0]
+        self._current = None
+        self._first = self._last = None
+
+    def frame(self, current, total):
+        in_use, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak - self._base)
+        if self._current is not None:
+            self.transient.append(peak - self._current)
+        if self._first is None:
+            self._first = _snapshot()
+        elif current >= total:
+            self._last = _snapshot()
+        tracemalloc.reset_peak()
+        self._current = tracemalloc.get_traced_memory()[0]
+
+    def summary(self):
+        frames = len(self.transient)
+        result = {
+            "alloc_peak_bytes": self.peak,
+            "alloc_bytes_per_frame": int(np.mean(self.transient)) if frames else None,
+            "retained_bytes_per_frame": None,
+            "retained_blocks_per_frame": None,
+        }
+        if frames and self._last is not None:
+            stats = self._last.compare_to(self._first, "filename")
+            result["retained_bytes_per_frame"] = int(sum(s.size_diff for s in stats) / frames)
+            result["retained_blocks_per_frame"] = round(sum(s.count_diff for s in stats) / frames, 2)
+        return result
+
+
+def _settings(scenario, background_path):
+    settings = dict(SCENARIOS[scenario])
+    if settings.pop("background", None) == "image":
+        settings["background_path"] = background_path
+    return settings
+
+
+def _run_case(case, model_path, measure_allocations):
+    """Runs one case in a fresh process so peak RSS belongs to it alone."""
+    from pipeline import PipelineConfig
+    from video_processor import VideoProcessor
+
+    processor = VideoProcessor(model_path)
+    settings = _settings(case["scenario"], case["background_path"])
+    result = {k: case[k] for k in ("name", "kind", "scenario", "resolution", "frames")}
+
+    if case["kind"] == "video":
+        config = PipelineConfig(report_timings=False)
+        output_path = os.path.join(case["work_dir"], f"out_{case['name'].replace('/', '_')}.mp4")
+        start = time.perf_counter()
+        processor.process_video(case["video_path"], output_path, pipelined=case["pipelined"],
+                                pipeline_config=config, **settings)
+        seconds = time.perf_counter() - start
+        result["stages"] = processor.last_timings
+        os.remove(output_path)
+    else:
+        cap = cv2.VideoCapture(case["video_path"])
+        frames = []
+        while len(frames) < case["frames"]:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+        processor.process_single_frame(frames[0], **settings)
+        start = time.perf_counter()
+        for frame in frames:
+            processor.process_single_frame(frame, **settings)
+        seconds = time.perf_counter() - start
+
+    result["seconds"] = round(seconds, 4)
+    result["fps"] = round(case["frames"] / seconds, 3) if seconds > 0 else None
+    result["peak_rss_mb"] = peak_rss_mb()
+
+    if measure_allocations:
+        # Separate short pass: tracing slows everything down. Counts Python
+        # and NumPy heap allocations, not memory owned by ONNX Runtime/OpenCV.
+        frames = min(case["frames"], 16)
+        tracemalloc.start()
+        allocations = FrameAllocations()
+        if case["kind"] == "video":
+            output_path = os.path.join(case["work_dir"], f"alloc_{case['name'].replace('/', '_')}.mp4")
+            processor.process_video(case["video_path"], output_path, pipelined=case["pipelined"],
+                                    pipeline_config=PipelineConfig(report_timings=False),
+                                    end_frame=frames, progress_callback=allocations.frame, **settings)
+            os.remove(output_path)
+        else:
+            cap = cv2.VideoCapture(case["video_path"])
+            allocations.frame(0, frames)
+            for i in range(frames):
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                processor.process_single_frame(frame, **settings)
+                allocations.frame(i + 1, frames)
+            cap.release()
+        result.update(allocations.summary())
+        tracemalloc.stop()
+    return result
+
+
+def build_cases(work_dir, resolutions, frames, scenarios, frame_samples):
+    cases = []
+    for res in resolutions:
+        width, height = RESOLUTIONS[res]
+        video_path = os.path.join(work_dir, f"synthetic_{res}_{frames}.avi")
+        if not os.path.exists(video_path):
+            print(f"Generating {video_path}")
+            make_video(video_path, width, height, frames)
+        background_path = os.path.join(work_dir, f"background_{res}.png")
+        if not os.path.exists(background_path):
+            make_background(background_path, width, height)
+        base = dict(resolution=res, video_path=video_path, background_path=background_path, work_dir=work_dir)
+        for scenario in scenarios:
+            for pipelined in (True, False):
+                mode = "pipelined" if pipelined else "serial"
+                cases.append(dict(base, name=f"video/{res}/{scenario}/{mode}", kind="video",
+                                  scenario=scenario, frames=frames, pipelined=pipelined))
+            cases.append(dict(base, name=f"frame/{res}/{scenario}", kind="frame",
+                              scenario=scenario, frames=min(frames, frame_samples)))
+    return cases
+
+
+def compare(results, baseline, threshold):
+    """Returns the cases whose fps dropped by more than threshold (a fraction)."""
+    previous = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results["results"]:
+        old = previous.get(r["name"])
+        if not old or not old.get("fps") or not r.get("fps"):
+            continue
+        change = r["fps"] / old["fps"] - 1
+        flag = "REGRESSION" if change < -threshold else ""
+        print(f"  {r['name']:<45} {old['fps']:>9.2f} -> {r['fps']:>9.2f} fps ({change:+.1%}) {flag}")
+        if change < -threshold:
+            regressions.append(r["name"])
+    if baseline["meta"].get("model") != results["meta"].get("model"):
+        print("Warning: baseline was run with a different model")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Veditor matting pipeline")
+    parser.add_argument("--resolutions", default="480p,720p", help=f"comma-separated, from {','.join(RESOLUTIONS)}")
+    parser.add_argument("--frames", type=int, default=90, help="frames per synthetic clip")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--frame-samples", type=int, default=30, help="frames timed through process_single_frame")
+    parser.add_argument("--work-dir", default=os.path.join(os.path.dirname(__file__), "cache", "benchmark"))
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed fps drop vs the baseline")
+    parser.add_argument("--no-allocations", action="store_true", help="skip the tracemalloc pass")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    model_path, model_kind = resolve_model(args.work_dir)
+    cases = build_cases(args.work_dir, args.resolutions.split(","), args.frames,
+                        args.scenarios.split(","), args.frame_samples)
+
+    results = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "model": model_kind,
+        },
+        "results": [],
+    }
+    ctx = mp.get_context("spawn")
+    for case in cases:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(_run_case, (case, model_path, not args.no_allocations))
+        line = f"{result['name']:<45} {result['fps']:>9.2f} fps  peak RSS {result['peak_rss_mb']} MB"
+        if result.get("alloc_bytes_per_frame") is not None:
+            line += f"  {result['alloc_bytes_per_frame'] / 1024:.0f} KiB/frame allocated"
+        print(line)
+        results["results"].append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Comparison with {args.baseline} (threshold {args.threshold:.0%}):")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+def cache_key(*parts):
+    """Stable hex digest over the given parts (hashes, numbers, strings)."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(repr(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class OutputCache:
+    """
+    Content-addressed cache of finished outputs.
+
+    Files live in cache_dir named by their key; the index (size, last
+    access) and hit/miss counters live in a SQLite database next to them,
+    so several API or worker processes can share one cache safely. Entries
+    not accessed for ttl_seconds are dropped, and least recently used
+    entries are evicted whenever the total size exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, ttl_seconds=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "index.sqlite3")
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL,
+                created REAL NOT NULL, last_access REAL NOT NULL)""")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _count(self, db, name):
+        db.execute("INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def _remove(self, db, key, filename):
+        db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        try:
+            os.remove(os.path.join(self.cache_dir, filename))
+        except OSError:
+            pass
+
+    def lookup(self, key):
+        """Returns the cached file path for key, or None (and counts a miss)."""
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute("SELECT filename, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+            if row:
+                filename, last_access = row
+                path = os.path.join(self.cache_dir, filename)
+                if now - last_access > self.ttl_seconds or not os.path.exists(path):
+                    self._remove(db, key, filename)
+                else:
+                    db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                    self._count(db, "hits")
+                    return path
+            self._count(db, "misses")
+        return None
+
+    def put(self, key, src_path):
+        """Adds src_path under key (hard link when possible) and returns the cached path."""
+        filename = key + os.path.splitext(src_path)[1]
+        dest = os.path.join(self.cache_dir, filename)
+        tmp = f"{dest}.tmp-{os.getpid()}"
+        try:
+            os.link(src_path, tmp)
+        except OSError:
+            shutil.copy2(src_path, tmp)
+        # Atomic publish: readers see either no file or the whole file
+        os.replace(tmp, dest)
+
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                       (key, filename, os.path.getsize(dest), now, now))
+            self._count(db, "stores")
+        self.evict()
+        return dest
+
+    def path_for(self, filename):
+        """Resolves a file name served from the cache, or None."""
+        name = os.path.basename(filename)
+        if name.startswith("index.sqlite3") or ".tmp-" in name:
+            return None
+        path = os.path.join(self.cache_dir, name)
+        return path if os.path.isfile(path) else None
+
+    def evict(self):
+        now = time.time()
+        with self._connect() as db:
+            for key, filename in db.execute(
+                    "SELECT key, filename FROM entries WHERE last_access < ?", (now - self.ttl_seconds,)).fetchall():
+                self._remove(db, key, filename)
+                self._count(db, "evictions")
+
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, filename, size in db.execute(
+                    "SELECT key, filename, size FROM entries ORDER BY last_access ASC").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._remove(db, key, filename)
+                self._count(db, "evictions")
+                total -= size
+
+    def stats(self):
+        with self._connect() as db:
+            counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "stores": counters.get("stores", 0),
+            "evictions": counters.get("evictions", 0),
+        }
@@ -0,0 +1,80 @@
+import time
+
+import cv2
+import numpy as np
+
+
+class Compositor:
+    """
+    Blends RVM output over a fixed background using preallocated scratch
+    buffers and in-place NumPy ops, so a frame costs no full-size temporaries.
+
+    Computes  out = bg + alpha * (clip(fgr_bgr) - bg)  which is algebraically
+    the same as the original fgr * alpha + bg * (1 - alpha). The float
+    reassociation can move a pixel across an integer boundary, so results
+    match the reference path within 1 LSB per channel (uint8).
+
+    The RGB -> BGR swap is folded into the first clip, and the background is
+    converted to float once per job. Output frames come from a ring of
+    out_ring_size uint8 buffers: a buffer is reused only after that many
+    later frames, so size the ring to cover every frame still queued for
+    encoding.
+    """
+
+    def __init__(self, bg_img, lighting=None, out_ring_size=1, timings=None, bg_f=None):
+        self.height, self.width = bg_img.shape[:2]
+        # Background-dependent terms, computed once per job (or passed in
+        # from a shared PreparedBackground; only ever read)
+        self.bg_f = bg_img.astype(np.float32) / 255.0 if bg_f is None else bg_f
+        # FullFrameLighting or LightingMatcher from lighting.py
+        self.lighting = lighting
+        # Optional StageTimings; lighting is timed separately from the blend
+        self.timings = timings
+
+        shape = (self.height, self.width)
+        self._alpha = np.empty(shape, dtype=np.float32)
+        self._work = np.empty(shape + (3,), dtype=np.float32)
+        self._scratch = np.empty(shape + (3,), dtype=np.float32) if lighting else None
+        self._out_ring = [np.empty(shape + (3,), dtype=np.uint8) for _ in range(max(1, out_ring_size))]
+        self._out_pos = 0
+
+    def composite(self, alpha, foreground):
+        """alpha [H, W] and foreground [H, W, 3] RGB (float or uint8) -> BGR uint8 frame."""
+        target = (self.height, self.width)
+        # Resize if model output doesn't match input exactly (unlikely but safe)
+        if alpha.shape[:2] != target:
+            alpha = cv2.resize(alpha, (self.width, self.height))
+        if foreground.shape[:2] != target:
+            foreground = cv2.resize(foreground, (self.width, self.height))
+
+        a = self._alpha
+        work = self._work
+        # Stored mattes arrive as uint8 and are scaled while being copied in
+        if alpha.dtype == np.uint8:
+            np.multiply(alpha, np.float32(1 / 255.0), out=a, casting='unsafe')
+        else:
+            np.clip(alpha, 0, 1, out=a)
+        # Clip and RGB -> BGR in one pass
+        if foreground.dtype == np.uint8:
+            np.multiply(foreground[:, :, ::-1], np.float32(1 / 255.0), out=work, casting='unsafe')
+        else:
+            np.clip(foreground[:, :, ::-1], 0, 1, out=work)
+
+        if self.lighting is not None:
+            if self.timings is not None:
+                t0 = time.perf_counter()
+                self.lighting.correct(a, work, self._scratch)
+                self.timings.add("lighting", busy=time.perf_counter() - t0, items=1, start=t0)
+            else:
+                self.lighting.correct(a, work, self._scratch)
+
+        np.subtract(work, self.bg_f, out=work)
+        np.multiply(work, a[:, :, np.newaxis], out=work)
+        np.add(work, self.bg_f, out=work)
+        np.multiply(work, 255, out=work)
+        # A convex blend of [0, 1] values stays in range, so no final clip;
+        # the cast truncates like the original astype(np.uint8)
+        out = self._out_ring[self._out_pos]
+        self._out_pos = (self._out_pos + 1) % len(self._out_ring)
+        np.copyto(out, work, casting='unsafe')
+        return out
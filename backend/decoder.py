@@ -0,0 +1,249 @@
+import json
+import subprocess
+import tempfile
+
+import cv2
+import numpy as np
+
+from encoder import ffmpeg_version, find_ffprobe
+
+
+class VideoInfo:
+    """
+    Metadata of an input video. width and height are the displayed size,
+    i.e. after applying the rotation, as both decoders return frames that
+    way. audio_codec is '' for a video without audio and None if unknown.
+    """
+
+    def __init__(self, width, height, fps, frame_count, duration=None, rotation=0, audio_codec=None,
+                 source='opencv'):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frame_count = frame_count
+        self.duration = duration
+        self.rotation = rotation
+        self.audio_codec = audio_codec
+        # 'ffprobe' or 'opencv': where the numbers come from
+        self.source = source
+
+    @property
+    def has_audio(self):
+        return bool(self.audio_codec) if self.audio_codec is not None else None
+
+    def __repr__(self):
+        return (f"VideoInfo({self.width}x{self.height}, {self.fps:.3f} fps, {self.frame_count} frames, "
+                f"rotation {self.rotation}, audio {self.audio_codec!r}, from {self.source})")
+
+
+def _rate(text):
+    try:
+        num, _, den = (text or '').partition('/')
+        value = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return value if value > 0 else None
+
+
+def _rotation(stream):
+    rotate = stream.get('tags', {}).get('rotate')
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            rotate = side_data['rotation']
+    try:
+        return int(round(float(rotate))) % 360 if rotate is not None else 0
+    except ValueError:
+        return 0
+
+
+def probe_with_ffprobe(ffprobe_path, input_path):
+    """VideoInfo from one ffprobe run, or None if ffprobe cannot read the file."""
+    try:
+        result = subprocess.run(
+            [ffprobe_path, '-v', 'error', '-show_streams', '-show_format', '-of', 'json', input_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60
+        )
+        if result.returncode != 0:
+            return None
+        data = json.loads(result.stdout.decode(errors='replace') or '{}')
+    except Exception:
+        return None
+
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    if video is None:
+        return None
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+    # avg_frame_rate is the mean over the file, which keeps variable frame
+    # rate phone recordings at their real duration
+    fps = _rate(video.get('avg_frame_rate')) or _rate(video.get('r_frame_rate')) or 30
+    try:
+        duration = float(video.get('duration') or data.get('format', {}).get('duration') or 0) or None
+    except ValueError:
+        duration = None
+    nb_frames = str(video.get('nb_frames', ''))
+    if nb_frames.isdigit() and int(nb_frames) > 0:
+        frame_count = int(nb_frames)
+    else:
+        # Containers like Matroska do not store a frame count
+        frame_count = int(round(duration * fps)) if duration else 0
+
+    width, height = int(video.get('width', 0)), int(video.get('height', 0))
+    rotation = _rotation(video)
+    if rotation in (90, 270):
+        width, height = height, width
+    return VideoInfo(width, height, fps, frame_count, duration, rotation,
+                     audio_codec=audio.get('codec_name', '') if audio else '', source='ffprobe')
+
+
+def probe_video(input_path, ffmpeg_path=None):
+    """
+    VideoInfo for input_path: from a single ffprobe run when ffprobe is
+    available next to ffmpeg_path (or on PATH), otherwise from OpenCV's
+    CAP_PROP_* values.
+    """
+    ffprobe_path = find_ffprobe(ffmpeg_path)
+    if ffprobe_path:
+        info = probe_with_ffprobe(ffprobe_path, input_path)
+        if info is not None:
+            return info
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        raise Exception(f"Could not open video {input_path}")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        return VideoInfo(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                         fps, frame_count, frame_count / fps if fps > 0 else None)
+    finally:
+        cap.release()
+
+
+# Channels per pixel of the raw formats FFmpegReader can ask for
+_CHANNELS = {'bgr24': 3, 'bgra': 4, 'gray': 1}
+
+
+class FFmpegReader:
+    """
+    Decodes a video through an ffmpeg rawvideo pipe, with the read()/
+    release() interface of cv2.VideoCapture. Frames are read with readinto
+    straight into a ring of ring_size preallocated buffers, so decoding
+    allocates nothing per frame; a returned frame stays valid until
+    ring_size more frames have been read.
+
+    start_frame seeks before decoding. size=(width, height) scales and
+    pix_fmt ('bgr24', 'bgra' or 'gray') converts inside ffmpeg.
+    """
+
+    def __init__(self, ffmpeg_path, input_path, info, ring_size=8, start_frame=0, size=None, pix_fmt='bgr24'):
+        self.width, self.height = size or (info.width, info.height)
+        channels = _CHANNELS[pix_fmt]
+        shape = (self.height, self.width, channels) if channels > 1 else (self.height, self.width)
+        self._ring = [np.empty(shape, dtype=np.uint8) for _ in range(max(2, ring_size))]
+        self._views = [memoryview(buf).cast('B') for buf in self._ring]
+        self._pos = 0
+        self.frames_read = 0
+
+        cmd = [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin']
+        if start_frame > 0:
+            # Half a frame early, so rounding never skips the start frame;
+            # ffmpeg decodes from the keyframe before and drops what precedes it
+            cmd += ['-ss', f'{(start_frame - 0.5) / info.fps:.6f}']
+        cmd += ['-i', input_path, '-map', '0:v:0', '-an', '-sn']
+        if size:
+            cmd += ['-vf', f'scale={self.width}:{self.height}:flags=area']
+        # One output frame per decoded frame: the rawvideo muxer is constant
+        # rate by default, which duplicates or drops frames of VFR inputs and
+        # breaks the match with the probed frame count and audio
+        version = ffmpeg_version(ffmpeg_path)
+        cmd += ['-vsync', '0'] if version and version < (5, 1) else ['-fps_mode', 'passthrough']
+        cmd += ['-f', 'rawvideo', '-pix_fmt', pix_fmt, 'pipe:1']
+
+        # stderr goes to a file: an unread pipe would stall ffmpeg once full
+        self._log = tempfile.TemporaryFile()
+        # Unbuffered, so readinto goes from the pipe into the ring directly
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=self._log, bufsize=0)
+
+    def isOpened(self):
+        return self.proc is not None
+
+    def read(self):
+        if self.proc is None:
+            return False, None
+        view = self._views[self._pos]
+        filled = 0
+        while filled < len(view):
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        if filled < len(view):
+            if self.frames_read == 0:
+                print(f"FFmpeg decoder returned no frames: {self._stderr_tail()}")
+            return False, None
+        frame = self._ring[self._pos]
+        self._pos = (self._pos + 1) % len(self._ring)
+        self.frames_read += 1
+        return True, frame
+
+    def _stderr_tail(self):
+        self._log.seek(0)
+        return self._log.read().decode(errors='replace')[-2000:]
+
+    def release(self):
+        if self.proc is None:
+            return
+        self.proc.stdout.close()
+        # Jobs with an end frame stop reading before ffmpeg is done
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self._log.close()
+        self.proc = None
+
+
+class CaptureReader:
+    """
+    cv2.VideoCapture that decodes into a ring of ring_size preallocated
+    buffers (VideoCapture.read fills a passed array of the right shape in
+    place) instead of a new array per frame.
+    """
+
+    def __init__(self, input_path, info, ring_size=8, start_frame=0):
+        self.cap = cv2.VideoCapture(input_path)
+        if not self.cap.isOpened():
+            raise Exception(f"Could not open video {input_path}")
+        if start_frame > 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        self._ring = [np.empty((info.height, info.width, 3), dtype=np.uint8) for _ in range(max(2, ring_size))]
+        self._pos = 0
+        self.frames_read = 0
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self):
+        ret, frame = self.cap.read(self._ring[self._pos])
+        if not ret:
+            return False, None
+        # A frame of another size than probed comes back as a new array
+        if frame.ctypes.data == self._ring[self._pos].ctypes.data:
+            self._pos = (self._pos + 1) % len(self._ring)
+        self.frames_read += 1
+        return True, frame
+
+    def release(self):
+        self.cap.release()
+
+
+def open_video(input_path, info, ffmpeg_path=None, start_frame=0, ring_size=8, decoder='opencv'):
+    """
+    A reader positioned at start_frame. decoder 'ffmpeg' uses FFmpegReader
+    when ffmpeg is available and info came from ffprobe; otherwise frames
+    are decoded by OpenCV.
+    """
+    if decoder == 'ffmpeg' and ffmpeg_path and info.source == 'ffprobe':
+        return FFmpegReader(ffmpeg_path, input_path, info, ring_size=ring_size, start_frame=start_frame)
+    return CaptureReader(input_path, info, ring_size=ring_size, start_frame=start_frame)
@@ -0,0 +1,322 @@
+import functools
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+
+FFMPEG_CANDIDATES = ['ffmpeg', 'C:\\ffmpeg\\ffmpeg.exe', '/usr/bin/ffmpeg', '/usr/local/bin/ffmpeg']
+
+# Audio codecs that can be stream-copied into an MP4/MOV container as-is
+MP4_COPY_SAFE_AUDIO = {'aac', 'mp3', 'alac', 'ac3', 'eac3', 'opus'}
+
+
+@functools.lru_cache(maxsize=None)
+def find_ffmpeg():
+    """Returns a working ffmpeg executable or None; looked up once per process."""
+    for path in FFMPEG_CANDIDATES:
+        try:
+            result = subprocess.run([path, '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5)
+            if result.returncode == 0:
+                return path
+        except Exception:
+            continue
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_version(ffmpeg_path):
+    """(major, minor) of an ffmpeg release, or None for git builds and unparsable output."""
+    try:
+        result = subprocess.run([ffmpeg_path, '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=5)
+        match = re.match(r'ffmpeg version n?(\d+)\.(\d+)', result.stdout.decode(errors='replace'))
+    except Exception:
+        return None
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+@functools.lru_cache(maxsize=None)
+def find_ffprobe(ffmpeg_path):
+    """ffprobe normally ships next to ffmpeg."""
+    if ffmpeg_path:
+        base = os.path.basename(ffmpeg_path).replace('ffmpeg', 'ffprobe')
+        sibling = os.path.join(os.path.dirname(ffmpeg_path), base)
+        if os.path.dirname(ffmpeg_path) and os.path.exists(sibling):
+            return sibling
+    return shutil.which('ffprobe')
+
+
+def probe_audio_codec(ffmpeg_path, input_path):
+    """
+    Returns the codec name of the first audio stream, '' if the input has no
+    audio, or None if it could not be determined.
+    """
+    ffprobe_path = find_ffprobe(ffmpeg_path)
+    if not ffprobe_path:
+        return None
+    try:
+        result = subprocess.run(
+            [ffprobe_path, '-v', 'error', '-select_streams', 'a:0',
+             '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', input_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30
+        )
+        if result.returncode != 0:
+            return None
+        return result.stdout.decode().strip()
+    except Exception:
+        return None
+
+
+def choose_audio_codec(ffmpeg_path, audio_source, output_path, audio_codec='copy', source_codec=None):
+    """
+    Stream copy when the source audio fits the output container, else AAC.
+    source_codec, when already known, saves probing audio_source.
+    """
+    if audio_codec != 'copy':
+        return audio_codec
+    if output_path.lower().endswith(('.mp4', '.mov', '.m4v')):
+        if source_codec is None:
+            source_codec = probe_audio_codec(ffmpeg_path, audio_source)
+        if source_codec and source_codec not in MP4_COPY_SAFE_AUDIO:
+            print(f"Audio codec {source_codec} cannot be copied into {os.path.splitext(output_path)[1]}, re-encoding to AAC")
+            return 'aac'
+    return 'copy'
+
+
+def concat_segments(ffmpeg_path, segment_paths, output_path, audio_source=None, audio_codec='copy'):
+    """
+    Joins independently encoded segments with the concat demuxer (stream
+    copy, no re-encode) and muxes the audio of audio_source.
+    """
+    list_fd, list_path = tempfile.mkstemp(suffix='.txt')
+    try:
+        with os.fdopen(list_fd, 'w') as f:
+            for path in segment_paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        cmd = [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 'concat', '-safe', '0', '-i', list_path]
+        if audio_source:
+            cmd += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?']
+        cmd += ['-c:v', 'copy']
+        if audio_source:
+            cmd += ['-c:a', choose_audio_codec(ffmpeg_path, audio_source, output_path, audio_codec), '-shortest']
+        if output_path.lower().endswith(('.mp4', '.mov', '.m4v')):
+            cmd += ['-movflags', '+faststart']
+        cmd.append(output_path)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg concat failed: {result.stderr.decode(errors='replace')[-2000:]}")
+    finally:
+        os.remove(list_path)
+
+
+# Output formats: extension, raw layout piped into ffmpeg and whether the
+# source audio is kept. 'composite' is the flattened H.264 video in MP4; the others
+# keep the matte for compositing downstream (see export.py). Sequences are
+# written as numbered images and delivered as one zip.
+# 'stream': the encode can also be served as HLS while it runs (browser-playable H.264 only)
+OUTPUT_FORMATS = {
+    'composite': {'ext': '.mp4', 'pix_fmt': 'bgr24', 'audio': True, 'stream': True},
+    'matte': {'ext': '.mp4', 'pix_fmt': 'gray', 'audio': False, 'stream': False},
+    'webm_alpha': {'ext': '.webm', 'pix_fmt': 'bgra', 'audio': True, 'stream': False},
+    'prores4444': {'ext': '.mov', 'pix_fmt': 'bgra', 'audio': True, 'stream': False},
+    'png_sequence': {'ext': '.zip', 'pix_fmt': 'bgra', 'audio': False, 'stream': False},
+    'exr_sequence': {'ext': '.zip', 'pix_fmt': 'gbrapf32le', 'audio': False, 'stream': False},
+}
+
+# Playlist of a progressive (HLS) output, inside its stream directory
+HLS_PLAYLIST = 'index.m3u8'
+
+
+def _video_args(output_format, config):
+    if output_format == 'webm_alpha':
+        return ['-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p', '-b:v', '0', '-crf', '30',
+                '-row-mt', '1', '-threads', str(config.threads)]
+    if output_format == 'prores4444':
+        return ['-c:v', 'prores_ks', '-profile:v', '4444', '-pix_fmt', 'yuva444p10le',
+                '-alpha_bits', '16', '-threads', str(config.threads)]
+    if output_format == 'png_sequence':
+        return ['-c:v', 'png', '-pix_fmt', 'rgba']
+    if output_format == 'exr_sequence':
+        return ['-c:v', 'exr', '-compression', 'zip1']
+    if output_format == 'matte':
+        # Lossless 4:0:0 H.264: the 8-bit alpha comes back bit-exact, full range
+        return ['-c:v', 'libx264', '-preset', config.preset, '-qp', '0', '-threads', str(config.threads),
+                '-pix_fmt', 'gray', '-color_range', 'pc']
+    return ['-c:v', 'libx264', '-preset', config.preset, '-crf', str(config.crf),
+            '-threads', str(config.threads), '-pix_fmt', 'yuv420p']
+
+
+class EncoderConfig:
+    """libx264 settings for the single-pass ffmpeg writer."""
+
+    def __init__(self, preset='fast', crf=23, threads=0, audio_codec='copy', use_ffmpeg=True,
+                 hls_segment_seconds=2.0):
+        self.preset = preset
+        self.crf = crf
+        # 0 lets libx264 pick based on the core count
+        self.threads = threads
+        # 'copy' keeps the source audio bit-exact; falls back to AAC when the
+        # source codec cannot live in the output container
+        self.audio_codec = audio_codec
+        self.use_ffmpeg = use_ffmpeg
+        # Segment length of progressive (HLS) outputs
+        self.hls_segment_seconds = hls_segment_seconds
+
+
+class FFmpegWriter:
+    """
+    Streams raw frames over a pipe into a single ffmpeg process that
+    encodes them and muxes the audio straight from the original input.
+    Mirrors the cv2.VideoWriter write/release interface.
+
+    output_format (see OUTPUT_FORMATS) selects the encode: by default BGR
+    frames become H.264; matte exports take the frames export.MatteExporter
+    produces, so nothing passes through a lossy intermediate.
+
+    source_audio_codec is the codec of audio_source's audio if known
+    ('' when it has none, see decoder.VideoInfo).
+
+    With stream_dir (formats with 'stream' in OUTPUT_FORMATS), ffmpeg
+    writes an HLS event playlist (HLS_PLAYLIST) of fragmented MP4 segments
+    there as it encodes, with a keyframe at every segment boundary, so the
+    result can be watched while the job runs. release() stream-copies the
+    segments into output_path.
+    """
+
+    def __init__(self, ffmpeg_path, output_path, width, height, fps,
+                 audio_source=None, config=None, output_format='composite', source_audio_codec=None,
+                 stream_dir=None):
+        self.config = config or EncoderConfig()
+        self.ffmpeg_path = ffmpeg_path
+        self.output_path = output_path
+        self.stream_dir = stream_dir
+        self.width = width
+        self.height = height
+        self.frames_written = 0
+        spec = OUTPUT_FORMATS[output_format]
+        self.frame_shape = {'bgr24': (height, width, 3), 'gray': (height, width),
+                            'bgra': (height, width, 4), 'gbrapf32le': (4, height, width)}[spec['pix_fmt']]
+        if not spec['audio'] or source_audio_codec == '':
+            audio_source = None
+
+        # Image sequences go to a temp directory and are zipped on release
+        self._sequence_dir = None
+        target = output_path
+        if output_format.endswith('_sequence'):
+            self._sequence_dir = tempfile.mkdtemp(prefix='veditor_sequence_')
+            ext = 'exr' if output_format == 'exr_sequence' else 'png'
+            target = os.path.join(self._sequence_dir, f'frame_%06d.{ext}')
+
+        cmd = [
+            ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', spec['pix_fmt'],
+            '-s', f'{width}x{height}', '-r', f'{fps}',
+            '-i', 'pipe:0',
+        ]
+        if audio_source:
+            cmd += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?']
+        cmd += _video_args(output_format, self.config)
+        if stream_dir:
+            cmd += ['-force_key_frames', f'expr:gte(t,n_forced*{self.config.hls_segment_seconds})']
+        if audio_source:
+            audio_codec = self.config.audio_codec
+            if output_format == 'webm_alpha' and audio_codec == 'copy':
+                # WebM only carries Opus/Vorbis
+                audio_codec = 'libopus'
+            # Segments are MP4 fragments, whatever the container of output_path
+            container = 'segments.mp4' if stream_dir else output_path
+            cmd += ['-c:a', choose_audio_codec(ffmpeg_path, audio_source, container, audio_codec,
+                                               source_audio_codec), '-shortest']
+        if stream_dir:
+            os.makedirs(stream_dir, exist_ok=True)
+            # temp_file: a segment only appears under its name once complete
+            cmd += ['-f', 'hls', '-hls_time', str(self.config.hls_segment_seconds),
+                    '-hls_playlist_type', 'event', '-hls_segment_type', 'fmp4',
+                    '-hls_fmp4_init_filename', 'init.mp4',
+                    '-hls_segment_filename', os.path.join(stream_dir, 'segment_%05d.m4s'),
+                    '-hls_flags', 'temp_file+independent_segments',
+                    os.path.join(stream_dir, HLS_PLAYLIST)]
+        else:
+            if output_path.lower().endswith(('.mp4', '.mov', '.m4v')):
+                cmd += ['-movflags', '+faststart']
+            cmd.append(target)
+
+        # stderr goes to a file: an unread pipe would stall ffmpeg once full
+        self._log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._log)
+
+    def isOpened(self):
+        return self.proc.poll() is None
+
+    def write(self, frame):
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"Invalid frame shape: {frame.shape}, expected {self.frame_shape}")
+        try:
+            self.proc.stdin.write(frame.data if frame.flags['C_CONTIGUOUS'] else frame.tobytes())
+        except (BrokenPipeError, OSError):
+            raise Exception(f"FFmpeg encoder exited early: {self._stderr_tail()}")
+        self.frames_written += 1
+
+    def _stderr_tail(self):
+        self._log.seek(0)
+        return self._log.read().decode(errors='replace')[-2000:]
+
+    def release(self):
+        """Closes the pipe and waits for ffmpeg to finish writing the file."""
+        if self.proc.stdin and not self.proc.stdin.closed:
+            try:
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+        returncode = self.proc.wait()
+        log = self._stderr_tail()
+        self._log.close()
+        if returncode != 0:
+            self._remove_sequence()
+            raise Exception(f"FFmpeg encode failed ({returncode}): {log}")
+        if self._sequence_dir:
+            self._zip_sequence()
+        if self.stream_dir:
+            self._remux_stream()
+
+    def _remux_stream(self):
+        # Segments are kept for playback; the download is a plain file
+        cmd = [self.ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+               '-i', os.path.join(self.stream_dir, HLS_PLAYLIST), '-map', '0', '-c', 'copy']
+        if self.output_path.lower().endswith(('.mp4', '.mov', '.m4v')):
+            cmd += ['-movflags', '+faststart']
+        cmd.append(self.output_path)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg remux of the stream failed: {result.stderr.decode(errors='replace')[-2000:]}")
+
+    def _zip_sequence(self):
+        # PNG and EXR are compressed already, so the zip only stores them
+        tmp = f"{self.output_path}.tmp-{os.getpid()}"
+        try:
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED) as archive:
+                for name in sorted(os.listdir(self._sequence_dir)):
+                    archive.write(os.path.join(self._sequence_dir, name), name)
+            os.replace(tmp, self.output_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            self._remove_sequence()
+
+    def _remove_sequence(self):
+        if self._sequence_dir:
+            shutil.rmtree(self._sequence_dir, ignore_errors=True)
+            self._sequence_dir = None
+
+    def abort(self):
+        """Kills the encoder without waiting for a valid file."""
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self._log.close()
+        self._remove_sequence()
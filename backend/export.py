@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class MatteExporter:
+    """
+    Turns RVM output into the raw frames FFmpegWriter expects for a matte
+    export format (see encoder.OUTPUT_FORMATS), in place of the Compositor:
+
+      matte         alpha as 8-bit gray
+      webm_alpha,   straight (not premultiplied) foreground with alpha as
+      prores4444,   8-bit BGRA
+      png_sequence
+      exr_sequence  float32 G, B, R, A planes, no quantization at all
+
+    Accepts float output from the model and the uint8 frames of a stored
+    matte. Output frames come from a ring of out_ring_size buffers, like
+    the Compositor's.
+    """
+
+    def __init__(self, width, height, output_format, out_ring_size=1):
+        self.width = width
+        self.height = height
+        self.output_format = output_format
+        if output_format == 'matte':
+            shape, dtype = (height, width), np.uint8
+        elif output_format == 'exr_sequence':
+            shape, dtype = (4, height, width), np.float32
+        else:
+            shape, dtype = (height, width, 4), np.uint8
+        self._work = np.empty((height, width, 3), dtype=np.float32)
+        self._alpha = np.empty((height, width), dtype=np.float32)
+        self._out_ring = [np.empty(shape, dtype=dtype) for _ in range(max(1, out_ring_size))]
+        self._out_pos = 0
+
+    def _to_8bit(self, src, work, out):
+        if src.dtype == np.uint8:
+            np.copyto(out, src)
+            return
+        np.multiply(src, 255, out=work)
+        np.clip(work, 0, 255, out=work)
+        np.add(work, 0.5, out=work)
+        np.copyto(out, work, casting='unsafe')
+
+    def frame(self, alpha, foreground):
+        """alpha [H, W] and foreground [H, W, 3] RGB -> one frame for the writer."""
+        out = self._out_ring[self._out_pos]
+        self._out_pos = (self._out_pos + 1) % len(self._out_ring)
+
+        if self.output_format == 'matte':
+            self._to_8bit(alpha, self._alpha, out)
+        elif self.output_format == 'exr_sequence':
+            scale = np.float32(1 / 255.0) if foreground.dtype == np.uint8 else np.float32(1)
+            for plane, channel in zip(out[:3], (1, 2, 0)):
+                np.multiply(foreground[:, :, channel], scale, out=plane, casting='unsafe')
+            np.clip(out[:3], 0, 1, out=out[:3])
+            ascale = np.float32(1 / 255.0) if alpha.dtype == np.uint8 else np.float32(1)
+            np.multiply(alpha, ascale, out=out[3], casting='unsafe')
+            np.clip(out[3], 0, 1, out=out[3])
+        else:
+            # RGB -> BGR as part of the copy into the first three channels
+            self._to_8bit(foreground[:, :, ::-1], self._work, out[:, :, :3])
+            self._to_8bit(alpha, self._alpha, out[:, :, 3])
+        return out
@@ -0,0 +1,131 @@
+import cv2
+import numpy as np
+
+
+class FrameReuseConfig:
+    """Settings for skipping inference on near-identical frames."""
+
+    def __init__(self, threshold=1.0, max_interval=8, probe_width=64):
+        # Mean absolute difference of the grayscale probe images (0-255)
+        # below which a frame counts as unchanged
+        self.threshold = threshold
+        # A real inference runs at least every max_interval frames
+        self.max_interval = max(1, max_interval)
+        # Width of the downsampled probe used for the comparison
+        self.probe_width = probe_width
+
+    def key(self):
+        """Part of cache keys for anything produced with reuse enabled."""
+        return ("reuse", self.threshold, self.max_interval, self.probe_width)
+
+
+class FrameReuse:
+    """
+    Wraps an RVMInference's process_batch for static shots. Each frame is
+    shrunk to a small grayscale probe and compared with the probe of the
+    last inferred frame; when the difference is under the threshold the
+    previous alpha is reused and the foreground is rebuilt from the current
+    frame plus the last foreground residual, so lips and eyes still move.
+    Only the changed frames go through the model, in one batch.
+
+    Outputs of reused frames come from a ring sized like the engine's, so
+    they stay valid as long as the engine's own results do.
+    """
+
+    def __init__(self, inference, config=None):
+        self.inference = inference
+        self.config = config or FrameReuseConfig()
+        self.frames = 0
+        self.reused = 0
+        self._probe = None
+        self._since_inferred = 0
+        self._held_key = None
+        self._ring_key = None
+
+    def stats(self):
+        cfg = self.config
+        return {
+            "threshold": cfg.threshold,
+            "max_interval": cfg.max_interval,
+            "frames": self.frames,
+            "reused": self.reused,
+            "reused_fraction": round(self.reused / self.frames, 4) if self.frames else 0.0,
+        }
+
+    def _make_probe(self, frame):
+        height, width = frame.shape[:2]
+        probe_height = max(1, round(height * self.config.probe_width / width))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (self.config.probe_width, probe_height), interpolation=cv2.INTER_AREA)
+
+    def _ensure_buffers(self, n, height, width):
+        if self._held_key != (height, width):
+            self._held_alpha = np.empty((height, width), dtype=np.float32)
+            self._held_residual = np.empty((height, width, 3), dtype=np.float32)
+            self._rgb = np.empty((height, width, 3), dtype=np.uint8)
+            self._rgb_f = np.empty((height, width, 3), dtype=np.float32)
+            self._held_key = (height, width)
+            self._probe = None
+        slots = n * self.inference.output_ring_size
+        key = self._ring_key
+        if key is not None and key[:2] == (height, width) and key[2] >= slots:
+            return
+        self._alpha_ring = [np.empty((height, width), dtype=np.float32) for _ in range(slots)]
+        self._fgr_ring = [np.empty((height, width, 3), dtype=np.float32) for _ in range(slots)]
+        self._ring_pos = 0
+        self._ring_key = (height, width, slots)
+
+    def _hold(self, frame, alpha, foreground):
+        # Copies, since the engine reuses its output buffers
+        np.copyto(self._held_alpha, alpha, casting='unsafe')
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        np.copyto(self._held_residual, foreground, casting='unsafe')
+        np.copyto(self._rgb_f, self._rgb, casting='unsafe')
+        cv2.scaleAdd(self._rgb_f, -1 / 255.0, self._held_residual, dst=self._held_residual)
+
+    def _reuse(self, frame):
+        alpha = self._alpha_ring[self._ring_pos]
+        foreground = self._fgr_ring[self._ring_pos]
+        self._ring_pos = (self._ring_pos + 1) % len(self._alpha_ring)
+        np.copyto(alpha, self._held_alpha)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        foreground[...] = self._rgb
+        cv2.scaleAdd(foreground, 1 / 255.0, self._held_residual, dst=foreground)
+        return alpha, foreground
+
+    def process_batch(self, frames_bgr):
+        if not frames_bgr:
+            return []
+        height, width = frames_bgr[0].shape[:2]
+        self._ensure_buffers(len(frames_bgr), height, width)
+
+        # Decide per frame; a frame can only reuse a matte inferred before it,
+        # so the first inferred frame of the batch resolves the later ones
+        plan = []
+        probe = self._probe
+        since = self._since_inferred
+        for frame in frames_bgr:
+            current = self._make_probe(frame)
+            unchanged = (probe is not None and since < self.config.max_interval
+                         and cv2.absdiff(current, probe).mean() < self.config.threshold)
+            if unchanged:
+                since += 1
+            else:
+                probe = current
+                since = 1
+            plan.append(not unchanged)
+        self._probe = probe
+        self._since_inferred = since
+
+        inferred = iter(self.inference.process_batch([f for f, run in zip(frames_bgr, plan) if run]))
+        results = []
+        for frame, run in zip(frames_bgr, plan):
+            if run:
+                alpha, foreground = next(inferred)
+                self._hold(frame, alpha, foreground)
+                results.append((alpha, foreground))
+            else:
+                results.append(self._reuse(frame))
+                self.reused += 1
+        self.frames += len(frames_bgr)
+        return results
@@ -1,101 +1,298 @@
 import os
-import cv2
+import time
 import numpy as np
 import onnxruntime as ort
+from model_registry import DEFAULT_TIER, MODEL_DIR, ModelRegistry
+from refine import ResolutionPolicy
+
+# ONNX tensor types the buffers can take
+_NP_TYPES = {'tensor(float)': np.float32, 'tensor(float16)': np.float16}
+
+
+# TorchScript traces kept per engine, one per input shape and ratio
+_MAX_TRACES = 8
+
 
 class RVMInference:
-    def __init__(self, model_path_pth, device='cpu'):
-        # Prefer ONNX if available for speed
-        model_dir = os.path.dirname(model_path_pth)
-        onnx_path = os.path.join(model_dir, "rvm_mobilenetv3_fp32.onnx")
-        
-        self.use_onnx = os.path.exists(onnx_path)
+    def __init__(self, model_path_pth, device='cpu', intra_op_threads=None, tier=None,
+                 onnx_path=None, session_config=None, downsample_ratio=0.25, max_inference_side=None,
+                 use_torch=False):
+        # Prefer ONNX if available for speed: the registry picks the variant
+        # for the tier (or onnx_path names one) and applies the session tuning
+        model_dir = os.path.dirname(model_path_pth) if model_path_pth else MODEL_DIR
+        registry = ModelRegistry(model_dir, session_config)
+        self.tier = tier or DEFAULT_TIER
+        if use_torch:
+            self.sess = None
+        elif onnx_path:
+            variant_name = os.path.basename(onnx_path)
+            self.sess = ort.InferenceSession(onnx_path,
+                                             sess_options=registry.session_config.session_options(intra_op_threads),
+                                             providers=['CPUExecutionProvider'])
+        else:
+            variant, self.sess = registry.create_session(self.tier, intra_op_threads)
+            variant_name = variant.name if variant else None
+
+        self.use_onnx = self.sess is not None
+        self.backend = 'onnxruntime' if self.use_onnx else 'torch'
+        # Optional StageTimings for the preprocess / model_run split
+        self.timings = None
         if self.use_onnx:
-            print(f"Using ONNX Runtime for inference: {onnx_path}")
-            self.sess = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
-            self.rec = {
-                'r1i': np.zeros([1, 16, 1, 1], dtype=np.float32),
-                'r2i': np.zeros([1, 20, 1, 1], dtype=np.float32),
-                'r3i': np.zeros([1, 40, 1, 1], dtype=np.float32),
-                'r4i': np.zeros([1, 64, 1, 1], dtype=np.float32)
-            }
+            print(f"Using ONNX Runtime for inference: {variant_name}" + ("" if onnx_path else f" (tier {self.tier})"))
+            self._model_name = variant_name
+            self.binding = self.sess.io_binding()
+            types = {i.name: _NP_TYPES.get(i.type, np.float32) for i in self.sess.get_inputs()}
+            # fp16 exports take and return half-precision tensors
+            self.dtype = types.get('src', np.float32)
+            self._ratio_buf = np.array([0.25], dtype=types.get('downsample_ratio', np.float32))
+            # Output buffers are handed to the caller as views, so keep a ring
+            # of them: a slot is only reused once the consumer is done with it.
+            # process_video sizes this to the depth of its pipeline.
+            self.output_ring_size = 2
+            self._buffers_key = None
+            self.reset_states()
         else:
-            print("ONNX model not found, falling back to PyTorch (Slower)")
+            print("No usable ONNX model found, falling back to PyTorch (Slower)")
             import torch
             import sys
             sys.path.append(os.path.join(os.path.dirname(__file__), 'rvm_repo'))
             from model import MattingNetwork
+            config = registry.session_config
+            threads = intra_op_threads or config.torch_threads
+            if threads:
+                torch.set_num_threads(threads)
             self.device = torch.device('cuda' if torch.cuda.is_available() and device == 'cuda' else 'cpu')
             self.model = MattingNetwork('mobilenetv3').to(self.device).eval()
-            self.model.load_state_dict(torch.load(model_path_pth, map_location=self.device))
+            if config.shared_weights and self.device.type == 'cpu':
+                # Parameters stay backed by the mapped checkpoint, shared between processes
+                state = torch.load(model_path_pth, map_location=self.device, mmap=True)
+                self.model.load_state_dict(state, assign=True)
+            else:
+                self.model.load_state_dict(torch.load(model_path_pth, map_location=self.device))
+            # Inference only; TorchScript also refuses to bake in weights that require grad
+            self.model.requires_grad_(False)
+            # NHWC suits the CPU convolution kernels; frames arrive that way anyway
+            self.channels_last = config.torch_channels_last
+            if self.channels_last:
+                self.model = self.model.to(memory_format=torch.channels_last)
+            self.torch_compile = config.torch_compile
+            self._compiled = torch.compile(self.model, dynamic=False) if self.torch_compile == 'compile' else None
+            self._traces = {}
+            self.dtype = np.float32
+            self._torch_src = None
             self.rec = [None] * 4
+            self._model_name = os.path.basename(model_path_pth)
+            self.output_ring_size = 2
+        self.resolution = ResolutionPolicy(ring_size=self.output_ring_size)
+        self.set_resolution_policy(downsample_ratio, max_inference_side)
+
+    def set_resolution_policy(self, downsample_ratio=0.25, max_inference_side=None):
+        """downsample_ratio (a number or 'auto') and max_inference_side, see refine.ResolutionPolicy."""
+        self.resolution.set(downsample_ratio, max_inference_side)
+        self.downsample_ratio = self.resolution.downsample_ratio
+        self.max_inference_side = self.resolution.max_inference_side
+        self.model_id = self.resolution.model_id(self._model_name)
+
+    @classmethod
+    def from_onnx(cls, onnx_path, session_config=None, intra_op_threads=None):
+        """Loads one specific ONNX file, e.g. to compare variants."""
+        return cls(None, intra_op_threads=intra_op_threads, onnx_path=onnx_path, session_config=session_config)
+
+    @classmethod
+    def from_torch(cls, checkpoint_path, device='cpu', session_config=None, intra_op_threads=None):
+        """The PyTorch backend even when an ONNX model is available, e.g. to check parity."""
+        return cls(checkpoint_path, device, intra_op_threads=intra_op_threads, session_config=session_config,
+                   use_torch=True)
 
     def reset_states(self):
         if self.use_onnx:
+            # 1x1 zero states broadcast inside the model; the real state
+            # buffers are allocated once the first frame reports their shapes.
             self.rec = {
-                'r1i': np.zeros([1, 16, 1, 1], dtype=np.float32),
-                'r2i': np.zeros([1, 20, 1, 1], dtype=np.float32),
-                'r3i': np.zeros([1, 40, 1, 1], dtype=np.float32),
-                'r4i': np.zeros([1, 64, 1, 1], dtype=np.float32)
+                'r1i': np.zeros([1, 16, 1, 1], dtype=self.dtype),
+                'r2i': np.zeros([1, 20, 1, 1], dtype=self.dtype),
+                'r3i': np.zeros([1, 40, 1, 1], dtype=self.dtype),
+                'r4i': np.zeros([1, 64, 1, 1], dtype=self.dtype)
             }
+            self._rec_bufs = None
         else:
             self.rec = [None] * 4
 
+    def set_output_ring_size(self, size):
+        """Number of process_batch results that may be alive at once."""
+        if size != self.output_ring_size:
+            self.output_ring_size = max(1, size)
+            self._buffers_key = None
+            self.resolution.set_ring_size(self.output_ring_size)
+
+    def _ensure_buffers(self, n, height, width):
+        # Sized for the largest batch seen so a short final batch reuses them
+        key = self._buffers_key
+        if key is not None and key[0] >= n and key[1:] == (height, width, self.output_ring_size):
+            return
+        n = max(n, key[0]) if key is not None and key[1:3] == (height, width) else n
+        self._src = np.empty((n, 3, height, width), dtype=self.dtype)
+        self._fgr_ring = [np.empty((n, 3, height, width), dtype=self.dtype) for _ in range(self.output_ring_size)]
+        self._pha_ring = [np.empty((n, 1, height, width), dtype=self.dtype) for _ in range(self.output_ring_size)]
+        self._ring_pos = 0
+        self._buffers_key = (n, height, width, self.output_ring_size)
+
     def process_batch(self, frames_bgr):
         if not frames_bgr:
             return []
+        return self.resolution.process_batch(frames_bgr, self._run, self.timings)
 
-        # Enforce 3 channels and convert to RGB
-        frames_rgb = []
-        for f in frames_bgr:
-            if f.shape[2] == 4:
-                f = cv2.cvtColor(f, cv2.COLOR_BGRA2BGR)
-            frames_rgb.append(cv2.cvtColor(f, cv2.COLOR_BGR2RGB))
-
+    def _run(self, frames_bgr):
         if self.use_onnx:
-            return self._process_onnx(frames_rgb)
-        else:
-            return self._process_torch(frames_rgb)
-
-    def _process_onnx(self, frames_rgb):
-        results = []
-        downsample_ratio = np.array([0.25], dtype=np.float32)
-        
-        for frame in frames_rgb:
-            # ONNX expects [1, C, H, W]
-            src = np.expand_dims(frame.transpose(2, 0, 1), 0).astype(np.float32) / 255.0
-            
-            inputs = {
-                'src': src,
-                'r1i': self.rec['r1i'],
-                'r2i': self.rec['r2i'],
-                'r3i': self.rec['r3i'],
-                'r4i': self.rec['r4i'],
-                'downsample_ratio': downsample_ratio
-            }
-            
-            fgr, pha, r1o, r2o, r3o, r4o = self.sess.run(None, inputs)
-            
-            self.rec = {'r1i': r1o, 'r2i': r2o, 'r3i': r3o, 'r4i': r4o}
-            
-            # Convert back: pha [1, 1, H, W] -> [H, W], fgr [1, 3, H, W] -> [H, W, 3]
-            alpha = pha[0, 0]
-            foreground = fgr[0].transpose(1, 2, 0)
-            results.append((alpha, foreground))
-            
-        return results
-
-    def _process_torch(self, frames_rgb):
+            return self._process_onnx(frames_bgr)
+        return self._process_torch(frames_bgr)
+
+    def _bind_ptr(self, name, arr, output=False):
+        bind = self.binding.bind_output if output else self.binding.bind_input
+        bind(name, 'cpu', 0, arr.dtype, list(arr.shape), arr.ctypes.data)
+
+    def _process_onnx(self, frames_bgr):
+        n = len(frames_bgr)
+        height, width = frames_bgr[0].shape[:2]
+        self._ensure_buffers(n, height, width)
+        if self._rec_bufs is not None and self._rec_shape_for != (height, width):
+            self.reset_states()
+
+        timings = self.timings
+        if timings is not None:
+            t0 = time.perf_counter()
+
+        # uint8 HWC BGR(A) -> float32 NCHW RGB in [0, 1], written straight
+        # into the bound input buffer: the channel flip and transpose are
+        # strided views, so the only pass over the pixels is this multiply.
+        for i, frame in enumerate(frames_bgr):
+            np.multiply(frame[:, :, 2::-1].transpose(2, 0, 1), np.float32(1 / 255.0),
+                        out=self._src[i], casting='unsafe')
+
+        if timings is not None:
+            t1 = time.perf_counter()
+            timings.add("preprocess", busy=t1 - t0, items=n, start=t0)
+
+        fgr_out = self._fgr_ring[self._ring_pos]
+        pha_out = self._pha_ring[self._ring_pos]
+        self._ring_pos = (self._ring_pos + 1) % self.output_ring_size
+
+        binding = self.binding
+        self._ratio_buf[0] = self.resolution.ratio_for(height, width)
+        binding.bind_cpu_input('downsample_ratio', self._ratio_buf)
+
+        # The recurrent model needs frame t's state before frame t+1, so the
+        # frames run back to back; the state ping-pongs between two buffer
+        # sets that stay bound to the session instead of new dicts per frame.
+        for i in range(n):
+            self._bind_ptr('src', self._src[i:i + 1])
+            self._bind_ptr('fgr', fgr_out[i:i + 1], output=True)
+            self._bind_ptr('pha', pha_out[i:i + 1], output=True)
+
+            if self._rec_bufs is None:
+                # First frame after a reset: let ORT size the state outputs
+                for k in range(1, 5):
+                    binding.bind_cpu_input(f'r{k}i', self.rec[f'r{k}i'])
+                    binding.bind_output(f'r{k}o', 'cpu')
+                self.sess.run_with_iobinding(binding)
+                states = binding.copy_outputs_to_cpu()[2:]
+                front = {f'r{k}i': states[k - 1] for k in range(1, 5)}
+                back = {f'r{k}i': np.empty_like(states[k - 1]) for k in range(1, 5)}
+                self._rec_bufs = [front, back]
+                self._rec_shape_for = (height, width)
+                continue
+
+            rec_in, rec_out = self._rec_bufs
+            for k in range(1, 5):
+                self._bind_ptr(f'r{k}i', rec_in[f'r{k}i'])
+                self._bind_ptr(f'r{k}o', rec_out[f'r{k}i'], output=True)
+            self.sess.run_with_iobinding(binding)
+            self._rec_bufs = [rec_out, rec_in]
+
+        self.rec = self._rec_bufs[0]
+        if timings is not None:
+            t2 = time.perf_counter()
+            timings.add("model_run", busy=t2 - t1, items=n, start=t1)
+
+        # Views into the ring slot: pha [N, 1, H, W] -> [H, W], fgr [N, 3, H, W] -> [H, W, 3]
+        return [(pha_out[i, 0], fgr_out[i].transpose(1, 2, 0)) for i in range(n)]
+
+    def _torch_model(self, src, ratio):
+        """
+        The callable that runs src [1, T, 3, H, W] with the current states:
+        the eager model, or with torch_compile set, a compiled model or a
+        TorchScript trace per (shape, ratio). The first batch of a video,
+        whose states are still None, always runs eagerly.
+        """
+        def eager(src, *rec):
+            return self.model(src, *rec, downsample_ratio=ratio)
+
+        if not self.torch_compile or self.rec[0] is None:
+            return eager
+        if self._compiled is not None:
+            compiled = self._compiled
+
+            def run_compiled(src, *rec):
+                try:
+                    return compiled(src, *rec, downsample_ratio=ratio)
+                except Exception as e:
+                    # torch.compile fails on first use when its toolchain is missing
+                    print(f"torch.compile failed ({e}), running the model eagerly")
+                    self._compiled = None
+                    self.torch_compile = ''
+                    return eager(src, *rec)
+            return run_compiled
+
         import torch
-        batch_tensor = torch.stack([
-            torch.from_numpy(f).permute(2, 0, 1).float().div(255) 
-            for f in frames_rgb
-        ]).to(self.device)
-
-        with torch.no_grad():
-            fgr, pha, *self.rec = self.model(batch_tensor, *self.rec, downsample_ratio=0.25)
-        
-        alphas = pha.squeeze(1).cpu().numpy()
-        foregrounds = fgr.cpu().permute(0, 2, 3, 1).numpy()
-        
+        key = (tuple(src.shape), ratio)
+        traced = self._traces.get(key)
+        if traced is None:
+            if len(self._traces) >= _MAX_TRACES:
+                self._traces.pop(next(iter(self._traces)))
+            try:
+                # Tracing records only tensor inputs, so the ratio is baked in;
+                # strict=False because the model returns a list
+                traced = torch.jit.trace(eager, (src, *self.rec), check_trace=False, strict=False)
+            except Exception as e:
+                print(f"TorchScript tracing failed ({e}), running the model eagerly")
+                traced = eager
+            self._traces[key] = traced
+        return traced
+
+    def _process_torch(self, frames_bgr):
+        """
+        Runs the frames as one sequence, [1, T, 3, H, W], so the recurrent
+        state steps through every frame in order within a single call.
+        """
+        import torch
+        timings = self.timings
+        if timings is not None:
+            t0 = time.perf_counter()
+        n = len(frames_bgr)
+        height, width = frames_bgr[0].shape[:2]
+        if self._torch_src is None or self._torch_src.shape[0] < n or self._torch_src.shape[1:3] != (height, width):
+            self._torch_src = np.empty((n, height, width, 3), dtype=np.float32)
+        buf = self._torch_src[:n]
+        for frame, out in zip(frames_bgr, buf):
+            # BGR(A) -> RGB and scaling in one pass, straight into the buffer
+            np.multiply(frame[:, :, 2::-1], np.float32(1 / 255.0), out=out, casting='unsafe')
+        # The NHWC buffer viewed as NCHW is already channels_last
+        src = torch.from_numpy(buf).permute(0, 3, 1, 2)
+        if not self.channels_last:
+            src = src.contiguous()
+        src = src.to(self.device).unsqueeze(0)
+        if timings is not None:
+            t1 = time.perf_counter()
+            timings.add("preprocess", busy=t1 - t0, items=n, start=t0)
+
+        ratio = self.resolution.ratio_for(height, width)
+        with torch.inference_mode():
+            fgr, pha, *self.rec = self._torch_model(src, ratio)(src, *self.rec)
+            # pha [1, T, 1, H, W] -> [T, H, W], fgr [1, T, 3, H, W] -> [T, H, W, 3]
+            alphas = pha[0, :, 0].cpu().numpy()
+            foregrounds = fgr[0].permute(0, 2, 3, 1).cpu().numpy()
+        if timings is not None:
+            t2 = time.perf_counter()
+            timings.add("model_run", busy=t2 - t1, items=n, start=t1)
+
         return list(zip(alphas, foregrounds))
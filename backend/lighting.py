@@ -0,0 +1,135 @@
+import cv2
+import numpy as np
+
+
+def get_lab_stats(img_lab):
+    """Compute mean and std for each channel in Lab color space."""
+    l, a, b = cv2.split(img_lab)
+    return (l.mean(), l.std()), (a.mean(), a.std()), (b.mean(), b.std())
+
+
+def background_lab_stats(bg_img):
+    bg_lab = cv2.cvtColor(bg_img.astype(np.uint8), cv2.COLOR_BGR2LAB).astype(np.float32)
+    return get_lab_stats(bg_lab)
+
+
+def match_lab_lighting(foreground_bgr, bg_stats, strength=0.5, fg_stats=None):
+    """
+    Matches foreground lighting to background using pre-computed Lab stats.
+    fg_stats defaults to the stats of the whole foreground image.
+    """
+    if strength <= 0:
+        return foreground_bgr
+
+    # Convert to Lab
+    fg_lab = cv2.cvtColor(foreground_bgr.astype(np.uint8), cv2.COLOR_BGR2LAB).astype(np.float32)
+    if fg_stats is None:
+        fg_stats = get_lab_stats(fg_lab)
+
+    res_lab_list = list(cv2.split(fg_lab))
+    for i in range(3):
+        mu_f, sigma_f = fg_stats[i]
+        mu_b, sigma_b = bg_stats[i]
+
+        if sigma_f < 1e-4: sigma_f = 1e-4
+
+        matched_channel = (res_lab_list[i] - mu_f) * (sigma_b / sigma_f) + mu_b
+        res_lab_list[i] = matched_channel * strength + res_lab_list[i] * (1 - strength)
+
+    res_lab = cv2.merge(res_lab_list)
+    res_lab = np.clip(res_lab, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(res_lab, cv2.COLOR_LAB2BGR)
+
+
+class FullFrameLighting:
+    """The original per-frame, full-resolution Lab transfer."""
+
+    def __init__(self, bg_stats, strength):
+        self.bg_stats = bg_stats
+        self.strength = strength
+        self._fg_u8 = None
+
+    def correct(self, alpha, work, scratch):
+        """Corrects the BGR float frame in work in place."""
+        if self._fg_u8 is None or self._fg_u8.shape != work.shape:
+            self._fg_u8 = np.empty(work.shape, dtype=np.uint8)
+        np.multiply(work, 255, out=work)
+        np.copyto(self._fg_u8, work, casting='unsafe')
+        matched = match_lab_lighting(self._fg_u8, self.bg_stats, strength=self.strength)
+        np.multiply(matched, np.float32(1 / 255.0), out=work, casting='unsafe')
+
+
+class LightingMatcher:
+    """
+    Temporally stable lighting match that avoids full-resolution Lab passes.
+
+    Every refresh_interval frames the subject is downsampled to stats_size on
+    its long side and its Lab mean/std are measured with alpha as the weight,
+    so background pixels left in the foreground estimate do not count. The
+    stats are smoothed with an EMA (ema_weight is the share of each new
+    measurement). The exact Lab transfer is run on that small sample only,
+    and a 3x4 BGR affine transform is fitted to it by weighted least squares.
+    Full-resolution frames then get one cv2.transform inside the compositor.
+    """
+
+    def __init__(self, bg_stats, strength, refresh_interval=8, ema_weight=0.3,
+                 stats_size=256, min_coverage=1e-3):
+        self.bg_stats = np.array(bg_stats, dtype=np.float64)
+        self.strength = strength
+        self.refresh_interval = max(1, refresh_interval)
+        self.ema_weight = ema_weight
+        self.stats_size = stats_size
+        self.min_coverage = min_coverage
+
+        self.fg_stats = None
+        self.matrix = np.hstack([np.eye(3), np.zeros((3, 1))]).astype(np.float32)
+        self.frame_index = 0
+        self.refreshes = 0
+
+    def _downsample(self, img):
+        h, w = img.shape[:2]
+        scale = self.stats_size / max(h, w)
+        if scale >= 1:
+            return img
+        return cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+    def _refresh(self, alpha, work):
+        small_alpha = self._downsample(alpha).reshape(-1).astype(np.float64)
+        total = small_alpha.sum()
+        if total < self.min_coverage * small_alpha.size:
+            # Subject lost: keep the last transform instead of fitting noise
+            return
+
+        small_bgr = self._downsample(work)
+        small_u8 = (np.clip(small_bgr, 0, 1) * 255).astype(np.uint8)
+        lab = cv2.cvtColor(small_u8, cv2.COLOR_BGR2LAB).reshape(-1, 3).astype(np.float64)
+
+        w = small_alpha / total
+        mean = w @ lab
+        std = np.sqrt(np.maximum(w @ (lab - mean) ** 2, 0))
+        stats = np.stack([mean, std], axis=1)
+
+        if self.fg_stats is None:
+            self.fg_stats = stats
+        else:
+            self.fg_stats = (1 - self.ema_weight) * self.fg_stats + self.ema_weight * stats
+
+        matched = match_lab_lighting(small_u8, self.bg_stats, self.strength, fg_stats=self.fg_stats)
+
+        x = small_u8.reshape(-1, 3).astype(np.float64) / 255.0
+        y = matched.reshape(-1, 3).astype(np.float64) / 255.0
+        x = np.hstack([x, np.ones((x.shape[0], 1))])
+        sw = np.sqrt(w)[:, np.newaxis]
+        coef, *_ = np.linalg.lstsq(x * sw, y * sw, rcond=None)
+        self.matrix = coef.T.astype(np.float32)
+        self.refreshes += 1
+
+    def correct(self, alpha, work, scratch):
+        """Corrects the BGR float frame in work in place (scratch is clobbered)."""
+        if self.strength <= 0:
+            return
+        if self.frame_index % self.refresh_interval == 0:
+            self._refresh(alpha, work)
+        self.frame_index += 1
+        cv2.transform(work, self.matrix, dst=scratch)
+        np.clip(scratch, 0, 1, out=work)
@@ -0,0 +1,221 @@
+import json
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+
+
+META_FILE = "meta.json"
+_LEN = struct.Struct("<Q")
+
+
+class MatteStore:
+    """
+    On-disk cache of per-frame RVM output, so a video whose matte is known
+    can be re-composited without running the model again.
+
+    Each entry is a directory named by key holding meta.json and chunk files
+    of chunk_frames frames. A frame is stored as 8-bit alpha plus 8-bit RGB
+    foreground, each zlib-compressed; foreground pixels with zero alpha are
+    blanked first since they never reach the composite. Entries are written
+    to a temp directory and renamed into place, so concurrent writers and
+    readers in different processes only ever see complete entries. The
+    store is trimmed to max_bytes by least recent use (meta.json mtime).
+    Readers touch meta.json at every chunk, and entries used within the
+    last busy_seconds are never evicted, so a re-composite in progress in
+    any process keeps its matte.
+    """
+
+    def __init__(self, root_dir, max_bytes=20 * 1024 ** 3, chunk_frames=64, compress_level=1, busy_seconds=120):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.chunk_frames = chunk_frames
+        self.compress_level = compress_level
+        self.busy_seconds = busy_seconds
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root_dir, key)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self._entry_dir(key), META_FILE))
+
+    def open_reader(self, key):
+        """Returns a MatteReader, or None if no complete matte exists."""
+        meta_path = os.path.join(self._entry_dir(key), META_FILE)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return MatteReader(self._entry_dir(key), meta)
+
+    def open_writer(self, key, width, height, fps):
+        tmp_dir = os.path.join(self.root_dir, f".tmp-{key}-{uuid.uuid4().hex}")
+        return MatteWriter(self, key, tmp_dir, width, height, fps)
+
+    def _publish(self, key, tmp_dir):
+        final_dir = self._entry_dir(key)
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            # Another job stored the same matte first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, name)
+            meta_path = os.path.join(path, META_FILE)
+            if name.startswith(".") or not os.path.exists(meta_path):
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(path))
+                entries.append((os.path.getmtime(meta_path), size, path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                # Checked again right before removal: a reader may have just opened it
+                if time.time() - os.path.getmtime(os.path.join(path, META_FILE)) < self.busy_seconds:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        entries = self._entries()
+        return {"entries": len(entries), "bytes": sum(s for _, s, _ in entries), "max_bytes": self.max_bytes}
+
+
+class MatteWriter:
+    """
+    Appends frames from the inference output. Quantization happens in the
+    caller; compression and file I/O run on a background thread.
+    """
+
+    def __init__(self, store, key, tmp_dir, width, height, fps):
+        self.store = store
+        self.key = key
+        self.tmp_dir = tmp_dir
+        self.meta = {"width": width, "height": height, "fps": fps,
+                     "frames": 0, "chunk_frames": store.chunk_frames, "created": time.time()}
+        os.makedirs(tmp_dir)
+        self._queue = queue.Queue(maxsize=32)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="matte-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, alpha, foreground):
+        """alpha [H, W] and foreground [H, W, 3] RGB floats in [0, 1]."""
+        if self._error is not None:
+            return
+        alpha_u8 = np.empty(alpha.shape, dtype=np.uint8)
+        np.copyto(alpha_u8, np.clip(alpha * 255 + 0.5, 0, 255), casting='unsafe')
+        fgr_u8 = np.empty(foreground.shape, dtype=np.uint8)
+        np.copyto(fgr_u8, np.clip(foreground * 255 + 0.5, 0, 255), casting='unsafe')
+        fgr_u8[alpha_u8 == 0] = 0
+        self._queue.put((alpha_u8, fgr_u8))
+
+    def _run(self):
+        chunk = None
+        level = self.store.compress_level
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                index = self.meta["frames"]
+                if index % self.store.chunk_frames == 0:
+                    if chunk:
+                        chunk.close()
+                    chunk = open(os.path.join(self.tmp_dir, f"chunk_{index // self.store.chunk_frames:05d}.bin"), "wb")
+                for arr in item:
+                    data = zlib.compress(arr.data, level)
+                    chunk.write(_LEN.pack(len(data)))
+                    chunk.write(data)
+                self.meta["frames"] = index + 1
+        except Exception as e:
+            self._error = e
+            # Keep draining so add() never blocks on a dead writer
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if chunk:
+                chunk.close()
+
+    def commit(self):
+        """Flushes and publishes the matte; returns False if it failed."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None or self.meta["frames"] == 0:
+            print(f"Matte not stored: {self._error or 'no frames'}")
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            return False
+        # meta.json last: its presence marks a complete entry
+        with open(os.path.join(self.tmp_dir, META_FILE), "w") as f:
+            json.dump(self.meta, f)
+        self.store._publish(self.key, self.tmp_dir)
+        return True
+
+    def abort(self):
+        self._queue.put(None)
+        self._thread.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class MatteReader:
+    """Yields stored frames in order as (alpha uint8 [H, W], foreground uint8 [H, W, 3])."""
+
+    def __init__(self, entry_dir, meta):
+        self.entry_dir = entry_dir
+        self.meta = meta
+        self.width = meta["width"]
+        self.height = meta["height"]
+        self.frames = meta["frames"]
+        self._index = 0
+        self._chunk = None
+
+    def _read_array(self, shape):
+        (size,) = _LEN.unpack(self._chunk.read(_LEN.size))
+        return np.frombuffer(zlib.decompress(self._chunk.read(size)), dtype=np.uint8).reshape(shape)
+
+    def read(self):
+        """Next (alpha, foreground) pair, or None at the end."""
+        if self._index >= self.frames:
+            self.close()
+            return None
+        chunk_frames = self.meta["chunk_frames"]
+        if self._index % chunk_frames == 0:
+            self.close()
+            try:
+                # Marks the entry as in use for MatteStore.evict
+                os.utime(os.path.join(self.entry_dir, META_FILE))
+            except OSError:
+                pass
+            self._chunk = open(os.path.join(self.entry_dir, f"chunk_{self._index // chunk_frames:05d}.bin"), "rb")
+        alpha = self._read_array((self.height, self.width))
+        foreground = self._read_array((self.height, self.width, 3))
+        self._index += 1
+        return alpha, foreground
+
+    def close(self):
+        if self._chunk:
+            self._chunk.close()
+            self._chunk = None
@@ -0,0 +1,81 @@
+import threading
+import time
+import traceback
+
+
+class ModelNotReady(Exception):
+    """Raised by ModelLoader.get() while the model is loading or after it failed to load."""
+
+
+def parse_sizes(text):
+    """'1280x720,1920x1080' -> [(1280, 720), (1920, 1080)]"""
+    sizes = []
+    for part in text.split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        width, height = part.split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+class ModelLoader:
+    """
+    Builds something that holds a model (e.g. a VideoProcessor) on a
+    background thread, so the server takes requests while the model loads
+    and warms up. start() begins loading; get() also starts it if needed
+    and waits up to timeout seconds for the result.
+    """
+
+    def __init__(self, build, name="Model"):
+        self.name = name
+        self._build = build
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+        self._value = None
+        self.error = None
+        self.load_seconds = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+                self._thread.start()
+
+    def _load(self):
+        t0 = time.perf_counter()
+        try:
+            value = self._build()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e)
+        else:
+            self._value = value
+            self.load_seconds = round(time.perf_counter() - t0, 3)
+            print(f"{self.name} ready in {self.load_seconds:.2f}s")
+        finally:
+            self._done.set()
+
+    @property
+    def ready(self):
+        return self._value is not None
+
+    def get(self, timeout=None):
+        self.start()
+        self._done.wait(timeout)
+        if self._value is None:
+            raise ModelNotReady(f"{self.name} failed to load: {self.error}" if self.error
+                                else f"{self.name} is still loading")
+        return self._value
+
+    def status(self):
+        if self._value is not None:
+            state = "ready"
+        elif self.error:
+            state = "failed"
+        elif self._thread is not None:
+            state = "loading"
+        else:
+            state = "idle"
+        return {"state": state, "load_seconds": self.load_seconds, "error": self.error}
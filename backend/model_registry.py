@@ -0,0 +1,415 @@
+"""
+Discovers the RVM ONNX variants in the model directory and builds tuned
+ONNX Runtime sessions for them.
+
+Files are matched by name: rvm_<backbone>[_<precision>].onnx, where the
+backbone is mobilenetv3 or resnet50 and the precision fp32 (the default
+when omitted, e.g. the checked-in rvm_mobilenetv3.onnx), fp16 or int8.
+Jobs ask for a tier and get the first variant of that tier's preference
+list that is present and loads.
+
+    python model_registry.py list
+    python model_registry.py quantize [--calibration-video clip.mp4]
+    python model_registry.py check --candidate rvm_mobilenetv3_int8.onnx --video clip.mp4
+"""
+import argparse
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+
+MODEL_DIR = os.path.join(os.path.dirname(__file__), "model")
+
+_NAME = re.compile(r"^rvm_(mobilenetv3|resnet50)(?:_(fp32|fp16|int8))?\.onnx$")
+
+# Real exports are megabytes; anything tiny is a placeholder or a failed download
+MIN_MODEL_BYTES = 1024
+
+# Tier -> (backbone, precision) in order of preference. fp16 sits last on
+# CPU, where ONNX Runtime mostly runs it through casts to fp32.
+TIERS = {
+    "fast": [("mobilenetv3", "int8"), ("mobilenetv3", "fp32"), ("mobilenetv3", "fp16")],
+    "balanced": [("mobilenetv3", "fp32"), ("mobilenetv3", "int8"), ("mobilenetv3", "fp16")],
+    "quality": [("resnet50", "fp32"), ("resnet50", "fp16"), ("mobilenetv3", "fp32"),
+                ("resnet50", "int8"), ("mobilenetv3", "int8")],
+}
+DEFAULT_TIER = os.environ.get("VEDITOR_MODEL_TIER", "balanced")
+if DEFAULT_TIER not in TIERS:
+    print(f"Unknown VEDITOR_MODEL_TIER {DEFAULT_TIER!r}, expected one of {sorted(TIERS)}; using 'balanced'")
+    DEFAULT_TIER = "balanced"
+
+# onnxruntime is imported where sessions are built, so the API process can
+# read the tiers above without loading it
+_OPT_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+class ModelVariant:
+    def __init__(self, path, backbone, precision):
+        self.path = path
+        self.backbone = backbone
+        self.precision = precision
+        self.name = os.path.basename(path)
+
+    def __repr__(self):
+        return f"ModelVariant({self.name}, {self.backbone}, {self.precision})"
+
+
+class SessionConfig:
+    """
+    ONNX Runtime session settings for a deployment. The defaults leave
+    thread counts to ONNX Runtime; the VEDITOR_ORT_* environment variables
+    override them (see from_env).
+
+    With shared_weights, sessions load an optimized copy of the model whose
+    weights are memory-mapped from a separate file (see
+    ModelRegistry.shared_model_path), so worker processes share them.
+
+    The torch_* settings apply to the PyTorch fallback used when there is
+    no ONNX model: its intra-op thread count, 'compile' (torch.compile) or
+    'trace' (TorchScript) for the model, and channels_last memory format.
+    """
+
+    def __init__(self, intra_op_threads=0, inter_op_threads=0, optimization="all",
+                 mem_arena=True, mem_pattern=True, parallel_execution=False,
+                 shared_weights=False, shared_weights_dir=None,
+                 torch_threads=0, torch_compile="", torch_channels_last=True):
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.optimization = optimization
+        self.mem_arena = mem_arena
+        self.mem_pattern = mem_pattern
+        self.parallel_execution = parallel_execution
+        self.shared_weights = shared_weights
+        self.shared_weights_dir = shared_weights_dir
+        self.torch_threads = torch_threads
+        self.torch_compile = torch_compile
+        self.torch_channels_last = torch_channels_last
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        return cls(
+            intra_op_threads=int(env("VEDITOR_ORT_INTRA_THREADS", 0)),
+            inter_op_threads=int(env("VEDITOR_ORT_INTER_THREADS", 0)),
+            optimization=env("VEDITOR_ORT_OPT_LEVEL", "all"),
+            mem_arena=env("VEDITOR_ORT_MEM_ARENA", "1") != "0",
+            mem_pattern=env("VEDITOR_ORT_MEM_PATTERN", "1") != "0",
+            parallel_execution=env("VEDITOR_ORT_PARALLEL", "0") != "0",
+            shared_weights=env("VEDITOR_SHARED_WEIGHTS", "0") != "0",
+            shared_weights_dir=env("VEDITOR_SHARED_WEIGHTS_DIR"),
+            torch_threads=int(env("VEDITOR_TORCH_THREADS", 0)),
+            torch_compile=env("VEDITOR_TORCH_COMPILE", ""),
+            torch_channels_last=env("VEDITOR_TORCH_CHANNELS_LAST", "1") != "0",
+        )
+
+    def session_options(self, intra_op_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        threads = intra_op_threads or self.intra_op_threads
+        if threads:
+            options.intra_op_num_threads = threads
+        if self.inter_op_threads:
+            options.inter_op_num_threads = self.inter_op_threads
+        level = _OPT_LEVELS.get(self.optimization, _OPT_LEVELS["all"])
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, level)
+        options.enable_cpu_mem_arena = self.mem_arena
+        # The frame size is fixed per job, so planned allocations get reused
+        options.enable_mem_pattern = self.mem_pattern
+        options.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if self.parallel_execution
+                                  else ort.ExecutionMode.ORT_SEQUENTIAL)
+        return options
+
+
+class ModelRegistry:
+    def __init__(self, model_dir=MODEL_DIR, session_config=None):
+        self.model_dir = model_dir
+        self.session_config = session_config or SessionConfig.from_env()
+        self._variants = None
+
+    def variants(self):
+        if self._variants is None:
+            self._variants = self._discover()
+        return self._variants
+
+    def _discover(self):
+        found = []
+        if not os.path.isdir(self.model_dir):
+            return found
+        for name in sorted(os.listdir(self.model_dir)):
+            match = _NAME.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.model_dir, name)
+            if os.path.getsize(path) < MIN_MODEL_BYTES:
+                print(f"Skipping {name}: file is too small to be a model")
+                continue
+            found.append(ModelVariant(path, match.group(1), match.group(2) or "fp32"))
+        return found
+
+    def candidates(self, tier=None):
+        """Variants for a tier, best first; unknown tiers use the default."""
+        by_kind = {}
+        for v in self.variants():
+            # An explicit _fp32 file wins over the unsuffixed one
+            if (v.backbone, v.precision) not in by_kind or v.name.endswith(f"_{v.precision}.onnx"):
+                by_kind[(v.backbone, v.precision)] = v
+        order = TIERS.get(tier) or TIERS[DEFAULT_TIER]
+        return [by_kind[kind] for kind in order if kind in by_kind]
+
+    def create_session(self, tier=None, intra_op_threads=None):
+        """Returns (variant, session) for the tier, or (None, None) if no variant loads."""
+        import onnxruntime as ort
+
+        for variant in self.candidates(tier):
+            path = self.shared_model_path(variant) if self.session_config.shared_weights else variant.path
+            try:
+                sess = ort.InferenceSession(path,
+                                            sess_options=self.session_config.session_options(intra_op_threads),
+                                            providers=['CPUExecutionProvider'])
+                return variant, sess
+            except Exception as e:
+                print(f"Could not load {variant.name}: {e}")
+        return None, None
+
+    def shared_model_path(self, variant):
+        """
+        Path of an optimized copy of variant with its weights in a file of
+        their own. ONNX Runtime memory-maps that file instead of reading the
+        weights onto each process's heap, so all workers loading the copy
+        share one set of pages, and skip graph optimization at load. The
+        copy is written once per model file, ONNX Runtime version and
+        optimization level (it may contain CPU-specific layouts, so keep
+        the directory local to the machine). Returns variant.path if the
+        copy cannot be written.
+        """
+        import onnxruntime as ort
+
+        cfg = self.session_config
+        st = os.stat(variant.path)
+        tag = (f"{os.path.splitext(variant.name)[0]}-{st.st_size}-{int(st.st_mtime)}"
+               f"-ort{ort.__version__}-{cfg.optimization}")
+        base = cfg.shared_weights_dir or os.path.join(self.model_dir, "shared")
+        target = os.path.join(base, tag)
+        model_file = os.path.join(target, "model.onnx")
+        if os.path.exists(model_file):
+            return model_file
+
+        tmp = os.path.join(base, f".tmp-{tag}-{os.getpid()}")
+        try:
+            os.makedirs(tmp, exist_ok=True)
+            options = cfg.session_options()
+            options.optimized_model_filepath = os.path.join(tmp, "model.onnx")
+            options.add_session_config_entry("session.optimized_model_external_initializers_file_name", "weights.bin")
+            options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+            ort.InferenceSession(variant.path, sess_options=options, providers=['CPUExecutionProvider'])
+            # Publish the whole directory at once; another process may have won
+            os.rename(tmp, target)
+        except Exception as e:
+            if not os.path.exists(model_file):
+                print(f"Could not write shared-weights copy of {variant.name}: {e}")
+                return variant.path
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        print(f"Wrote shared-weights copy of {variant.name} to {target}")
+        return model_file
+
+
+def quantize_int8(src_path, dst_path, calibration_video=None, calibration_frames=32):
+    """
+    Writes an INT8 copy of an fp32 model. Without a calibration video the
+    weights are quantized dynamically; with one, activations are calibrated
+    on its frames (static QDQ), which is usually faster on CPU.
+    """
+    from onnxruntime import quantization as q
+
+    if not calibration_video:
+        q.quantize_dynamic(src_path, dst_path, weight_type=q.QuantType.QInt8)
+        return dst_path
+
+    class VideoCalibration(q.CalibrationDataReader):
+        # Feeds real frames with the recurrent state the fp32 model produces
+        def __init__(self):
+            self.inputs = iter(_recorded_inputs(src_path, calibration_video, calibration_frames))
+
+        def get_next(self):
+            return next(self.inputs, None)
+
+    q.quantize_static(src_path, dst_path, VideoCalibration(), quant_format=q.QuantFormat.QDQ,
+                      activation_type=q.QuantType.QUInt8, weight_type=q.QuantType.QInt8,
+                      op_types_to_quantize=["Conv", "MatMul", "Gemm"])
+    return dst_path
+
+
+def _read_frames(video_path, count):
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise Exception(f"Could not read frames from {video_path}")
+    return frames
+
+
+def _recorded_inputs(model_path, video_path, count):
+    import onnxruntime as ort
+
+    sess = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    rec = [np.zeros([1, c, 1, 1], dtype=np.float32) for c in (16, 20, 40, 64)]
+    ratio = np.array([0.25], dtype=np.float32)
+    recorded = []
+    for frame in _read_frames(video_path, count):
+        src = (frame[:, :, ::-1].transpose(2, 0, 1)[np.newaxis] / np.float32(255)).astype(np.float32)
+        feed = {'src': src, 'r1i': rec[0], 'r2i': rec[1], 'r3i': rec[2], 'r4i': rec[3], 'downsample_ratio': ratio}
+        recorded.append(feed)
+        rec = sess.run(None, feed)[2:]
+    return recorded
+
+
+def compare_variants(reference_path, candidate_path, video_path, frames=60, session_config=None):
+    """
+    Runs both models over the same frames through RVMInference and reports
+    the candidate's alpha error against the reference and the speed of each.
+    """
+    from inference import RVMInference
+
+    clip = _read_frames(video_path, frames)
+    results = {}
+    alphas = {}
+    for label, path in (("reference", reference_path), ("candidate", candidate_path)):
+        engine = RVMInference.from_onnx(path, session_config=session_config)
+        engine.set_output_ring_size(1)
+        start = time.perf_counter()
+        out = []
+        for i in range(0, len(clip), 4):
+            out.extend(np.array(a, dtype=np.float32) for a, _ in engine.process_batch(clip[i:i + 4]))
+        seconds = time.perf_counter() - start
+        alphas[label] = out
+        results[label] = {"model": os.path.basename(path), "fps": round(len(clip) / seconds, 2)}
+
+    errors = [np.abs(a - b) for a, b in zip(alphas["reference"], alphas["candidate"])]
+    results["alpha_mae"] = round(float(np.mean([e.mean() for e in errors])), 5)
+    results["alpha_max_error"] = round(float(max(e.max() for e in errors)), 5)
+    # Share of pixels whose 8-bit alpha would change
+    results["alpha_changed_8bit"] = round(float(np.mean([(e * 255 >= 0.5).mean() for e in errors])), 5)
+    results["speedup"] = round(results["candidate"]["fps"] / results["reference"]["fps"], 3)
+    return results
+
+
+def compare_torch_onnx(checkpoint_path, onnx_path, video_path, frames=60, batch_size=4, session_config=None):
+    """
+    Parity of the PyTorch backend with ONNX: the ONNX model runs the clip
+    one frame per call, the PyTorch model in batch_size-frame sequences.
+    Reports the alpha error of PyTorch against ONNX and the error between
+    PyTorch sequences and PyTorch one frame at a time. The latter should
+    be at float rounding level, which shows the recurrent state steps once
+    per frame inside a sequence. Also reports the speed of each run.
+    """
+    from inference import RVMInference
+
+    clip = _read_frames(video_path, frames)
+    runs = (
+        ("onnx", lambda: RVMInference.from_onnx(onnx_path, session_config=session_config), 1),
+        ("torch_frames", lambda: RVMInference.from_torch(checkpoint_path, session_config=session_config), 1),
+        ("torch_sequence", lambda: RVMInference.from_torch(checkpoint_path, session_config=session_config),
+         batch_size),
+    )
+    results = {}
+    alphas = {}
+    for label, load, step in runs:
+        engine = load()
+        engine.set_output_ring_size(1)
+        start = time.perf_counter()
+        out = []
+        for i in range(0, len(clip), step):
+            out.extend(np.array(a, dtype=np.float32) for a, _ in engine.process_batch(clip[i:i + step]))
+        seconds = time.perf_counter() - start
+        alphas[label] = out
+        results[label] = {"fps": round(len(clip) / seconds, 2)}
+
+    errors = [np.abs(a - b) for a, b in zip(alphas["onnx"], alphas["torch_sequence"])]
+    results["alpha_mae"] = round(float(np.mean([e.mean() for e in errors])), 6)
+    results["alpha_max_error"] = round(float(max(e.max() for e in errors)), 6)
+    sequence = [np.abs(a - b).max() for a, b in zip(alphas["torch_frames"], alphas["torch_sequence"])]
+    results["sequence_max_error"] = round(float(max(sequence)), 6)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RVM model variants")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list")
+    quant = sub.add_parser("quantize", help="write rvm_<backbone>_int8.onnx from the fp32 model")
+    quant.add_argument("--backbone", default="mobilenetv3", choices=["mobilenetv3", "resnet50"])
+    quant.add_argument("--calibration-video")
+    quant.add_argument("--calibration-frames", type=int, default=32)
+    check = sub.add_parser("check", help="accuracy and speed of a variant against fp32")
+    check.add_argument("--candidate", required=True)
+    check.add_argument("--reference")
+    check.add_argument("--video", required=True)
+    check.add_argument("--frames", type=int, default=60)
+    check_torch = sub.add_parser("check-torch", help="parity of the PyTorch backend with frame-by-frame ONNX")
+    check_torch.add_argument("--checkpoint", required=True)
+    check_torch.add_argument("--onnx")
+    check_torch.add_argument("--video", required=True)
+    check_torch.add_argument("--frames", type=int, default=60)
+    check_torch.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.model_dir)
+    if args.command == "list":
+        for v in registry.variants():
+            print(f"{v.name:<32} {v.backbone:<12} {v.precision}")
+        for tier in TIERS:
+            best = registry.candidates(tier)
+            print(f"tier {tier:<9} -> {best[0].name if best else 'none (PyTorch fallback)'}")
+    elif args.command == "quantize":
+        fp32 = [v for v in registry.variants() if v.backbone == args.backbone and v.precision == "fp32"]
+        if not fp32:
+            raise SystemExit(f"No fp32 {args.backbone} model in {args.model_dir}")
+        dst = os.path.join(args.model_dir, f"rvm_{args.backbone}_int8.onnx")
+        quantize_int8(fp32[-1].path, dst, args.calibration_video, args.calibration_frames)
+        print(f"Wrote {dst}")
+    elif args.command == "check-torch":
+        onnx_path = args.onnx
+        if not onnx_path:
+            fp32 = [v for v in registry.variants() if v.backbone == "mobilenetv3" and v.precision == "fp32"]
+            if not fp32:
+                raise SystemExit("No fp32 mobilenetv3 ONNX model to compare with")
+            onnx_path = fp32[-1].path
+        results = compare_torch_onnx(args.checkpoint, onnx_path, args.video, args.frames, args.batch_size)
+        for key, value in results.items():
+            print(f"{key:<20} {value}")
+    else:
+        candidate = args.candidate if os.path.exists(args.candidate) else os.path.join(args.model_dir, args.candidate)
+        reference = args.reference
+        if not reference:
+            # Errors only mean something against the same network at fp32
+            match = _NAME.match(os.path.basename(candidate))
+            if not match:
+                raise SystemExit(f"Cannot tell the backbone of {args.candidate}, pass --reference")
+            fp32 = [v for v in registry.variants() if v.backbone == match.group(1) and v.precision == "fp32"]
+            if not fp32:
+                raise SystemExit(f"No fp32 {match.group(1)} model to compare with")
+            reference = fp32[-1].path
+        for key, value in compare_variants(reference, candidate, args.video, args.frames).items():
+            print(f"{key:<20} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import json
+import queue
+import threading
+import time
+
+
+# Marks the end of the stream on every queue
+_END = object()
+
+
+class PipelineConfig:
+    """Queue depths, decoder and timing options for the staged pipeline."""
+
+    def __init__(self, batch_size=4, decode_queue_size=4, inference_queue_size=4,
+                 encode_queue_size=16, collect_timings=True, report_timings=True, decoder='opencv'):
+        self.batch_size = batch_size
+        # decode_queue_size and inference_queue_size are counted in batches,
+        # encode_queue_size in frames
+        self.decode_queue_size = decode_queue_size
+        self.inference_queue_size = inference_queue_size
+        self.encode_queue_size = encode_queue_size
+        self.collect_timings = collect_timings
+        self.report_timings = report_timings
+        # 'opencv' or 'ffmpeg' (a rawvideo pipe, see decoder.py)
+        self.decoder = decoder
+
+
+class StageTimings:
+    """
+    Accumulates busy and wait time for each stage of a job. With trace=True
+    every timed span (given its start) is also kept, for write_trace().
+    """
+
+    def __init__(self, enabled=True, trace=False):
+        self.enabled = enabled
+        self.trace = enabled and trace
+        self._lock = threading.Lock()
+        self.busy = {}
+        self.wait = {}
+        self.items = {}
+        self.events = []
+        self._origin = time.perf_counter()
+
+    def add(self, stage, busy=0.0, wait=0.0, items=0, start=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.busy[stage] = self.busy.get(stage, 0.0) + busy
+            self.wait[stage] = self.wait.get(stage, 0.0) + wait
+            self.items[stage] = self.items.get(stage, 0) + items
+            if self.trace and start is not None:
+                self.events.append((stage, start, busy, threading.current_thread().name))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                stage: {
+                    "busy_s": round(self.busy[stage], 4),
+                    "wait_s": round(self.wait.get(stage, 0.0), 4),
+                    "items": self.items.get(stage, 0),
+                }
+                for stage in self.busy
+            }
+
+    def report(self):
+        for stage, t in self.as_dict().items():
+            print(f"  {stage:<10} busy {t['busy_s']:8.2f}s  wait {t['wait_s']:8.2f}s  items {t['items']}")
+
+    def write_trace(self, path, metadata=None):
+        """Writes the spans in Chrome trace format (chrome://tracing, Perfetto)."""
+        with self._lock:
+            events = [
+                {"name": stage, "ph": "X", "pid": 1, "tid": thread,
+                 "ts": round((start - self._origin) * 1e6, 1), "dur": round(busy * 1e6, 1)}
+                for stage, start, busy, thread in self.events
+            ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "metadata": metadata or {}, "stages": self.as_dict()}, f)
+
+
+class StagedPipeline:
+    """
+    Runs decode -> inference -> composite -> encode in four threads joined by
+    bounded queues. Each stage has exactly one worker, so frame order and the
+    recurrent state of the model are preserved. OpenCV, NumPy and ONNX Runtime
+    release the GIL in their kernels, which lets the stages overlap.
+
+    Stage callables:
+      read_frame()                -> frame or None at end of stream
+      infer_batch(frames)         -> list of (alpha, foreground)
+      composite(alpha, fgr)       -> final BGR frame
+      write(frame)                -> None
+    """
+
+    def __init__(self, config=None, timings=None):
+        self.config = config or PipelineConfig()
+        self.timings = timings or StageTimings(self.config.collect_timings)
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, q, item):
+        # Poll so a failing downstream stage cannot leave us blocked forever
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _fail(self, exc):
+        if self._error is None:
+            self._error = exc
+        self._stop.set()
+
+    def _decode(self, read_frame, out_q):
+        try:
+            batch = []
+            while True:
+                t0 = time.perf_counter()
+                frame = read_frame()
+                self.timings.add("decode", busy=time.perf_counter() - t0, items=0 if frame is None else 1, start=t0)
+                if frame is None:
+                    break
+                batch.append(frame)
+                if len(batch) == self.config.batch_size:
+                    t0 = time.perf_counter()
+                    if not self._put(out_q, batch):
+                        return
+                    self.timings.add("decode", wait=time.perf_counter() - t0)
+                    batch = []
+            if batch:
+                self._put(out_q, batch)
+            self._put(out_q, _END)
+        except Exception as e:
+            self._fail(e)
+
+    def _infer(self, infer_batch, in_q, out_q):
+        try:
+            while True:
+                t0 = time.perf_counter()
+                batch = self._get(in_q)
+                t1 = time.perf_counter()
+                if batch is _END:
+                    break
+                results = infer_batch(batch)
+                t2 = time.perf_counter()
+                if not self._put(out_q, results):
+                    return
+                self.timings.add("inference", busy=t2 - t1,
+                                 wait=(t1 - t0) + (time.perf_counter() - t2), items=len(batch), start=t1)
+            self._put(out_q, _END)
+        except Exception as e:
+            self._fail(e)
+
+    def _composite(self, composite, in_q, out_q):
+        try:
+            while True:
+                t0 = time.perf_counter()
+                results = self._get(in_q)
+                wait = time.perf_counter() - t0
+                if results is _END:
+                    break
+                for alpha, foreground in results:
+                    t1 = time.perf_counter()
+                    try:
+                        frame = composite(alpha, foreground)
+                    except Exception as e:
+                        # Same policy as the serial loop: skip the bad frame
+                        print(f"Error writing frame: {e}")
+                        frame = None
+                    t2 = time.perf_counter()
+                    if not self._put(out_q, frame):
+                        return
+                    self.timings.add("composite", busy=t2 - t1, wait=wait + (time.perf_counter() - t2), items=1, start=t1)
+                    wait = 0.0
+            self._put(out_q, _END)
+        except Exception as e:
+            self._fail(e)
+
+    def _encode(self, write, in_q, on_frame):
+        try:
+            while True:
+                t0 = time.perf_counter()
+                frame = self._get(in_q)
+                t1 = time.perf_counter()
+                if frame is _END:
+                    break
+                written = False
+                if frame is not None:
+                    write(frame)
+                    written = True
+                self.timings.add("encode", busy=time.perf_counter() - t1, wait=t1 - t0, items=1, start=t1)
+                if on_frame:
+                    on_frame(written)
+        except Exception as e:
+            self._fail(e)
+
+    def run(self, read_frame, infer_batch, composite, write, on_frame=None):
+        """
+        Runs the pipeline to completion. on_frame(written) is called from the
+        encode thread once per frame, in order. Re-raises the first stage error.
+        """
+        cfg = self.config
+        decoded_q = queue.Queue(maxsize=max(1, cfg.decode_queue_size))
+        inferred_q = queue.Queue(maxsize=max(1, cfg.inference_queue_size))
+        composited_q = queue.Queue(maxsize=max(1, cfg.encode_queue_size))
+
+        threads = [
+            threading.Thread(target=self._decode, args=(read_frame, decoded_q), name="pipeline-decode", daemon=True),
+            threading.Thread(target=self._infer, args=(infer_batch, decoded_q, inferred_q), name="pipeline-inference", daemon=True),
+            threading.Thread(target=self._composite, args=(composite, inferred_q, composited_q), name="pipeline-composite", daemon=True),
+            threading.Thread(target=self._encode, args=(write, composited_q, on_frame), name="pipeline-encode", daemon=True),
+        ]
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        if self._error is not None:
+            raise self._error
+
+        if cfg.collect_timings and cfg.report_timings:
+            frames = self.timings.items.get("encode", 0)
+            fps = frames / elapsed if elapsed > 0 else 0.0
+            print(f"Pipeline finished: {frames} frames in {elapsed:.2f}s ({fps:.2f} fps)")
+            self.timings.report()
+
+        return self.timings.as_dict()
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import cv2
+
+from compositor import Compositor
+
+
+class PreviewSession:
+    """
+    An uploaded video kept around for interactive previews.
+
+    Mattes are cached per frame index, and prepared backgrounds come from
+    the processor's shared background cache, so changing only color, blur
+    or lighting re-composites without touching the model.
+    """
+
+    def __init__(self, session_id, video_path, max_mattes=8):
+        self.session_id = session_id
+        self.video_path = video_path
+        self.max_mattes = max_mattes
+        self.last_access = time.time()
+        self.lock = threading.Lock()
+        self._mattes = OrderedDict()
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            raise Exception(f"Could not open video {video_path}")
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        self.frame_count = max(1, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        cap.release()
+
+    def info(self):
+        return {
+            "session_id": self.session_id,
+            "width": self.width,
+            "height": self.height,
+            "fps": self.fps,
+            "frame_count": self.frame_count,
+            "duration": self.frame_count / self.fps,
+        }
+
+    def frame_index(self, timestamp):
+        return min(self.frame_count - 1, max(0, int(round(timestamp * self.fps))))
+
+    def _cached(self, cache, key, limit, build):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = build()
+        cache[key] = value
+        while len(cache) > limit:
+            cache.popitem(last=False)
+        return value
+
+    def render(self, processor, timestamp, background_path=None, background_color=(0, 255, 0),
+               blur_radius=0, lighting_strength=0.0, warmup_frames=8):
+        """Composites the frame at timestamp (seconds); returns (frame_index, BGR image)."""
+        with self.lock:
+            self.last_access = time.time()
+            index = self.frame_index(timestamp)
+            _, alpha, foreground = self._cached(
+                self._mattes, index, self.max_mattes,
+                lambda: processor.matte_at(self.video_path, index, warmup_frames))
+
+            background = processor.prepare_background(background_path, background_color, blur_radius,
+                                                      self.width, self.height)
+
+            lighting = processor._make_lighting(background, lighting_strength, 'fast', refresh_interval=1)
+            return index, Compositor(background.image, lighting, bg_f=background.image_f).composite(alpha, foreground)
+
+    def close(self):
+        with self.lock:
+            self._mattes.clear()
+            if os.path.exists(self.video_path):
+                os.remove(self.video_path)
+
+
+class PreviewSessionManager:
+    """Creates, looks up and expires preview sessions (idle for ttl_seconds)."""
+
+    def __init__(self, upload_dir, ttl_seconds=1800, max_sessions=32):
+        self.upload_dir = upload_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def new_video_path(self, filename):
+        session_id = str(uuid.uuid4())
+        return session_id, os.path.join(self.upload_dir, f"preview_{session_id}_{os.path.basename(filename)}")
+
+    def create(self, session_id, video_path):
+        session = PreviewSession(session_id, video_path)
+        with self._lock:
+            self._sessions[session_id] = session
+            evicted = self._expire_locked()
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            evicted = self._expire_locked()
+            session = self._sessions.get(session_id)
+            if session:
+                session.last_access = time.time()
+                self._sessions.move_to_end(session_id)
+        for old in evicted:
+            old.close()
+        return session
+
+    def delete(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session:
+            session.close()
+        return session is not None
+
+    def _expire_locked(self):
+        now = time.time()
+        expired = [sid for sid, s in self._sessions.items() if now - s.last_access > self.ttl_seconds]
+        return [self._sessions.pop(sid) for sid in expired]
+
+    def cleanup(self):
+        with self._lock:
+            evicted = self._expire_locked()
+        for old in evicted:
+            old.close()
+        return len(evicted)
@@ -0,0 +1,49 @@
+import time
+
+
+class JobCancelled(Exception):
+    """Raised inside process_video when the job's cancel event is set."""
+
+
+def check_cancelled(cancel_event):
+    """Raises JobCancelled if cancel_event (anything with is_set()) is set."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled("Job was cancelled")
+
+
+class ProgressReporter:
+    """
+    Wraps a progress callback for processing code that reports every frame.
+    Calls are passed on to callback(current, total) at most once every
+    min_interval seconds, and only once progress has moved by min_step
+    percent since the last update; the first and last frames always go out.
+
+    Keeps a smoothed frame rate over the updates passed on, so the callback
+    can read fps and eta_seconds (None until there is a rate).
+    """
+
+    def __init__(self, callback, min_interval=0.5, min_step=1.0, smoothing=0.3):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.min_step = min_step
+        self.smoothing = smoothing
+        self.fps = None
+        self.eta_seconds = None
+        self._sent = None
+
+    def __call__(self, current, total):
+        now = time.perf_counter()
+        percent = current * 100.0 / total if total else 100.0
+        if self._sent is not None and current < total:
+            sent_time, sent_current, sent_percent = self._sent
+            if now - sent_time < self.min_interval or percent - sent_percent < self.min_step:
+                return
+        if self._sent is not None:
+            sent_time, sent_current, _ = self._sent
+            if now > sent_time and current > sent_current:
+                rate = (current - sent_current) / (now - sent_time)
+                self.fps = rate if self.fps is None else self.fps + self.smoothing * (rate - self.fps)
+        if self.fps:
+            self.eta_seconds = max(0, total - current) / self.fps
+        self._sent = (now, current, percent)
+        self.callback(current, total)
@@ -0,0 +1,87 @@
+import mimetypes
+import os
+from email.utils import formatdate
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+
+# Read size for ranged responses
+CHUNK_SIZE = 256 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    (start, end), inclusive, for a single 'bytes=' range of a file of size
+    bytes, or None when the whole file should be sent: no header, a unit
+    other than bytes, or several ranges, which servers may answer with the
+    full file. Raises RangeNotSatisfiable if the range lies past the end.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                raise RangeNotSatisfiable()
+            start, end = max(0, size - length), size - 1
+    except ValueError:
+        return None
+    if start > end:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def _iter_file(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_response(path, range_header=None, if_range=None, media_type=None, headers=None):
+    """
+    Serves path whole or, for a Range request, as a 206 partial response,
+    so interrupted downloads can resume and players can seek. The ETag and
+    Last-Modified sent let clients use If-Range; a range whose If-Range no
+    longer matches the file gets the whole file.
+    """
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = dict(headers or {}, **{"Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": last_modified})
+
+    if if_range and if_range not in (etag, last_modified):
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, stat.st_size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}", **headers})
+    if byte_range is None:
+        return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+    start, end = byte_range
+    length = end - start + 1
+    headers.update({"Content-Range": f"bytes {start}-{end}/{stat.st_size}", "Content-Length": str(length)})
+    return StreamingResponse(_iter_file(path, start, length), status_code=206,
+                             media_type=media_type or mimetypes.guess_type(path)[0] or "application/octet-stream",
+                             headers=headers)
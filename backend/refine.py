@@ -0,0 +1,168 @@
+import time
+
+import cv2
+import numpy as np
+
+
+# RVM's recommended downsample_ratio keeps the base network near this many
+# pixels on the long side (0.25 at 1080p, 0.125 at 4K, 1 up to 512px)
+RVM_TARGET_SIDE = 512
+
+
+def auto_downsample_ratio(height, width, target_side=RVM_TARGET_SIDE):
+    """downsample_ratio for a frame size, following RVM's guidance table."""
+    ratio = min(1.0, target_side / max(height, width))
+    # Coarse steps keep model_id (and so cached mattes) stable across near sizes
+    return max(0.0625, round(ratio * 16) / 16) if ratio < 1.0 else 1.0
+
+
+def inference_size(height, width, max_side):
+    """(height, width) to feed the model under a long-side cap, or None if no cap applies."""
+    if not max_side or max(height, width) <= max_side:
+        return None
+    scale = max_side / max(height, width)
+    # Even dimensions keep the model's internal down/upsampling aligned
+    return max(2, int(height * scale) // 2 * 2), max(2, int(width * scale) // 2 * 2)
+
+
+class GuidedUpsampler:
+    """
+    Brings low-resolution RVM output back to the frame size.
+
+    Alpha uses a fast guided filter (He & Sun, 2015): the local linear model
+    between the low-resolution luma and alpha is fitted at low resolution,
+    upsampled, and applied to the full-resolution luma, so matte edges
+    follow the real image edges instead of being blurred by interpolation.
+    The foreground is upsampled as a residual on top of the full-resolution
+    frame, which keeps its detail. Scratch buffers are reused per size.
+    """
+
+    def __init__(self, radius=2, eps=1e-4):
+        self.radius = radius
+        self.eps = eps
+        self._key = None
+
+    def _ensure(self, low, high):
+        if self._key == (low, high):
+            return
+        self._gray_hr = np.empty(high, dtype=np.float32)
+        self._a_hr = np.empty(high, dtype=np.float32)
+        self._b_hr = np.empty(high, dtype=np.float32)
+        self._residual_hr = np.empty(high + (3,), dtype=np.float32)
+        self._rgb_hr = np.empty(high + (3,), dtype=np.uint8)
+        self._key = (low, high)
+
+    def _box(self, x):
+        k = 2 * self.radius + 1
+        return cv2.boxFilter(x, -1, (k, k), borderType=cv2.BORDER_REFLECT)
+
+    def upsample(self, alpha_lr, fgr_lr, frame_lr, frame_hr, alpha_out, fgr_out):
+        """
+        alpha_lr [h, w], fgr_lr [h, w, 3] RGB floats; frame_lr / frame_hr the
+        BGR uint8 frames at both sizes. Writes alpha_out [H, W] and
+        fgr_out [H, W, 3] RGB.
+        """
+        high = frame_hr.shape[:2]
+        self._ensure(frame_lr.shape[:2], high)
+        size = (high[1], high[0])
+
+        gray_lr = cv2.cvtColor(frame_lr, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+        p = alpha_lr.astype(np.float32, copy=False)
+        mean_i = self._box(gray_lr)
+        mean_p = self._box(p)
+        cov_ip = self._box(gray_lr * p) - mean_i * mean_p
+        var_i = self._box(gray_lr * gray_lr) - mean_i * mean_i
+        a = cov_ip / (var_i + self.eps)
+        b = mean_p - a * mean_i
+        cv2.resize(self._box(a), size, dst=self._a_hr, interpolation=cv2.INTER_LINEAR)
+        cv2.resize(self._box(b), size, dst=self._b_hr, interpolation=cv2.INTER_LINEAR)
+
+        gray_hr = self._gray_hr
+        gray_hr[...] = cv2.cvtColor(frame_hr, cv2.COLOR_BGR2GRAY)
+        cv2.multiply(self._a_hr, gray_hr, dst=alpha_out, scale=1 / 255.0)
+        cv2.add(alpha_out, self._b_hr, dst=alpha_out)
+        np.clip(alpha_out, 0, 1, out=alpha_out)
+
+        # fgr_hr = frame_hr + up(fgr_lr - frame_lr), all RGB in [0, 1]; the
+        # channel flips go through cvtColor, much faster than strided views
+        rgb_lr = cv2.cvtColor(frame_lr, cv2.COLOR_BGR2RGB)
+        residual_lr = cv2.scaleAdd(rgb_lr.astype(np.float32), -1 / 255.0, fgr_lr.astype(np.float32))
+        cv2.resize(residual_lr, size, dst=self._residual_hr, interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(frame_hr, cv2.COLOR_BGR2RGB, dst=self._rgb_hr)
+        fgr_out[...] = self._rgb_hr
+        cv2.scaleAdd(fgr_out, 1 / 255.0, self._residual_hr, dst=fgr_out)
+
+
+class ResolutionPolicy:
+    """
+    The resolution settings of an inference engine and the capped runs that
+    go with them. downsample_ratio is a number or 'auto' (picked per frame
+    size, see auto_downsample_ratio). With max_inference_side, larger
+    frames are run at that long side and the output is brought back to full
+    size by GuidedUpsampler, into a ring with one slot per frame of every
+    batch that may still be alive (ring_size batches).
+    """
+
+    def __init__(self, downsample_ratio=0.25, max_inference_side=None, ring_size=2):
+        self.upsampler = GuidedUpsampler()
+        self.ring_size = ring_size
+        self._hr_key = None
+        self.set(downsample_ratio, max_inference_side)
+
+    def set(self, downsample_ratio=0.25, max_inference_side=None):
+        self.downsample_ratio = downsample_ratio if downsample_ratio == 'auto' else float(downsample_ratio)
+        self.max_inference_side = int(max_inference_side) if max_inference_side else None
+
+    def model_id(self, model_name):
+        """Identifies the model and settings for anything cached from its output."""
+        model_id = f"{model_name}@{self.downsample_ratio}"
+        if self.max_inference_side:
+            model_id += f"/max{self.max_inference_side}"
+        return model_id
+
+    def ratio_for(self, height, width):
+        if self.downsample_ratio == 'auto':
+            return auto_downsample_ratio(height, width)
+        return self.downsample_ratio
+
+    def set_ring_size(self, size):
+        if size != self.ring_size:
+            self.ring_size = max(1, size)
+            self._hr_key = None
+
+    def _ensure_buffers(self, n, height, width):
+        slots = n * self.ring_size
+        key = self._hr_key
+        if key is not None and key[:2] == (height, width) and key[2] >= slots:
+            return
+        self._hr_pha = [np.empty((height, width), dtype=np.float32) for _ in range(slots)]
+        self._hr_fgr = [np.empty((height, width, 3), dtype=np.float32) for _ in range(slots)]
+        self._hr_pos = 0
+        self._hr_key = (height, width, slots)
+
+    def process_batch(self, frames_bgr, run, timings=None):
+        """
+        run(frames) -> [(alpha, fgr)] at the frames' size; called with
+        frames_bgr, or with them downscaled under max_inference_side and the
+        output upsampled back.
+        """
+        height, width = frames_bgr[0].shape[:2]
+        small = inference_size(height, width, self.max_inference_side)
+        if small is None:
+            return run(frames_bgr)
+
+        frames_lr = [cv2.resize(f, (small[1], small[0]), interpolation=cv2.INTER_AREA) for f in frames_bgr]
+        results = run(frames_lr)
+        if timings is not None:
+            t0 = time.perf_counter()
+        self._ensure_buffers(len(frames_bgr), height, width)
+        upsampled = []
+        for (alpha, fgr), frame_lr, frame in zip(results, frames_lr, frames_bgr):
+            alpha_hr = self._hr_pha[self._hr_pos]
+            fgr_hr = self._hr_fgr[self._hr_pos]
+            self._hr_pos = (self._hr_pos + 1) % len(self._hr_pha)
+            self.upsampler.upsample(alpha, fgr, frame_lr, frame, alpha_hr, fgr_hr)
+            upsampled.append((alpha_hr, fgr_hr))
+        if timings is not None:
+            timings.add("upsample", busy=time.perf_counter() - t0, items=len(frames_bgr), start=t0)
+        return upsampled
@@ -0,0 +1,204 @@
+from collections import deque
+
+import numpy as np
+
+
+class SubjectROIConfig:
+    """Settings for cropping inference to the region around the subject."""
+
+    def __init__(self, padding=0.15, alpha_threshold=0.1, smoothing=0.7, max_area=0.7,
+                 max_changes=6, change_window=60, cooldown=60, align=16):
+        # Margin around the subject box, as a fraction of its size per side
+        self.padding = padding
+        # Alpha above this counts as subject when measuring the box
+        self.alpha_threshold = alpha_threshold
+        # EMA weight of the previous box when the subject shrinks (growth is immediate)
+        self.smoothing = smoothing
+        # Crops covering more of the frame than this are not worth it
+        self.max_area = max_area
+        # More than max_changes crop changes within change_window frames
+        # means the box is unstable: run full frames for cooldown frames
+        self.max_changes = max_changes
+        self.change_window = change_window
+        self.cooldown = cooldown
+        # Crop edges snap to this grid so small motions keep the same crop
+        self.align = align
+
+    def key(self):
+        """Part of cache keys for anything produced with cropping enabled."""
+        return ("roi", self.padding, self.alpha_threshold, self.smoothing, self.max_area,
+                self.max_changes, self.change_window, self.cooldown, self.align)
+
+
+class SubjectROI:
+    """
+    Wraps an RVMInference's process_batch so the model only sees a padded
+    box around the subject. The box comes from the alpha of the previous
+    batch, is smoothed over time and only moves when the subject leaves it
+    (or it has become much too large), so the crop stays fixed for long runs.
+    Alpha outside the box is 0.
+
+    The recurrent state describes the old crop, so on every crop change it
+    is reset and the first frame is run twice to settle it again. Lost
+    subjects and unstable boxes fall back to full-frame inference.
+    """
+
+    def __init__(self, inference, config=None):
+        self.inference = inference
+        self.config = config or SubjectROIConfig()
+        self.box = None
+        self.frames = 0
+        self.cropped_frames = 0
+        self.crop_changes = 0
+        self.fallbacks = 0
+        self._pixels = 0
+        self._full_pixels = 0
+        self._smoothed = None
+        self._changes = deque()
+        self._cooldown_until = 0
+        self._prime = False
+        self._frame_size = None
+        self._ring_key = None
+
+    @property
+    def output_ring_size(self):
+        return self.inference.output_ring_size
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "cropped_frames": self.cropped_frames,
+            "pixel_fraction": round(self._pixels / self._full_pixels, 4) if self._full_pixels else 1.0,
+            "crop_changes": self.crop_changes,
+            "fallbacks": self.fallbacks,
+        }
+
+    def _ensure_buffers(self, n, height, width):
+        # Full-size outputs, one slot per frame of every batch still alive
+        slots = n * self.inference.output_ring_size
+        key = self._ring_key
+        if key is not None and key[:2] == (height, width) and key[2] >= slots:
+            return
+        self._alpha_ring = [np.zeros((height, width), dtype=np.float32) for _ in range(slots)]
+        self._fgr_ring = [np.zeros((height, width, 3), dtype=np.float32) for _ in range(slots)]
+        # Box last pasted into each slot; outside it the slot is still zero
+        self._slot_box = [None] * slots
+        self._ring_pos = 0
+        self._ring_key = (height, width, slots)
+
+    def _paste(self, alpha, foreground, box):
+        pos = self._ring_pos
+        self._ring_pos = (pos + 1) % len(self._alpha_ring)
+        alpha_out = self._alpha_ring[pos]
+        fgr_out = self._fgr_ring[pos]
+        if self._slot_box[pos] != box:
+            alpha_out.fill(0)
+            fgr_out.fill(0)
+            self._slot_box[pos] = box
+        x0, y0, x1, y1 = box
+        alpha_out[y0:y1, x0:x1] = alpha
+        fgr_out[y0:y1, x0:x1] = foreground
+        return alpha_out, fgr_out
+
+    def process_batch(self, frames_bgr):
+        if not frames_bgr:
+            return []
+        n = len(frames_bgr)
+        height, width = frames_bgr[0].shape[:2]
+        if self._frame_size != (height, width):
+            self._frame_size = (height, width)
+            self._smoothed = None
+            self._set_box(None)
+
+        box = self.box
+        if box is None:
+            inputs = list(frames_bgr)
+        else:
+            x0, y0, x1, y1 = box
+            inputs = [f[y0:y1, x0:x1] for f in frames_bgr]
+        if self._prime:
+            # Settle the freshly reset state on the first frame of the new crop
+            inputs.insert(0, inputs[0])
+        results = self.inference.process_batch(inputs)
+        if self._prime:
+            results = results[1:]
+            self._prime = False
+
+        self.frames += n
+        self._full_pixels += n * height * width
+        if box is None:
+            self._pixels += n * height * width
+            self._update_box(results[-1][0], 0, 0, height, width)
+            return results
+
+        self.cropped_frames += n
+        self._pixels += n * (box[2] - box[0]) * (box[3] - box[1])
+        self._ensure_buffers(n, height, width)
+        self._update_box(results[-1][0], box[0], box[1], height, width)
+        return [self._paste(alpha, foreground, box) for alpha, foreground in results]
+
+    def _update_box(self, alpha, offset_x, offset_y, height, width):
+        cfg = self.config
+        mask = alpha > cfg.alpha_threshold
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if not len(rows):
+            # Subject lost: look at the whole frame again
+            self._smoothed = None
+            self._set_box(None)
+            return
+
+        subject = np.array([cols[0] + offset_x, rows[0] + offset_y,
+                            cols[-1] + 1 + offset_x, rows[-1] + 1 + offset_y], dtype=np.float64)
+        if self._smoothed is None:
+            self._smoothed = subject
+        else:
+            ema = cfg.smoothing * self._smoothed + (1 - cfg.smoothing) * subject
+            # Follow growth at once so the subject is never cut, shrink slowly
+            self._smoothed = np.concatenate([np.minimum(ema[:2], subject[:2]), np.maximum(ema[2:], subject[2:])])
+
+        x0, y0, x1, y1 = self._smoothed
+        pad_x = max(8.0, (x1 - x0) * cfg.padding)
+        pad_y = max(8.0, (y1 - y0) * cfg.padding)
+        target = (max(0, int(x0 - pad_x)), max(0, int(y0 - pad_y)),
+                  min(width, int(np.ceil(x1 + pad_x))), min(height, int(np.ceil(y1 + pad_y))))
+        target_area = (target[2] - target[0]) * (target[3] - target[1])
+
+        if self.frames < self._cooldown_until or target_area > cfg.max_area * height * width:
+            self._set_box(None)
+            return
+        box = self.box
+        if box is not None:
+            inside = box[0] <= target[0] and box[1] <= target[1] and box[2] >= target[2] and box[3] >= target[3]
+            box_area = (box[2] - box[0]) * (box[3] - box[1])
+            if inside and box_area <= 2 * target_area:
+                return
+
+        # New crop: the target plus the same margin again as room to move,
+        # snapped outwards to the grid
+        a = cfg.align
+        slack_x = int(pad_x)
+        slack_y = int(pad_y)
+        new_box = (max(0, (target[0] - slack_x) // a * a), max(0, (target[1] - slack_y) // a * a),
+                   min(width, -(-(target[2] + slack_x) // a) * a), min(height, -(-(target[3] + slack_y) // a) * a))
+        self._set_box(new_box)
+
+    def _set_box(self, box):
+        if box == self.box:
+            return
+        cfg = self.config
+        self._changes.append(self.frames)
+        while self._changes and self._changes[0] <= self.frames - cfg.change_window:
+            self._changes.popleft()
+        if box is not None and len(self._changes) > cfg.max_changes:
+            # The box keeps moving: full frames until it has settled
+            self.fallbacks += 1
+            self._cooldown_until = self.frames + cfg.cooldown
+            self._changes.clear()
+            box = None
+            if self.box is None:
+                return
+        self.box = box
+        self.crop_changes += 1
+        self.inference.reset_states()
+        self._prime = True
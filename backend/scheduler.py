@@ -0,0 +1,367 @@
+import heapq
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+
+from progress import JobCancelled, ProgressReporter
+
+
+class SchedulerFull(Exception):
+    """Raised by submit() when the pending queue is at capacity."""
+
+    def __init__(self, queue_length, max_queue):
+        super().__init__(f"Job queue is full ({queue_length}/{max_queue})")
+        self.queue_length = queue_length
+        self.max_queue = max_queue
+
+
+def _worker_main(worker_index, model_path, concurrency, inbox, events, batch_window=None, max_batch=8,
+                 processor_options=None, warmup_sizes=(), progress_interval=0.5, progress_step=1.0):
+    """
+    Entry point of a worker process. Each of the `concurrency` slots owns
+    its own VideoProcessor, because the recurrent state in RVMInference
+    belongs to one video at a time. With batch_window (seconds) and more
+    than one slot, the slots share one session per tier through a
+    BatcherPool, so frames of concurrent jobs are inferred together.
+
+    The processors are built with processor_options and warmed up at
+    warmup_sizes before the worker reports 'ready', so its first job does
+    not pay for loading the model.
+
+    The inbox carries ('run', job_id, kwargs) and ('cancel', job_id, None)
+    messages, read in order by this process's main thread: each job it has
+    received has a cancel event that process_video checks between batches. Progress is
+    sent at most every progress_interval seconds and progress_step percent,
+    with the job's frame rate and ETA.
+    """
+    # Imported here so the API process never loads the model stack
+    from video_processor import VideoProcessor
+    from batching import BatcherPool
+
+    batchers = None
+    if concurrency > 1 and batch_window is not None:
+        batchers = BatcherPool(model_path, window=batch_window, max_batch=max_batch)
+
+    def new_processor():
+        return VideoProcessor(model_path, batchers=batchers, **(processor_options or {}))
+
+    start = time.perf_counter()
+    processors = []
+    try:
+        for _ in range(concurrency):
+            processor = new_processor()
+            processor.prewarm(warmup_sizes)
+            processors.append(processor)
+    except Exception:
+        # Jobs retry the load and report the error
+        traceback.print_exc()
+    else:
+        events.put(('ready', worker_index, None, {'seconds': round(time.perf_counter() - start, 3)}))
+
+    # job id -> cancel event, for jobs received and not finished yet
+    cancel_events = {}
+    cancel_lock = threading.Lock()
+    jobs = queue.Queue()
+
+    def run_slot(slot):
+        processor = processors[slot] if slot < len(processors) else None
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            job_id, kwargs = job
+            with cancel_lock:
+                cancel_event = cancel_events[job_id]
+            try:
+                if cancel_event.is_set():
+                    raise JobCancelled("Job was cancelled")
+                if processor is None:
+                    processor = new_processor()
+
+                def send_progress(current, total):
+                    eta = progress.eta_seconds
+                    events.put(('progress', worker_index, job_id, {
+                        'progress': min(100, int((current / total) * 100)), 'current': current, 'total': total,
+                        'fps': round(progress.fps, 2) if progress.fps else None,
+                        'eta_seconds': round(eta, 1) if eta is not None else None,
+                    }))
+                progress = ProgressReporter(send_progress, progress_interval, progress_step)
+
+                events.put(('started', worker_index, job_id, {}))
+                processor.process_video(progress_callback=progress, cancel_event=cancel_event, **kwargs)
+                events.put(('completed', worker_index, job_id, {'output_path': kwargs.get('output_path'),
+                                                                'stats': processor.last_job}))
+            except JobCancelled:
+                print(f"Job {job_id} cancelled")
+                events.put(('cancelled', worker_index, job_id, {}))
+            except Exception as e:
+                traceback.print_exc()
+                events.put(('failed', worker_index, job_id, {'error': str(e)}))
+            finally:
+                with cancel_lock:
+                    cancel_events.pop(job_id, None)
+
+    threads = [threading.Thread(target=run_slot, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        kind, job_id, kwargs = message
+        with cancel_lock:
+            if kind == 'run':
+                cancel_events[job_id] = threading.Event()
+                jobs.put((job_id, kwargs))
+            elif job_id in cancel_events:
+                # A cancel comes after its job on the inbox, so an unknown id
+                # is a job that finished meanwhile: nothing to keep for it
+                cancel_events[job_id].set()
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+
+
+class _Worker:
+    def __init__(self, ctx, index, model_path, concurrency, events, batch_window=None, max_batch=8,
+                 processor_options=None, warmup_sizes=(), progress_interval=0.5, progress_step=1.0):
+        self.index = index
+        # Jobs and cancels in the order they were sent (see _worker_main)
+        self.inbox = ctx.Queue()
+        self.active = set()
+        # Set once the worker has loaded and warmed up its model
+        self.ready = False
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(index, model_path, concurrency, self.inbox, events, batch_window, max_batch,
+                  processor_options, warmup_sizes, progress_interval, progress_step),
+            name=f"veditor-worker-{index}",
+            # Not a daemon: segment-parallel jobs start processes of their own
+            daemon=False,
+        )
+        self.process.start()
+
+
+class JobScheduler:
+    """
+    Runs process_video jobs on a pool of worker processes so the API process
+    never does inference itself.
+
+    Pending jobs wait in a bounded priority queue (higher priority first,
+    FIFO within a priority). A dispatcher thread hands a job to the least
+    loaded worker that has a free slot (worker_concurrency slots each).
+    Worker events are delivered to on_event(job_id, kind, payload) from a
+    listener thread, where kind is 'started', 'progress', 'completed',
+    'failed' or 'cancelled'. Progress events carry fps and eta_seconds and
+    are throttled in the workers (progress_interval seconds, progress_step
+    percent).
+
+    cancel() drops a pending job at once; a running one stops at its next
+    batch and frees its slot with a 'cancelled' event.
+
+    With batch_window set, the slots of a worker batch their frames into
+    shared model runs (see batching.StreamBatcher), waiting at most
+    batch_window seconds for the other jobs and batching up to max_batch.
+
+    Workers build their VideoProcessors with processor_options and warm
+    them up at warmup_sizes ((width, height) pairs) when they start;
+    stats() counts the workers that are ready.
+    """
+
+    def __init__(self, model_path, num_workers=1, max_queue=16, worker_concurrency=1, on_event=None,
+                 batch_window=None, max_batch=8, processor_options=None, warmup_sizes=(),
+                 progress_interval=0.5, progress_step=1.0):
+        self.model_path = model_path
+        self.num_workers = max(1, num_workers)
+        self.max_queue = max_queue
+        self.worker_concurrency = max(1, worker_concurrency)
+        self.on_event = on_event
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.processor_options = processor_options
+        self.warmup_sizes = list(warmup_sizes)
+        self.progress_interval = progress_interval
+        self.progress_step = progress_step
+
+        self._ctx = mp.get_context('spawn')
+        self._events = None
+        self._workers = []
+        self._pending = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def start(self):
+        if self._running:
+            return
+        self._events = self._ctx.Queue()
+        self._workers = [
+            self._new_worker(i)
+            for i in range(self.num_workers)
+        ]
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._dispatch_loop, name="scheduler-dispatch", daemon=True),
+            threading.Thread(target=self._event_loop, name="scheduler-events", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+        print(f"Job scheduler started: {self.num_workers} worker(s) x {self.worker_concurrency} slot(s), queue {self.max_queue}")
+
+    def _new_worker(self, index):
+        return _Worker(self._ctx, index, self.model_path, self.worker_concurrency, self._events,
+                       self.batch_window, self.max_batch, self.processor_options, self.warmup_sizes,
+                       self.progress_interval, self.progress_step)
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for w in self._workers:
+            # Running jobs stop at their next batch and clean up after themselves
+            for job_id in list(w.active):
+                w.inbox.put(('cancel', job_id, None))
+            w.inbox.put(None)
+        for w in self._workers:
+            w.process.join(timeout=5)
+            if w.process.is_alive():
+                w.process.terminate()
+
+    def submit(self, job_id, kwargs, priority=0):
+        """Queues a job and returns its 1-based queue position."""
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                raise SchedulerFull(len(self._pending), self.max_queue)
+            heapq.heappush(self._pending, (-priority, next(self._seq), job_id, kwargs))
+            self._cond.notify_all()
+            return self._position_locked(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels a job: returns 'queued' if it was pending (and is gone now),
+        'running' if its worker was told to stop it, or None if the job is
+        not known (finished already).
+        """
+        with self._cond:
+            for i, entry in enumerate(self._pending):
+                if entry[2] == job_id:
+                    self._pending[i] = self._pending[-1]
+                    self._pending.pop()
+                    heapq.heapify(self._pending)
+                    self.cancelled += 1
+                    break
+            else:
+                worker = next((w for w in self._workers if job_id in w.active), None)
+                if worker is None:
+                    return None
+                worker.inbox.put(('cancel', job_id, None))
+                return 'running'
+        self._emit(job_id, 'cancelled', {})
+        return 'queued'
+
+    def _position_locked(self, job_id):
+        for pos, entry in enumerate(sorted(self._pending), start=1):
+            if entry[2] == job_id:
+                return pos
+        return None
+
+    def position(self, job_id):
+        """1-based position among pending jobs, or None once dispatched."""
+        with self._cond:
+            return self._position_locked(job_id)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.num_workers,
+                "ready_workers": sum(1 for w in self._workers if w.ready),
+                "slots_per_worker": self.worker_concurrency,
+                "cross_job_batching": self.batch_window is not None and self.worker_concurrency > 1,
+                "queued": len(self._pending),
+                "max_queue": self.max_queue,
+                "running": sum(len(w.active) for w in self._workers),
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+            }
+
+    def _free_worker_locked(self):
+        free = [w for w in self._workers if len(w.active) < self.worker_concurrency]
+        return min(free, key=lambda w: len(w.active)) if free else None
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while self._running and not (self._pending and self._free_worker_locked()):
+                    self._cond.wait()
+                if not self._running:
+                    return
+                _, _, job_id, kwargs = heapq.heappop(self._pending)
+                worker = self._free_worker_locked()
+                worker.active.add(job_id)
+                # Under the lock, so a cancel for the job is always sent after it
+                worker.inbox.put(('run', job_id, kwargs))
+
+    def _check_workers(self):
+        """
+        A crashed worker takes its running jobs with it: fails them and
+        respawns the worker. Runs on the event thread, which wakes at least
+        once a second whether or not anything is waiting for a slot.
+        """
+        lost = []
+        with self._cond:
+            for i, w in enumerate(self._workers):
+                if self._running and not w.process.is_alive():
+                    print(f"Worker {w.index} exited unexpectedly (code {w.process.exitcode}), restarting")
+                    lost.extend(w.active)
+                    self.failed += len(w.active)
+                    self._workers[i] = self._new_worker(w.index)
+                    self._cond.notify_all()
+        # on_event does task store I/O, so it runs without holding the lock
+        for job_id in lost:
+            self._emit(job_id, 'failed', {'error': 'Worker process crashed'})
+
+    def _emit(self, job_id, kind, payload):
+        if self.on_event:
+            try:
+                self.on_event(job_id, kind, payload)
+            except Exception:
+                traceback.print_exc()
+
+    def _event_loop(self):
+        while self._running:
+            self._check_workers()
+            try:
+                kind, worker_index, job_id, payload = self._events.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            if kind == 'ready':
+                with self._cond:
+                    for w in self._workers:
+                        if w.index == worker_index:
+                            w.ready = True
+                print(f"Worker {worker_index} ready in {payload['seconds']:.2f}s")
+                continue
+            if kind in ('completed', 'failed', 'cancelled'):
+                with self._cond:
+                    for w in self._workers:
+                        if w.index == worker_index:
+                            w.active.discard(job_id)
+                    if kind == 'completed':
+                        self.completed += 1
+                    elif kind == 'failed':
+                        self.failed += 1
+                    else:
+                        self.cancelled += 1
+                    self._cond.notify_all()
+            self._emit(job_id, kind, payload)
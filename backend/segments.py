@@ -0,0 +1,244 @@
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from encoder import concat_segments, find_ffprobe
+from progress import ProgressReporter, check_cancelled
+
+
+# Shorter clips are not worth the extra model loads
+MIN_SEGMENT_SECONDS = 10
+
+
+def probe_keyframes(ffmpeg_path, input_path, fps):
+    """Frame indices of the video keyframes, or None if ffprobe is unavailable."""
+    ffprobe_path = find_ffprobe(ffmpeg_path)
+    if not ffprobe_path:
+        return None
+    try:
+        result = subprocess.run(
+            [ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=120
+        )
+        if result.returncode != 0:
+            return None
+    except Exception:
+        return None
+    keyframes = set()
+    for line in result.stdout.decode().splitlines():
+        pts, _, flags = line.partition(',')
+        if 'K' in flags and pts not in ('', 'N/A'):
+            keyframes.add(int(round(float(pts) * fps)))
+    return sorted(keyframes)
+
+
+def plan_segments(ffmpeg_path, input_path, total_frames, fps, num_segments):
+    """
+    Splits [0, total_frames) into up to num_segments (start, end) ranges of
+    at least MIN_SEGMENT_SECONDS. Cuts snap to the nearest keyframe so each
+    segment seeks cheaply; without keyframe info the split is uniform.
+    """
+    min_frames = max(1, int(MIN_SEGMENT_SECONDS * fps))
+    num_segments = max(1, min(num_segments, total_frames // min_frames))
+    if num_segments == 1:
+        return [(0, total_frames)]
+
+    keyframes = probe_keyframes(ffmpeg_path, input_path, fps) or []
+    cuts = [0]
+    for i in range(1, num_segments):
+        target = total_frames * i // num_segments
+        if keyframes:
+            nearest = min(keyframes, key=lambda k: abs(k - target))
+            # Only snap when the keyframe is reasonably close
+            if abs(nearest - target) < min_frames // 2:
+                target = nearest
+        if target - cuts[-1] >= min_frames and total_frames - target >= min_frames:
+            cuts.append(target)
+    cuts.append(total_frames)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+_worker = {}
+
+
+def _init_worker(model_path, device, intra_op_threads, progress_queue, cancel_event):
+    _worker.update(model_path=model_path, device=device, threads=intra_op_threads,
+                   progress=progress_queue, cancel=cancel_event, processor=None)
+
+
+def _run_segment(index, input_path, segment_path, start, end, overlap_frames, kwargs):
+    from video_processor import VideoProcessor
+
+    if _worker['processor'] is None:
+        _worker['processor'] = VideoProcessor(_worker['model_path'], _worker['device'],
+                                              intra_op_threads=_worker['threads'], tier=kwargs.get('model_tier'))
+    progress = _worker['progress']
+    _worker['processor'].process_video(
+        input_path, segment_path, start_frame=start, end_frame=end,
+        warmup_frames=overlap_frames, include_audio=False,
+        progress_callback=ProgressReporter(lambda current, total: progress.put((index, current)),
+                                           min_interval=0.2, min_step=0),
+        cancel_event=_worker['cancel'],
+        **kwargs
+    )
+    return segment_path, _worker['processor'].last_job
+
+
+def merge_stage_timings(stage_dicts):
+    """Sums StageTimings.as_dict() results from several runs."""
+    merged = {}
+    for stages in stage_dicts:
+        for stage, t in (stages or {}).items():
+            m = merged.setdefault(stage, {"busy_s": 0.0, "wait_s": 0.0, "items": 0})
+            m["busy_s"] = round(m["busy_s"] + t["busy_s"], 4)
+            m["wait_s"] = round(m["wait_s"] + t["wait_s"], 4)
+            m["items"] += t["items"]
+    return merged
+
+
+def process_video_segmented(processor, input_path, output_path, plan, ffmpeg_path,
+                            overlap_frames=16, progress_callback=None, trace_path=None, cancel_event=None,
+                            **kwargs):
+    """
+    Runs each (start, end) range of plan in its own process, encodes the
+    segments independently without audio, then joins them with a stream
+    copy and muxes the original audio once. Every segment after the first
+    warms its recurrent state on overlap_frames earlier frames, which are
+    discarded, so the matte does not restart cold at the seams.
+
+    Returns a job summary like VideoProcessor.last_job, with the stage
+    timings summed over segments. With trace_path, each segment writes its
+    own trace next to it (name.segmentN.json).
+
+    Setting cancel_event stops every segment at its next batch; the call
+    then raises progress.JobCancelled.
+    """
+    job_start = time.perf_counter()
+    total_frames = plan[-1][1] - plan[0][0]
+    num_segments = len(plan)
+    threads = max(1, (os.cpu_count() or 1) // num_segments)
+    print(f"Segment-parallel processing: {num_segments} segments x {threads} thread(s)")
+
+    ctx = mp.get_context('spawn')
+    progress_queue = ctx.Queue()
+    # Forwarded from cancel_event by the progress thread
+    segment_cancel = ctx.Event()
+    done = [0] * num_segments
+    stop = threading.Event()
+
+    def report_progress():
+        while not stop.is_set():
+            if cancel_event is not None and cancel_event.is_set():
+                segment_cancel.set()
+            try:
+                index, current = progress_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            done[index] = current
+            if progress_callback:
+                progress_callback(sum(done), total_frames)
+
+    reporter = threading.Thread(target=report_progress, name="segment-progress", daemon=True)
+    reporter.start()
+
+    work_dir = tempfile.mkdtemp(prefix="veditor_segments_")
+    try:
+        with ProcessPoolExecutor(max_workers=num_segments, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(processor.model_path, processor.device, threads, progress_queue,
+                                           segment_cancel)) as pool:
+            futures = []
+            for i, (start, end) in enumerate(plan):
+                segment_kwargs = dict(kwargs)
+                if trace_path:
+                    root, ext = os.path.splitext(trace_path)
+                    segment_kwargs["trace_path"] = f"{root}.segment{i}{ext or '.json'}"
+                futures.append(pool.submit(
+                    _run_segment, i, input_path, os.path.join(work_dir, f"segment_{i:03d}.mp4"),
+                    start, end, overlap_frames if start > 0 else 0, segment_kwargs))
+            results = [f.result() for f in futures]
+        segment_paths = [path for path, _ in results]
+        check_cancelled(cancel_event)
+        t0 = time.perf_counter()
+        concat_segments(ffmpeg_path, segment_paths, output_path, audio_source=input_path,
+                        audio_codec=kwargs['encoder_config'].audio_codec if kwargs.get('encoder_config') else 'copy')
+        concat_seconds = time.perf_counter() - t0
+    finally:
+        stop.set()
+        reporter.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if progress_callback:
+        progress_callback(total_frames, total_frames)
+
+    jobs = [job for _, job in results if job]
+    stages = merge_stage_timings(job["stages"] for job in jobs)
+    stages["mux"] = {"busy_s": round(concat_seconds, 4), "wait_s": 0.0, "items": 0}
+    seconds = time.perf_counter() - job_start
+    frames = sum(job["frames"] for job in jobs)
+    summary = {
+        "frames": frames,
+        "seconds": round(seconds, 4),
+        "fps": round(frames / seconds, 3) if seconds > 0 else None,
+        "backend": processor.inference.backend,
+        "model": processor.inference.model_id,
+        "pipelined": kwargs.get("pipelined", False),
+        "matte_reused": False,
+        "segments": len(plan),
+        "stages": stages,
+    }
+    reuse = [job["frame_reuse"] for job in jobs if job.get("frame_reuse")]
+    if reuse:
+        reused = sum(r["reused"] for r in reuse)
+        seen = sum(r["frames"] for r in reuse)
+        summary["frame_reuse"] = dict(reuse[0], frames=seen, reused=reused,
+                                      reused_fraction=round(reused / seen, 4) if seen else 0.0)
+    rois = [job["roi"] for job in jobs if job.get("roi")]
+    if rois:
+        seen = sum(r["frames"] for r in rois)
+        summary["roi"] = {
+            "frames": seen,
+            "cropped_frames": sum(r["cropped_frames"] for r in rois),
+            "pixel_fraction": round(sum(r["pixel_fraction"] * r["frames"] for r in rois) / seen, 4) if seen else 1.0,
+            "crop_changes": sum(r["crop_changes"] for r in rois),
+            "fallbacks": sum(r["fallbacks"] for r in rois),
+        }
+    return summary
+
+
+def measure_seam_consistency(processor, input_path, seam_frame, overlap_frames=16, window=4, lead_frames=64):
+    """
+    Checks a segment boundary: compares the alpha of the window frames after
+    seam_frame from an uninterrupted run (starting lead_frames earlier) with
+    a restart warmed on overlap_frames, as the segmented mode does. Returns
+    the largest per-frame mean absolute alpha difference (0 means seamless).
+    """
+    import cv2
+
+    def run(start):
+        cap = cv2.VideoCapture(input_path)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        processor.inference.reset_states()
+        alphas = []
+        for index in range(start, seam_frame + window):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            alpha, _ = processor.inference.process_batch([frame])[0]
+            if index >= seam_frame:
+                alphas.append(np.array(alpha, dtype=np.float32))
+        cap.release()
+        return alphas
+
+    reference = run(max(0, seam_frame - lead_frames))
+    restarted = run(max(0, seam_frame - overlap_frames))
+    if not reference or len(reference) != len(restarted):
+        raise Exception("Could not read frames around the seam")
+    return max(float(np.abs(a - b).mean()) for a, b in zip(reference, restarted))
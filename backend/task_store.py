@@ -0,0 +1,149 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+FINISHED = ("completed", "failed", "cancelled")
+_FINISHED_SQL = ", ".join("?" * len(FINISHED))
+
+
+class TaskStore:
+    """
+    Task records in a SQLite database, so they survive restarts and can be
+    read by every API process. Each task is a JSON document plus the columns
+    needed for lookups and expiry; finished tasks older than ttl_seconds are
+    removed by expire(), which hands them back so the caller can delete
+    their files.
+    """
+
+    def __init__(self, db_path, ttl_seconds=24 * 3600):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL,
+                created REAL NOT NULL, updated REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_updated ON tasks (status, updated)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def create(self, task_id, task):
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)",
+                       (task_id, task["status"], json.dumps(task), now, now))
+
+    def get(self, task_id):
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, task_id, only_if_status=None, **fields):
+        """
+        Merges fields into the task and returns it, or None if it is gone.
+        With only_if_status (a tuple of statuses), tasks in another status
+        are left alone and None is returned.
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if not row:
+                return None
+            task = json.loads(row[0])
+            if only_if_status is not None and task["status"] not in only_if_status:
+                return None
+            for name, value in fields.items():
+                if value is None:
+                    task.pop(name, None)
+                else:
+                    task[name] = value
+            db.execute("UPDATE tasks SET status = ?, data = ?, updated = ? WHERE task_id = ?",
+                       (task["status"], json.dumps(task), time.time(), task_id))
+        return task
+
+    def delete(self, task_id):
+        with self._connect() as db:
+            db.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def fail_unfinished(self, error):
+        """Marks tasks left queued or running by a previous process as failed; returns them."""
+        with self._connect() as db:
+            rows = db.execute(f"SELECT task_id, data FROM tasks WHERE status NOT IN ({_FINISHED_SQL})", FINISHED).fetchall()
+            failed = []
+            for task_id, data in rows:
+                task = json.loads(data)
+                task.update(status="failed", error=error)
+                db.execute("UPDATE tasks SET status = ?, data = ?, updated = ? WHERE task_id = ?",
+                           ("failed", json.dumps(task), time.time(), task_id))
+                failed.append(task)
+        return failed
+
+    def expire(self):
+        """Removes finished tasks not updated for ttl_seconds and returns their records."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._connect() as db:
+            rows = db.execute(f"SELECT task_id, data FROM tasks WHERE status IN ({_FINISHED_SQL}) AND updated < ?",
+                              FINISHED + (cutoff,)).fetchall()
+            db.executemany("DELETE FROM tasks WHERE task_id = ?", [(task_id,) for task_id, _ in rows])
+        return [json.loads(data) for _, data in rows]
+
+    def stats(self):
+        with self._connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+
+class ProgressBroker:
+    """
+    Fans task updates out to server-sent-event subscribers. publish() may be
+    called from any thread; updates are throttled to one per min_interval
+    seconds per task, except for status changes, which always go out.
+    """
+
+    def __init__(self, min_interval=0.5):
+        self.min_interval = min_interval
+        self._subscribers = {}
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_id):
+        """Returns an asyncio.Queue bound to the running loop; call from a coroutine."""
+        q = asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(task_id, []).append((asyncio.get_running_loop(), q))
+        return q
+
+    def unsubscribe(self, task_id, q):
+        with self._lock:
+            subs = [s for s in self._subscribers.get(task_id, []) if s[1] is not q]
+            if subs:
+                self._subscribers[task_id] = subs
+            else:
+                self._subscribers.pop(task_id, None)
+
+    def publish(self, task_id, update):
+        now = time.time()
+        with self._lock:
+            last_time, last_status = self._last.get(task_id, (0, None))
+            if update.get("status") == last_status and now - last_time < self.min_interval:
+                return
+            if update.get("status") in FINISHED:
+                self._last.pop(task_id, None)
+            else:
+                self._last[task_id] = (now, update.get("status"))
+            subs = list(self._subscribers.get(task_id, []))
+        for loop, q in subs:
+            try:
+                loop.call_soon_threadsafe(q.put_nowait, update)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                self.unsubscribe(task_id, q)
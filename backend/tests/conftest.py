@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# The backend modules import each other as top-level modules
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture(scope="session")
+def standin_model(tmp_path_factory):
+    """model_path for VideoProcessor, next to a generated stand-in ONNX model (see benchmark.py)."""
+    pytest.importorskip("onnx")
+    from benchmark import make_standin_model
+
+    model_dir = tmp_path_factory.mktemp("model")
+    make_standin_model(str(model_dir / "rvm_mobilenetv3_fp32.onnx"))
+    return str(model_dir / "rvm_mobilenetv3.pth")
+
+
+@pytest.fixture(scope="session")
+def ffmpeg_path():
+    from encoder import find_ffmpeg
+
+    path = find_ffmpeg()
+    if not path:
+        pytest.skip("ffmpeg not found")
+    return path
+
+
+@pytest.fixture(scope="session")
+def synthetic_video(tmp_path_factory):
+    """A 60-frame 160x96 clip with a moving subject."""
+    from benchmark import make_video
+
+    path = str(tmp_path_factory.mktemp("video") / "synthetic.avi")
+    make_video(path, 160, 96, 60)
+    return path
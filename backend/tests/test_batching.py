@@ -0,0 +1,146 @@
+import threading
+
+import numpy as np
+import pytest
+
+from batching import BatchedStream, StreamBatcher
+from benchmark import make_video
+from inference import RVMInference
+from model_registry import _read_frames
+
+
+def make_recurrent_model(path):
+    """
+    An ONNX model with RVM's signature that takes batches and whose alpha
+    depends on the recurrent state: r1 accumulates the downsampled frames
+    and grows from 1x1 to its real size on the first frame, like RVM's.
+    """
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper, numpy_helper
+
+    init = [
+        numpy_helper.from_array(np.array([1, 1], dtype=np.float32), "ones"),
+        numpy_helper.from_array(np.array(0.5, dtype=np.float32), "half"),
+        numpy_helper.from_array(np.array([0], dtype=np.int64), "zero"),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), "one"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "two"),
+        numpy_helper.from_array(np.array([4], dtype=np.int64), "four"),
+    ]
+    nodes = [
+        helper.make_node("Identity", ["src"], ["fgr"]),
+        helper.make_node("Concat", ["ones", "downsample_ratio", "downsample_ratio"], ["scales"], axis=0),
+        helper.make_node("ReduceMean", ["src"], ["gray"], axes=[1], keepdims=1),
+        helper.make_node("Resize", ["gray", "", "scales"], ["small"], mode="linear"),
+        helper.make_node("Mul", ["r1i", "half"], ["decayed"]),
+        helper.make_node("Add", ["decayed", "small"], ["r1o"]),
+        helper.make_node("ReduceMean", ["r1o"], ["state"], axes=[1], keepdims=1),
+        helper.make_node("Shape", ["src"], ["src_shape"]),
+        helper.make_node("Slice", ["src_shape", "zero", "one"], ["batch"]),
+        helper.make_node("Slice", ["src_shape", "two", "four"], ["hw"]),
+        helper.make_node("Concat", ["batch", "one", "hw"], ["sizes"], axis=0),
+        helper.make_node("Resize", ["state", "", "", "sizes"], ["up"], mode="linear"),
+        helper.make_node("Sub", ["up", "half"], ["centered"]),
+        helper.make_node("Sigmoid", ["centered"], ["pha"]),
+    ]
+    inputs = [helper.make_tensor_value_info("src", TensorProto.FLOAT, ["b", 3, "h", "w"])]
+    outputs = [
+        helper.make_tensor_value_info("fgr", TensorProto.FLOAT, ["b", 3, "h", "w"]),
+        helper.make_tensor_value_info("pha", TensorProto.FLOAT, ["b", 1, "h", "w"]),
+    ]
+    for i, channels in enumerate([16, 20, 40, 64], start=1):
+        inputs.append(helper.make_tensor_value_info(f"r{i}i", TensorProto.FLOAT, ["b", channels, f"h{i}", f"w{i}"]))
+        outputs.append(helper.make_tensor_value_info(f"r{i}o", TensorProto.FLOAT, ["b", channels, f"h{i}", f"w{i}"]))
+        if i > 1:
+            nodes.append(helper.make_node("Mul", [f"r{i}i", "half"], [f"r{i}o"]))
+    inputs.append(helper.make_tensor_value_info("downsample_ratio", TensorProto.FLOAT, [1]))
+    graph = helper.make_graph(nodes, "rvm_recurrent", inputs, outputs, init)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    onnx.save(model, path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def recurrent_model(tmp_path_factory):
+    return make_recurrent_model(str(tmp_path_factory.mktemp("model") / "rvm_mobilenetv3_fp32.onnx"))
+
+
+@pytest.fixture(scope="module")
+def clips(tmp_path_factory):
+    out = []
+    for i, (width, height) in enumerate([(128, 96), (128, 96), (96, 64)]):
+        path = str(tmp_path_factory.mktemp("video") / f"clip{i}.avi")
+        make_video(path, width, height, 12)
+        # Different content per stream, so mixed-up rows would show
+        out.append([np.roll(f, 7 * i, axis=1) for f in _read_frames(path, 12)])
+    return out
+
+
+def _kept(results):
+    return [(np.array(a), np.array(f)) for a, f in results]
+
+
+def _alone(model_path, frames, step, max_inference_side=None):
+    engine = RVMInference.from_onnx(model_path)
+    engine.set_resolution_policy(0.25, max_inference_side)
+    engine.set_output_ring_size(1)
+    out = []
+    for i in range(0, len(frames), step):
+        out.extend(_kept(engine.process_batch(frames[i:i + step])))
+    return out
+
+
+def _run_streams(batcher, clips, step, max_inference_side=None, ring_size=1):
+    streams = [batcher.stream() for _ in clips]
+    results = [[] for _ in clips]
+
+    def run(stream, frames, out):
+        stream.set_resolution_policy(0.25, max_inference_side)
+        stream.set_output_ring_size(ring_size)
+        for i in range(0, len(frames), step):
+            out.extend(_kept(stream.process_batch(frames[i:i + step])))
+
+    threads = [threading.Thread(target=run, args=args) for args in zip(streams, clips, results)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return streams, results
+
+
+@pytest.mark.parametrize("max_inference_side", [None, 64])
+def test_streams_match_separate_engines(recurrent_model, clips, max_inference_side):
+    batcher = StreamBatcher(RVMInference.from_onnx(recurrent_model), window=0.05, max_batch=4)
+    streams, results = _run_streams(batcher, clips, 4, max_inference_side)
+
+    assert batcher.stats()["mean_batch_size"] > 1
+    for frames, got in zip(clips, results):
+        expected = _alone(recurrent_model, frames, 1, max_inference_side)
+        assert len(got) == len(expected) == len(frames)
+        for (a, f), (ea, ef) in zip(got, expected):
+            assert a.shape == frames[0].shape[:2]
+            np.testing.assert_allclose(a, ea, atol=1e-5)
+            np.testing.assert_allclose(f, ef, atol=1e-5)
+
+
+def test_stream_outputs_stay_valid_for_the_ring(recurrent_model, clips):
+    """The outputs of the last output_ring_size batches are not overwritten."""
+    batcher = StreamBatcher(RVMInference.from_onnx(recurrent_model), window=0.0, max_batch=4)
+    stream = batcher.stream()
+    stream.set_output_ring_size(3)
+    frames = clips[0]
+    expected = _alone(recurrent_model, frames, 1)
+    batches = [stream.process_batch(frames[i:i + 2]) for i in range(0, 6, 2)]
+    for batch, i in zip(batches, range(0, 6, 2)):
+        for (a, f), (ea, ef) in zip(batch, expected[i:i + 2]):
+            np.testing.assert_allclose(a, ea, atol=1e-5)
+            np.testing.assert_allclose(f, ef, atol=1e-5)
+
+
+def test_stream_is_an_engine_of_its_own(recurrent_model):
+    engine = RVMInference.from_onnx(recurrent_model)
+    stream = StreamBatcher(engine).stream()
+    assert isinstance(stream, BatchedStream)
+    stream.set_resolution_policy('auto', 512)
+    assert stream.model_id != engine.model_id
+    assert (stream.backend, stream.tier) == (engine.backend, engine.tier)
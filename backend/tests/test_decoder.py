@@ -0,0 +1,18 @@
+import subprocess
+
+from decoder import FFmpegReader, probe_video
+
+
+def test_ffmpeg_reader_keeps_vfr_frame_count(tmp_path, ffmpeg_path):
+    """A clip whose second half runs at half the frame rate decodes to exactly its frames."""
+    path = str(tmp_path / "vfr.mp4")
+    subprocess.run([ffmpeg_path, '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=size=64x48:rate=30',
+                    '-frames:v', '60', '-vf', "setpts='if(lt(N,30),N,30+(N-30)*2)/30/TB'",
+                    '-fps_mode', 'passthrough', '-pix_fmt', 'yuv420p', path], check=True)
+    info = probe_video(path, ffmpeg_path)
+    reader = FFmpegReader(ffmpeg_path, path, info)
+    frames = 0
+    while reader.read()[0]:
+        frames += 1
+    reader.release()
+    assert frames == 60
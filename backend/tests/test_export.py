@@ -0,0 +1,66 @@
+import subprocess
+
+import numpy as np
+
+from decoder import open_video, probe_video
+from encoder import FFmpegWriter
+from export import MatteExporter
+from pipeline import PipelineConfig
+from video_processor import VideoProcessor
+
+
+def _decode_gray(ffmpeg_path, path, width, height):
+    raw = subprocess.run([ffmpeg_path, '-loglevel', 'error', '-i', path, '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+                         stdout=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(raw, dtype=np.uint8).reshape(-1, height, width)
+
+
+def test_matte_writer_is_lossless(tmp_path, ffmpeg_path):
+    """Every 8-bit level, including 0-15 and 236-255, comes back unchanged."""
+    width, height = 64, 48
+    rng = np.random.default_rng(0)
+    alphas = [rng.random((height, width), dtype=np.float32) for _ in range(6)]
+    alphas[0] = np.linspace(0, 1, width * height, dtype=np.float32).reshape(height, width)
+    exporter = MatteExporter(width, height, 'matte')
+    expected = []
+    path = str(tmp_path / "matte.mp4")
+    writer = FFmpegWriter(ffmpeg_path, path, width, height, 30, output_format='matte')
+    for alpha in alphas:
+        frame = exporter.frame(alpha, None)
+        expected.append(frame.copy())
+        writer.write(frame)
+    writer.release()
+
+    decoded = _decode_gray(ffmpeg_path, path, width, height)
+    assert decoded.shape[0] == len(expected)
+    np.testing.assert_array_equal(decoded, np.stack(expected))
+
+
+def test_matte_export_matches_model_alpha(tmp_path, standin_model, ffmpeg_path, synthetic_video):
+    processor = VideoProcessor(standin_model)
+    output_path = str(tmp_path / "export.mp4")
+    processor.process_video(synthetic_video, output_path, output_format='matte')
+
+    # The model run again over the same decoded frames, in the job's batches
+    info = probe_video(synthetic_video, ffmpeg_path)
+    config = PipelineConfig()
+    cap = open_video(synthetic_video, info, ffmpeg_path, decoder=config.decoder)
+    exporter = MatteExporter(info.width, info.height, 'matte')
+    processor.inference.reset_states()
+    expected = []
+    while True:
+        batch = []
+        while len(batch) < config.batch_size:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            batch.append(frame.copy())
+        if not batch:
+            break
+        for alpha, foreground in processor.inference.process_batch(batch):
+            expected.append(exporter.frame(alpha, foreground).copy())
+    cap.release()
+
+    decoded = _decode_gray(ffmpeg_path, output_path, info.width, info.height)
+    assert decoded.shape[0] == len(expected) == 60
+    np.testing.assert_array_equal(decoded, np.stack(expected))
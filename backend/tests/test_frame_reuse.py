@@ -0,0 +1,36 @@
+import numpy as np
+
+from frame_reuse import FrameReuse, FrameReuseConfig
+
+
+class FixedEngine:
+    """Stands in for RVMInference: the same alpha for every frame, the frame itself as foreground."""
+
+    output_ring_size = 2
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.calls = 0
+
+    def process_batch(self, frames_bgr):
+        self.calls += len(frames_bgr)
+        return [(self.alpha, frame[:, :, ::-1] / np.float32(255) + np.float32(0.01)) for frame in frames_bgr]
+
+
+def test_reused_frames_keep_the_held_residual():
+    rng = np.random.default_rng(0)
+    height, width = 48, 64
+    alpha = rng.random((height, width), dtype=np.float32)
+    engine = FixedEngine(alpha)
+    reuse = FrameReuse(engine, FrameReuseConfig(threshold=5.0, max_interval=8))
+    first = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    # Small changes stay under the probe threshold
+    frames = [first] + [np.clip(first.astype(np.int16) + d, 0, 255).astype(np.uint8) for d in (1, -1, 2)]
+
+    results = [(np.array(a), np.array(f)) for a, f in reuse.process_batch(frames)]
+    assert engine.calls == 1
+    assert reuse.stats()["reused"] == 3
+    for frame, (a, f) in zip(frames, results):
+        np.testing.assert_array_equal(a, alpha)
+        # The current frame plus the foreground residual of the inferred frame
+        np.testing.assert_allclose(f, frame[:, :, ::-1] / np.float32(255) + np.float32(0.01), atol=1e-6)
@@ -0,0 +1,50 @@
+import pytest
+
+from compositor import Compositor
+from encoder import FFmpegWriter
+from matte_store import MatteStore
+from video_processor import VideoProcessor
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_matte_stored_for_complete_job(tmp_path, standin_model, ffmpeg_path, synthetic_video, pipelined):
+    store = MatteStore(str(tmp_path / "mattes"))
+    processor = VideoProcessor(standin_model)
+    processor.process_video(synthetic_video, str(tmp_path / "out.mp4"), pipelined=pipelined,
+                            matte_store=store, matte_key="clip")
+    assert store.stats()["entries"] == 1
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_matte_not_stored_when_a_frame_is_dropped(tmp_path, monkeypatch, standin_model, ffmpeg_path,
+                                                 synthetic_video, pipelined):
+    composite = Compositor.composite
+    calls = []
+
+    def failing_composite(self, alpha, foreground):
+        calls.append(1)
+        if len(calls) == 10:
+            raise RuntimeError("composite failed")
+        return composite(self, alpha, foreground)
+    monkeypatch.setattr(Compositor, "composite", failing_composite)
+
+    store = MatteStore(str(tmp_path / "mattes"))
+    processor = VideoProcessor(standin_model)
+    processor.process_video(synthetic_video, str(tmp_path / "out.mp4"), pipelined=pipelined,
+                            matte_store=store, matte_key="clip")
+    assert store.stats()["entries"] == 0
+
+
+def test_failed_encode_leaves_nothing_behind(tmp_path, monkeypatch, standin_model, ffmpeg_path, synthetic_video):
+    def failing_release(self):
+        raise RuntimeError("encode failed")
+    monkeypatch.setattr(FFmpegWriter, "release", failing_release)
+
+    store = MatteStore(str(tmp_path / "mattes"))
+    output_path = tmp_path / "out.mp4"
+    processor = VideoProcessor(standin_model)
+    with pytest.raises(RuntimeError):
+        processor.process_video(synthetic_video, str(output_path), matte_store=store, matte_key="clip")
+    assert not output_path.exists()
+    assert store.stats()["entries"] == 0
+    assert not any(p.name.startswith(".tmp-") for p in (tmp_path / "mattes").iterdir())
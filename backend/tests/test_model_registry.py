@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+from model_registry import DEFAULT_TIER, TIERS, ModelRegistry
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_unknown_default_tier_falls_back_to_balanced():
+    env = dict(os.environ, VEDITOR_MODEL_TIER="turbo")
+    out = subprocess.run([sys.executable, "-c", "import model_registry; print(model_registry.DEFAULT_TIER)"],
+                         cwd=BACKEND_DIR, env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+    assert out.splitlines()[-1] == "balanced"
+
+
+def test_unknown_tier_uses_default_order(tmp_path):
+    for precision in ("fp32", "int8"):
+        (tmp_path / f"rvm_mobilenetv3_{precision}.onnx").write_bytes(b"\0" * 2048)
+    registry = ModelRegistry(str(tmp_path))
+    default = [(v.backbone, v.precision) for v in registry.candidates()]
+    assert default == [kind for kind in TIERS[DEFAULT_TIER] if kind[1] in ("fp32", "int8")]
+    assert registry.candidates("turbo") == registry.candidates()
+
+
+def test_reading_tiers_does_not_load_onnxruntime():
+    code = "import sys, model_registry; print('onnxruntime' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, stdout=subprocess.PIPE, text=True,
+                         check=True).stdout
+    assert out.splitlines()[-1] == "False"
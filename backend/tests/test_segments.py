@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+
+from segments import measure_seam_consistency, process_video_segmented
+from video_processor import VideoProcessor
+
+
+def _frame_diffs(path):
+    """Mean absolute difference between each decoded frame and the one before."""
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame.astype(np.float32))
+    cap.release()
+    return [float(np.abs(b - a).mean()) for a, b in zip(frames, frames[1:])]
+
+
+def test_segment_seams_match_in_segment_changes(tmp_path, standin_model, ffmpeg_path, synthetic_video):
+    processor = VideoProcessor(standin_model)
+    plan = [(0, 20), (20, 40), (40, 60)]
+    output_path = str(tmp_path / "segmented.mp4")
+    progress = []
+    summary = process_video_segmented(processor, synthetic_video, output_path, plan, ffmpeg_path,
+                                      overlap_frames=8, progress_callback=lambda c, t: progress.append((c, t)))
+
+    assert summary["segments"] == 3
+    assert summary["frames"] == 60
+    assert progress[-1] == (60, 60)
+
+    diffs = _frame_diffs(output_path)
+    assert len(diffs) == 59
+    # diffs[i] compares frame i + 1 with frame i, so a cut at frame s is diffs[s - 1]
+    seams = [start - 1 for start, _ in plan[1:]]
+    inside = [d for i, d in enumerate(diffs) if i not in seams]
+    tolerance = 1.5 * np.median(inside)
+    for seam in seams:
+        assert diffs[seam] <= tolerance, (seam, diffs[seam], tolerance)
+
+
+def test_seam_warmup_matches_uninterrupted_run(standin_model, synthetic_video):
+    processor = VideoProcessor(standin_model)
+    error = measure_seam_consistency(processor, synthetic_video, seam_frame=30, overlap_frames=8, lead_frames=30)
+    assert error < 1e-3
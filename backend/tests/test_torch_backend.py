@@ -0,0 +1,137 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from benchmark import make_video
+from inference import RVMInference
+from model_registry import MODEL_DIR, SessionConfig, _read_frames, compare_torch_onnx
+
+
+class RecurrentStandin(torch.nn.Module):
+    """
+    Small network with MattingNetwork's forward signature: src [B, T, 3, H, W]
+    and four recurrent states in, [fgr, pha, r1..r4] out. Each frame's alpha
+    depends on its state, which steps once per frame.
+    """
+
+    def __init__(self, variant="mobilenetv3"):
+        super().__init__()
+        # 16 state channels, like RVM's r1
+        self.conv = torch.nn.Conv2d(3, 16, 3, padding=1)
+        self.mix = torch.nn.Conv2d(16, 1, 1)
+
+    def forward(self, src, r1=None, r2=None, r3=None, r4=None, downsample_ratio=0.25):
+        state = r1 if r1 is not None else torch.zeros_like(src[:, 0, :1]).repeat(1, 16, 1, 1)
+        phas = []
+        for t in range(src.shape[1]):
+            state = 0.5 * state + 0.5 * torch.tanh(self.conv(src[:, t]))
+            phas.append(torch.sigmoid(self.mix(state)))
+        pha = torch.stack(phas, dim=1)
+        return [src, pha, state, state, state, state]
+
+
+class OnnxStandin(torch.nn.Module):
+    """RecurrentStandin with the signature of RVM's ONNX export: one frame per call."""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, src, r1i, r2i, r3i, r4i, downsample_ratio):
+        fgr, pha, r1o = self.net(src.unsqueeze(1), r1i)[:3]
+        # Keeps downsample_ratio an input of the graph, as RVMInference binds it
+        pha = pha[:, 0] + 0 * downsample_ratio
+        return fgr[:, 0], pha, r1o, r2i.clone(), r3i.clone(), r4i.clone()
+
+
+@pytest.fixture
+def standin_checkpoint(tmp_path, monkeypatch):
+    """A checkpoint for RecurrentStandin, which RVMInference loads as the RVM model."""
+    monkeypatch.setitem(sys.modules, "model", types.SimpleNamespace(MattingNetwork=RecurrentStandin))
+    torch.manual_seed(0)
+    path = tmp_path / "rvm_mobilenetv3.pth"
+    torch.save(RecurrentStandin().state_dict(), path)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("video") / "clip.avi")
+    make_video(path, 96, 64, 12)
+    return _read_frames(path, 12)
+
+
+def _alphas(engine, frames, step):
+    engine.set_output_ring_size(1)
+    out = []
+    for i in range(0, len(frames), step):
+        out.extend(np.array(a) for a, _ in engine.process_batch(frames[i:i + step]))
+    return out
+
+
+@pytest.mark.parametrize("compile_mode", ["", "trace", "compile"])
+@pytest.mark.parametrize("channels_last", [True, False])
+def test_sequence_matches_frame_by_frame(standin_checkpoint, clip, compile_mode, channels_last):
+    config = SessionConfig(torch_compile=compile_mode, torch_channels_last=channels_last)
+    frame_by_frame = _alphas(RVMInference.from_torch(standin_checkpoint, session_config=config), clip, 1)
+    engine = RVMInference.from_torch(standin_checkpoint, session_config=config)
+    sequence = _alphas(engine, clip, 4)
+    if compile_mode == "trace":
+        # One trace for the 4-frame shape, not the eager fallback
+        assert len(engine._traces) == 1
+        assert all(isinstance(t, torch.jit.ScriptFunction) for t in engine._traces.values())
+    if compile_mode == "compile":
+        # Still compiled, so torch.compile did not fall back to eager
+        assert engine._compiled is not None
+
+    assert len(sequence) == len(frame_by_frame) == len(clip)
+    for a, b in zip(frame_by_frame, sequence):
+        assert a.shape == clip[0].shape[:2]
+        np.testing.assert_allclose(a, b, atol=1e-5)
+
+
+def test_sequence_steps_state_every_frame(standin_checkpoint, clip):
+    """A frame repeated within one sequence gets a different alpha as the state moves on."""
+    engine = RVMInference.from_torch(standin_checkpoint)
+    alphas = [np.array(a) for a, _ in engine.process_batch([clip[0]] * 4)]
+    assert not np.allclose(alphas[0], alphas[1])
+
+
+def test_torch_sequence_matches_onnx_frame_by_frame(standin_checkpoint, clip, tmp_path):
+    """The same weights through the ONNX path, one frame per call, and PyTorch sequences."""
+    net = RecurrentStandin()
+    net.load_state_dict(torch.load(standin_checkpoint))
+    net.eval()
+    onnx_path = str(tmp_path / "rvm_mobilenetv3_fp32.onnx")
+    states = [torch.zeros(1, c, 1, 1) for c in (16, 20, 40, 64)]
+    names = ["src", "r1i", "r2i", "r3i", "r4i", "downsample_ratio"]
+    outputs = ["fgr", "pha", "r1o", "r2o", "r3o", "r4o"]
+    spatial = {name: {2: f"{name}_h", 3: f"{name}_w"} for name in names[:5] + outputs}
+    torch.onnx.export(OnnxStandin(net), (torch.zeros(1, 3, 64, 96), *states, torch.tensor([0.25])), onnx_path,
+                      input_names=names, output_names=outputs, dynamic_axes=spatial, opset_version=17, dynamo=False)
+
+    onnx_alphas = _alphas(RVMInference.from_onnx(onnx_path), clip, 1)
+    torch_alphas = _alphas(RVMInference.from_torch(standin_checkpoint), clip, 4)
+    for a, b in zip(onnx_alphas, torch_alphas):
+        np.testing.assert_allclose(a, b, atol=1e-5)
+
+
+def test_torch_matches_onnx(tmp_path):
+    """Needs the real weights: RVM's model package, the checkpoint and the fp32 ONNX export."""
+    checkpoint = os.path.join(MODEL_DIR, "rvm_mobilenetv3.pth")
+    onnx_path = os.path.join(MODEL_DIR, "rvm_mobilenetv3_fp32.onnx")
+    rvm_repo = os.path.join(os.path.dirname(MODEL_DIR), "rvm_repo")
+    if not (os.path.exists(checkpoint) and os.path.exists(onnx_path) and os.path.isdir(rvm_repo)):
+        pytest.skip("RVM weights or model package not available")
+    video = str(tmp_path / "parity.avi")
+    make_video(video, 320, 192, 24)
+
+    results = compare_torch_onnx(checkpoint, onnx_path, video, frames=24, batch_size=4)
+    assert results["sequence_max_error"] < 1e-4
+    assert results["alpha_mae"] < 1e-3
+    assert results["alpha_max_error"] < 5e-2
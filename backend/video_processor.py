@@ -1,97 +1,250 @@
 import cv2
-import os
 import numpy as np
-from tqdm import tqdm
+import os
 from inference import RVMInference
+from batching import BatchedStream
+from pipeline import StagedPipeline, PipelineConfig, StageTimings
+from compositor import Compositor
+from export import MatteExporter
+from lighting import FullFrameLighting, LightingMatcher, get_lab_stats, match_lab_lighting
+from backgrounds import PreparedBackground, render_background
+from cache import cache_key
+from frame_reuse import FrameReuse
+from roi import SubjectROI
+from segments import plan_segments, process_video_segmented
+from encoder import EncoderConfig, FFmpegWriter, OUTPUT_FORMATS, find_ffmpeg
+from decoder import open_video, probe_video
+from progress import check_cancelled
 import subprocess
 import tempfile
+import time
 
 class VideoProcessor:
-    def __init__(self, model_path, device=None):
-        self.inference = RVMInference(model_path, device)
+    def __init__(self, model_path, device=None, intra_op_threads=None, tier=None,
+                 downsample_ratio=0.25, max_inference_side=None, batchers=None):
+        self.model_path = model_path
+        self.device = device
+        self.intra_op_threads = intra_op_threads
+        # Resolution policy used when a job does not set its own (see refine.py)
+        self.downsample_ratio = downsample_ratio
+        self.max_inference_side = max_inference_side
+        # Optional BatcherPool: engines are then streams of sessions shared
+        # with the other processors of the process (see batching.py)
+        self.batchers = batchers
+        self.inference = self._create_engine(tier)
+        self.inference.set_resolution_policy(downsample_ratio, max_inference_side)
+        self.default_tier = self.inference.tier
+        # One engine per speed/quality tier, created when a job first asks for it
+        self._engines = {self.inference.tier: self.inference}
+        # Optional BackgroundCache shared by jobs and previews (see backgrounds.py)
+        self.background_cache = None
+        # Stage timings and summary of the last process_video run
+        self.last_timings = None
+        self.last_job = None
+
+    def use_tier(self, tier, downsample_ratio=None, max_inference_side=None):
+        """
+        Switches self.inference to the engine for tier (see
+        model_registry.TIERS) and applies the resolution policy, falling
+        back to the processor defaults for arguments left as None.
+        """
+        tier = tier or self.default_tier
+        if tier not in self._engines:
+            self._engines[tier] = self._create_engine(tier)
+        self.inference = self._engines[tier]
+        self.inference.set_resolution_policy(
+            self.downsample_ratio if downsample_ratio is None else downsample_ratio,
+            self.max_inference_side if max_inference_side is None else max_inference_side)
+        return self.inference
+
+    def prewarm(self, sizes, frames=2):
+        """
+        Runs blank frames at each (width, height) of sizes through the
+        current engine, so session initialization and kernel selection for
+        those sizes happen before the first job. Returns the seconds taken.
+        """
+        start = time.perf_counter()
+        for width, height in sizes:
+            blank = np.zeros((height, width, 3), dtype=np.uint8)
+            self.inference.reset_states()
+            self.inference.process_batch([blank] * frames)
+        self.inference.reset_states()
+        return time.perf_counter() - start
+
+    def _create_engine(self, tier):
+        if self.batchers is not None:
+            return self.batchers.stream(tier)
+        return RVMInference(self.model_path, self.device, intra_op_threads=self.intra_op_threads, tier=tier)
 
     def _get_lab_stats(self, img_lab):
         """Compute mean and std for each channel in Lab color space."""
-        l, a, b = cv2.split(img_lab)
-        return (l.mean(), l.std()), (a.mean(), a.std()), (b.mean(), b.std())
+        return get_lab_stats(img_lab)
 
     def apply_smart_lighting(self, foreground_bgr, bg_stats, strength=0.5):
         """
         Matches foreground lighting to background using pre-computed Lab stats.
         """
-        if strength <= 0:
-            return foreground_bgr
-
-        # Convert to Lab
-        fg_lab = cv2.cvtColor(foreground_bgr.astype(np.uint8), cv2.COLOR_BGR2LAB).astype(np.float32)
-        fg_stats = self._get_lab_stats(fg_lab)
-
-        res_lab_list = list(cv2.split(fg_lab))
-        for i in range(3):
-            mu_f, sigma_f = fg_stats[i]
-            mu_b, sigma_b = bg_stats[i]
-            
-            if sigma_f < 1e-4: sigma_f = 1e-4
-            
-            matched_channel = (res_lab_list[i] - mu_f) * (sigma_b / sigma_f) + mu_b
-            res_lab_list[i] = matched_channel * strength + res_lab_list[i] * (1 - strength)
-
-        res_lab = cv2.merge(res_lab_list)
-        res_lab = np.clip(res_lab, 0, 255).astype(np.uint8)
-        return cv2.cvtColor(res_lab, cv2.COLOR_LAB2BGR)
+        return match_lab_lighting(foreground_bgr, bg_stats, strength)
+
+    def _make_lighting(self, background, lighting_strength, lighting_mode, refresh_interval=8):
+        """
+        'fast' fits a subject-only, EMA-smoothed correction every
+        refresh_interval frames; 'full' runs the per-frame Lab transfer.
+        background is a PreparedBackground, which holds the BG stats.
+        """
+        if lighting_strength <= 0:
+            return None
+        bg_stats = background.lab_stats
+        if lighting_mode == 'full':
+            return FullFrameLighting(bg_stats, lighting_strength)
+        return LightingMatcher(bg_stats, lighting_strength, refresh_interval=refresh_interval)
+
+    def prepare_background(self, background_path, background_color, blur_radius, width, height,
+                           background_cache=None):
+        """
+        PreparedBackground (image or solid color at the frame size, blur
+        applied) from background_cache or self.background_cache if set.
+        """
+        cache = background_cache or self.background_cache
+        if cache is not None:
+            return cache.get(background_path, background_color, blur_radius, width, height)
+        return PreparedBackground(render_background(background_path, background_color, blur_radius, width, height))
+
+    def matte_at(self, video_path, frame_index, warmup_frames=8):
+        """
+        Returns (frame, alpha, foreground) for one frame of a video. The
+        recurrent state is warmed over up to warmup_frames preceding frames,
+        so the matte matches what process_video produces there instead of a
+        cold-start estimate.
+        """
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            raise Exception(f"Could not open video {video_path}")
+        start = max(0, frame_index - warmup_frames)
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+        self.inference.reset_states()
+        frames = []
+        result = None
+        try:
+            for _ in range(frame_index - start + 1):
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frames.append(frame)
+                if len(frames) == 4:
+                    result = (frames[-1], self.inference.process_batch(frames)[-1])
+                    frames = []
+            if frames:
+                result = (frames[-1], self.inference.process_batch(frames)[-1])
+        finally:
+            cap.release()
+
+        if result is None:
+            raise Exception(f"Could not read frame {frame_index} of {video_path}")
+        frame, (alpha, foreground) = result
+        # The inference results are views into reused buffers
+        return frame, alpha.copy(), foreground.copy()
 
     def process_single_frame(self, frame_bgr, background_path=None, 
-                             background_color=(0, 255, 0), blur_radius=0, lighting_strength=0.0):
+                             background_color=(0, 255, 0), blur_radius=0, lighting_strength=0.0,
+                             lighting_mode='fast'):
         """Processes a single frame for preview purposes."""
         height, width = frame_bgr.shape[:2]
         
-        # Setup background
-        if background_path and os.path.exists(background_path):
-            bg_img = cv2.imread(background_path)
-            bg_img = cv2.resize(bg_img, (width, height))
-        else:
-            bg_img = np.full((height, width, 3), background_color, dtype=np.uint8)
-
-        if blur_radius > 0:
-            ksize = int(blur_radius * 2 + 1)
-            bg_img = cv2.GaussianBlur(bg_img, (ksize, ksize), 0)
+        background = self.prepare_background(background_path, background_color, blur_radius, width, height)
 
-        bg_img_f = bg_img.astype(np.float32) / 255.0
-        
-        # Precompute BG stats for lighting match
-        bg_stats = None
-        if lighting_strength > 0:
-            bg_lab = cv2.cvtColor(bg_img.astype(np.uint8), cv2.COLOR_BGR2LAB).astype(np.float32)
-            bg_stats = self._get_lab_stats(bg_lab)
+        lighting = self._make_lighting(background, lighting_strength, lighting_mode, refresh_interval=1)
 
         # Inference
         self.inference.reset_states()
-        alphas, foregrounds = self.inference.process_batch([frame_bgr])[0]
+        alpha, foreground = self.inference.process_batch([frame_bgr])[0]
         
         # Composite
-        foreground_bgr_f = foregrounds[:, :, ::-1]
-        
-        if lighting_strength > 0:
-            fg_u8 = (foreground_bgr_f * 255).astype(np.uint8)
-            fg_matched = self.apply_smart_lighting(fg_u8, bg_stats, strength=lighting_strength)
-            foreground_bgr_f = fg_matched.astype(np.float32) / 255.0
-
-        alpha = alphas[:, :, np.newaxis]
-        composite = (foreground_bgr_f * alpha + bg_img_f * (1 - alpha))
-        return (composite * 255).astype(np.uint8)
+        return Compositor(background.image, lighting, bg_f=background.image_f).composite(alpha, foreground)
 
     def process_video(self, input_path, output_path, background_path=None, 
                       background_color=(0, 255, 0), blur_radius=0, lighting_strength=0.0,
-                      progress_callback=None):
-        
-        cap = cv2.VideoCapture(input_path)
-        if not cap.isOpened():
-            raise Exception(f"Could not open video {input_path}")
+                      progress_callback=None, pipelined=False, pipeline_config=None,
+                      encoder_config=None, lighting_mode='fast', lighting_refresh_interval=8,
+                      matte_store=None, matte_key=None, segments=1, segment_overlap=16,
+                      start_frame=0, end_frame=None, warmup_frames=0, include_audio=True,
+                      trace_path=None, model_tier=None, downsample_ratio=None, max_inference_side=None,
+                      frame_reuse=None, roi=None, background_cache=None, output_format='composite',
+                      cancel_event=None, stream_dir=None):
+        """
+        Replaces the background of every frame in input_path and writes the
+        result to output_path. With pipelined=True, decode, inference,
+        compositing and encoding run as concurrent stages (see pipeline.py);
+        pipeline_config sets the batch size, queue depths and timing reports.
+
+        When ffmpeg is available the frames are piped into a single libx264
+        encode that copies the audio from input_path (see encoder.py);
+        otherwise a temp file is written with cv2.VideoWriter and the audio
+        is muxed in a second pass.
+
+        lighting_mode 'fast' refreshes subject lighting stats every
+        lighting_refresh_interval frames and applies them as one affine color
+        transform (see lighting.py); 'full' is the per-frame Lab transfer.
+
+        With a matte_store and a matte_key (a hash of the input video), the
+        model output is saved on the first run, and later runs on the same
+        video only re-composite and encode (see matte_store.py).
+
+        segments > 1 splits a long video into that many parts that run in
+        parallel processes and are joined without re-encoding (see
+        segments.py). Each part is a call with start_frame/end_frame, whose
+        recurrent state is first warmed on warmup_frames earlier frames.
+        Parts do not record a matte, so a video first processed in segments
+        runs the model again when it is re-composited; once a matte is
+        stored, jobs on that video re-composite sequentially from it.
+
+        downsample_ratio (a number or 'auto') and max_inference_side override
+        the processor's resolution policy for this job: frames whose long
+        side exceeds max_inference_side are matted at that size and the
+        matte is guided-upsampled back (see refine.py).
+
+        frame_reuse, a FrameReuseConfig, skips inference on frames nearly
+        identical to the last inferred one and reuses its matte (see
+        frame_reuse.py); the share of reused frames goes into last_job.
+        roi, a SubjectROIConfig, crops inference to a tracked box around the
+        subject (see roi.py), also reported in last_job.
+        background_cache (default self.background_cache) shares prepared
+        backgrounds between jobs (see backgrounds.py).
 
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        output_format other than 'composite' exports the matte instead of a
+        composite (see encoder.OUTPUT_FORMATS and export.py); background and
+        lighting settings do not apply then, and ffmpeg is required.
+
+        Stage timings of the run end up in last_timings and a job summary in
+        last_job; trace_path additionally writes every timed span as a
+        Chrome trace file.
+
+        cancel_event (a threading or multiprocessing Event) is checked before
+        every batch; once it is set, the job stops with progress.JobCancelled
+        after killing ffmpeg and removing its partial output and temp files.
+        progress_callback(current, total) is called for every frame, so
+        callers that pass progress on should throttle it (see progress.py).
+
+        stream_dir makes the output progressive: HLS segments appear there
+        while frames are encoded, and output_path is written from them at
+        the end (see encoder.FFmpegWriter). Needs the single-pass ffmpeg
+        encode and an H.264 output format; segment-parallel mode is not
+        used then, since its parts only come together at the end.
+        """
+        job_start = time.perf_counter()
+        check_cancelled(cancel_event)
+        self.use_tier(model_tier, downsample_ratio, max_inference_side)
+        batched = isinstance(self.inference, BatchedStream)
+        if batched:
+            self.inference.reset_stats()
+        ffmpeg_path = find_ffmpeg()
+        # One ffprobe run (or OpenCV's properties without it) for the metadata
+        info = probe_video(input_path, ffmpeg_path)
+        width, height = info.width, info.height
+        fps = info.fps
+        total_frames = info.frame_count
         
         # Validate video properties
         if fps <= 0:
@@ -101,22 +254,322 @@ class VideoProcessor:
         if width <= 0 or height <= 0:
             raise Exception(f"Invalid video dimensions: {width}x{height}")
 
-        # Extract audio from input video
-        audio_path = None
+        encoder_config = encoder_config or EncoderConfig()
+        exporting = output_format != 'composite'
+        if exporting and not ffmpeg_path:
+            raise Exception(f"Exporting {output_format} requires ffmpeg")
+        single_pass = bool(ffmpeg_path) and (encoder_config.use_ffmpeg or exporting)
+        if stream_dir and not (single_pass and OUTPUT_FORMATS[output_format]['stream']):
+            print(f"Progressive output is not available for this job, writing only {output_path}")
+            stream_dir = None
+
+        # Mattes with reused frames or cropped inference are kept apart from
+        # plain full-frame ones
+        stored_key = matte_key and cache_key(matte_key, self.inference.model_id,
+                                             *[c.key() for c in (frame_reuse, roi) if c])
+        # A stored matte makes the job cheap enough to stay sequential
+        matte_known = matte_store is not None and matte_key and matte_store.has(stored_key)
+        if (segments > 1 and start_frame == 0 and end_frame is None and single_pass and not matte_known
+                and not exporting and not stream_dir):
+            plan = plan_segments(ffmpeg_path, input_path, total_frames, fps, segments)
+            if len(plan) > 1:
+                self.last_job = process_video_segmented(
+                    self, input_path, output_path, plan, ffmpeg_path,
+                    overlap_frames=segment_overlap, progress_callback=progress_callback, trace_path=trace_path,
+                    background_path=background_path, background_color=background_color,
+                    blur_radius=blur_radius, lighting_strength=lighting_strength,
+                    pipelined=pipelined, pipeline_config=pipeline_config, encoder_config=encoder_config,
+                    lighting_mode=lighting_mode, lighting_refresh_interval=lighting_refresh_interval,
+                    # The policy resolved here, so workers do not fall back to their own defaults
+                    model_tier=model_tier, downsample_ratio=self.inference.downsample_ratio,
+                    max_inference_side=self.inference.max_inference_side or 0,
+                    frame_reuse=frame_reuse, roi=roi, background_cache=background_cache,
+                    cancel_event=cancel_event,
+                )
+                self.last_timings = self.last_job["stages"]
+                return
+
+        # Frame range: warm the recurrent state on the frames just before
+        # start_frame, then output [start_frame, end_frame)
+        frame_count = total_frames
+        end_frame = frame_count if end_frame is None else min(end_frame, frame_count)
+        warm_start = max(0, start_frame - warmup_frames)
+        total_frames = end_frame - start_frame
+        if total_frames <= 0:
+            raise Exception(f"Invalid frame range: {start_frame}-{end_frame}")
+        partial = start_frame > 0 or end_frame < frame_count
+
+        # The legacy path encodes to a temp file first and muxes audio afterwards
         temp_dir = tempfile.gettempdir()
-        audio_path = os.path.join(temp_dir, f"audio_{os.path.basename(input_path)}.aac")
-        
-        # Try to find ffmpeg
-        ffmpeg_path = None
-        for path in ['ffmpeg', 'C:\\ffmpeg\\ffmpeg.exe', '/usr/bin/ffmpeg', '/usr/local/bin/ffmpeg']:
+        audio_path = None
+        if not single_pass and include_audio and info.audio_codec != '':
+            audio_path = self._extract_audio(ffmpeg_path, input_path, temp_dir)
+
+        # Composited frames wait in the encode queue, so the pipeline needs a
+        # deeper output ring than the serial loop, which writes immediately
+        cfg = pipeline_config or PipelineConfig()
+        timings = StageTimings(cfg.collect_timings, trace=bool(trace_path))
+        timed = timings.enabled
+        out_ring_size = cfg.encode_queue_size + 2 if pipelined else 1
+        if exporting:
+            compositor = MatteExporter(width, height, output_format, out_ring_size=out_ring_size)
+        else:
+            background = self.prepare_background(background_path, background_color, blur_radius, width, height,
+                                                 background_cache)
+            lighting = self._make_lighting(background, lighting_strength, lighting_mode, lighting_refresh_interval)
+            compositor = Compositor(background.image, lighting, bg_f=background.image_f,
+                                    out_ring_size=out_ring_size, timings=timings if timed else None)
+
+        if single_pass:
+            if exporting:
+                print(f"Exporting {output_format} with ffmpeg")
+            else:
+                print(f"Encoding with ffmpeg (libx264, preset={encoder_config.preset}, crf={encoder_config.crf})")
+            out = FFmpegWriter(ffmpeg_path, output_path, width, height, fps,
+                               audio_source=input_path if include_audio else None, config=encoder_config,
+                               output_format=output_format, source_audio_codec=info.audio_codec,
+                               stream_dir=stream_dir)
+            temp_video_path = None
+        else:
+            # Create temporary video file without audio
+            temp_video_path = os.path.join(temp_dir, f"temp_video_{os.path.basename(output_path)}")
+            out = self._open_cv_writer(temp_video_path, fps, width, height)
+            if out is None:
+                raise Exception(f"Failed to initialize video writer. No compatible codec found.")
+
+        # Reuse a stored matte for this video if there is one, otherwise
+        # record this run's matte so later background changes can skip the model
+        matte_reader = matte_writer = None
+        if matte_store is not None and matte_key and not partial:
+            matte_reader = matte_store.open_reader(stored_key)
+            if matte_reader and (matte_reader.width, matte_reader.height) != (width, height):
+                matte_reader = None
+            if matte_reader:
+                print(f"Re-compositing from stored matte ({matte_reader.frames} frames), skipping inference")
+                total_frames = matte_reader.frames
+            else:
+                matte_writer = matte_store.open_writer(stored_key, width, height, fps)
+
+        reuse = tracker = None
+        cap = None
+
+        def abort():
+            # A failed or cancelled job leaves no ffmpeg process or partial file behind
+            if cap is not None:
+                cap.release()
+            self._abort_writer(out)
+            if matte_writer:
+                matte_writer.abort()
+            for path in (output_path, temp_video_path, audio_path):
+                if path and os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Could not remove {path}: {e}")
+
+        if matte_reader:
+            read_frame = matte_reader.read
+            infer_batch = list
+        else:
+            # Decoded frames come from a ring: enough slots for every frame in
+            # the decode queue, the batch being filled and the one in inference
+            batch_size = cfg.batch_size
+            ring_size = (cfg.decode_queue_size + 3) * batch_size if pipelined else batch_size + 1
+            cap = open_video(input_path, info, ffmpeg_path, start_frame=warm_start, ring_size=ring_size,
+                             decoder=cfg.decoder)
+            frames_left = total_frames
+
+            def read_frame():
+                nonlocal frames_left
+                if frames_left <= 0:
+                    return None
+                ret, frame = cap.read()
+                if not ret:
+                    return None
+                frames_left -= 1
+                return frame
+            infer_batch = self.inference.process_batch
+            self.inference.reset_states()
             try:
-                result = subprocess.run([path, '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5)
-                if result.returncode == 0:
-                    ffmpeg_path = path
-                    break
-            except:
-                continue
+                self._warm_up(cap, start_frame - warm_start, batch_size, cancel_event)
+            except Exception:
+                # An ffmpeg decoder would otherwise be left blocked on its pipe
+                abort()
+                raise
+            if pipelined:
+                # Results stay alive in the inference queue and the composite stage
+                self.inference.set_output_ring_size(cfg.inference_queue_size + 2)
+            else:
+                self.inference.set_output_ring_size(1)
+            engine = self.inference
+            if roi:
+                tracker = engine = SubjectROI(engine, roi)
+                infer_batch = tracker.process_batch
+            if frame_reuse:
+                reuse = FrameReuse(engine, frame_reuse)
+                infer_batch = reuse.process_batch
+
+        if cancel_event is not None:
+            # Checked once per batch, before its inference, in both loops
+            run_batch = infer_batch
+
+            def infer_batch(frames):
+                check_cancelled(cancel_event)
+                return run_batch(frames)
+
+        render = compositor.frame if exporting else compositor.composite
+
+        def _recording_composite(alpha, foreground):
+            matte_writer.add(alpha, foreground)
+            return render(alpha, foreground)
+        composite = _recording_composite if matte_writer else render
+        
+        processed_count = 0
+        frames_written = 0
         
+        # Imported on first use, so loading the module stays cheap
+        from tqdm import tqdm
+        # A caller with a progress_callback reports progress itself
+        pbar = tqdm(total=total_frames, desc="Processing Video (Pipelined)" if pipelined else "Processing Video (Batched)",
+                    disable=progress_callback is not None)
+
+        def on_frame(written):
+            nonlocal processed_count, frames_written
+            if written:
+                frames_written += 1
+            processed_count += 1
+            pbar.update(1)
+            if progress_callback:
+                progress_callback(processed_count, total_frames)
+
+        self.last_timings = self.last_job = None
+        self.inference.timings = timings if timed else None
+        try:
+            if pipelined:
+                StagedPipeline(cfg, timings).run(read_frame, infer_batch, composite, out.write, on_frame)
+            else:
+                batch_size = cfg.batch_size
+                frames_batch = []
+                while True:
+                    t0 = time.perf_counter() if timed else None
+                    frame = read_frame()
+                    if timed:
+                        timings.add("decode", busy=time.perf_counter() - t0, items=0 if frame is None else 1, start=t0)
+                    if frame is not None:
+                        frames_batch.append(frame)
+                    if frames_batch and (frame is None or len(frames_batch) == batch_size):
+                        t0 = time.perf_counter() if timed else None
+                        results = infer_batch(frames_batch)
+                        if timed:
+                            timings.add("inference", busy=time.perf_counter() - t0, items=len(frames_batch), start=t0)
+                        for alpha, foreground in results:
+                            t0 = time.perf_counter() if timed else None
+                            try:
+                                final_frame = composite(alpha, foreground)
+                            except Exception as e:
+                                print(f"Error writing frame: {e}")
+                                final_frame = None
+                            if timed:
+                                t1 = time.perf_counter()
+                                timings.add("composite", busy=t1 - t0, items=1, start=t0)
+                            if final_frame is not None:
+                                out.write(final_frame)
+                            if timed:
+                                timings.add("encode", busy=time.perf_counter() - t1, items=1, start=t1)
+                            on_frame(final_frame is not None)
+                        frames_batch = []
+                    if frame is None:
+                        break
+
+            if cap is not None:
+                cap.release()
+            pbar.close()
+
+            if frames_written == 0:
+                raise Exception("No frames were written to output video. Check model inference output.")
+
+            t0 = time.perf_counter()
+            if single_pass:
+                # Waits for ffmpeg to flush; no timeout so long videos can finish
+                out.release()
+                timings.add("encode_finish", busy=time.perf_counter() - t0, start=t0)
+                print(f"Video processing complete. {frames_written} frames written to {output_path}")
+            else:
+                out.release()
+                print(f"Video processing complete. {frames_written} frames written.")
+                self._finish_two_pass(ffmpeg_path, temp_video_path, audio_path, output_path)
+                timings.add("mux", busy=time.perf_counter() - t0, start=t0)
+        except Exception:
+            # Also a failed encode or mux: nothing half-written is left behind
+            abort()
+            pbar.close()
+            raise
+        finally:
+            self.inference.timings = None
+
+        # Stored only once the output is complete, so later jobs never reuse
+        # the matte of a run that dropped frames or failed to encode
+        if matte_writer:
+            if frames_written == total_frames:
+                matte_writer.commit()
+            else:
+                print(f"Matte not stored: {frames_written} of {total_frames} frames written")
+                matte_writer.abort()
+
+        self._finish_job(timings, job_start, frames_written, pipelined, bool(matte_reader), trace_path,
+                         frame_reuse=reuse.stats() if reuse else None, roi=tracker.stats() if tracker else None,
+                         batching=self.inference.stats() if batched and not matte_reader else None)
+
+    def _finish_job(self, timings, job_start, frames, pipelined, matte_reused, trace_path=None,
+                    frame_reuse=None, roi=None, batching=None):
+        seconds = time.perf_counter() - job_start
+        self.last_timings = timings.as_dict() if timings.enabled else None
+        self.last_job = {
+            "frames": frames,
+            "seconds": round(seconds, 4),
+            "fps": round(frames / seconds, 3) if seconds > 0 else None,
+            "backend": self.inference.backend,
+            "model": self.inference.model_id,
+            "pipelined": pipelined,
+            "matte_reused": matte_reused,
+            "stages": self.last_timings,
+        }
+        if frame_reuse:
+            self.last_job["frame_reuse"] = frame_reuse
+        if roi:
+            self.last_job["roi"] = roi
+        if batching:
+            self.last_job["batching"] = batching
+        if trace_path:
+            try:
+                timings.write_trace(trace_path, self.last_job)
+            except OSError as e:
+                print(f"Could not write trace {trace_path}: {e}")
+
+    def _warm_up(self, cap, num_frames, batch_size=4, cancel_event=None):
+        """Runs num_frames through the model only to advance the recurrent state."""
+        batch = []
+        for _ in range(num_frames):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            batch.append(frame)
+            if len(batch) == batch_size:
+                check_cancelled(cancel_event)
+                self.inference.process_batch(batch)
+                batch = []
+        if batch:
+            self.inference.process_batch(batch)
+
+    def _abort_writer(self, out):
+        if isinstance(out, FFmpegWriter):
+            out.abort()
+        else:
+            out.release()
+
+    def _extract_audio(self, ffmpeg_path, input_path, temp_dir):
+        """Legacy path: pull the audio track into a temp .aac file."""
+        audio_path = os.path.join(temp_dir, f"audio_{os.path.basename(input_path)}.aac")
         try:
             if ffmpeg_path:
                 # Try to extract audio using ffmpeg
@@ -132,35 +585,13 @@ class VideoProcessor:
         except Exception as e:
             print(f"Could not extract audio: {e}")
             audio_path = None
+        return audio_path
 
-        # Setup background
-        if background_path and os.path.exists(background_path):
-            bg_img = cv2.imread(background_path)
-            bg_img = cv2.resize(bg_img, (width, height))
-        else:
-            bg_img = np.full((height, width, 3), background_color, dtype=np.uint8)
-
-        # Apply Blur if needed
-        if blur_radius > 0:
-            ksize = int(blur_radius * 2 + 1)
-            bg_img = cv2.GaussianBlur(bg_img, (ksize, ksize), 0)
-
-        bg_img_f = bg_img.astype(np.float32) / 255.0
-        
-        # Precompute BG stats for lighting match
-        bg_stats = None
-        if lighting_strength > 0:
-            bg_lab = cv2.cvtColor(bg_img.astype(np.uint8), cv2.COLOR_BGR2LAB).astype(np.float32)
-            bg_stats = self._get_lab_stats(bg_lab)
-
-        # Create temporary video file without audio
-        temp_video_path = os.path.join(temp_dir, f"temp_video_{os.path.basename(output_path)}")
-        
+    def _open_cv_writer(self, temp_video_path, fps, width, height):
         # Try multiple codecs for better compatibility
         # MJPEG is most reliable but larger file size
         # mp4v is best for MP4 but requires proper frame format
         codecs = ['MJPG', 'mp4v', 'H264', 'DIVX']
-        out = None
         
         for codec in codecs:
             try:
@@ -168,68 +599,14 @@ class VideoProcessor:
                 out = cv2.VideoWriter(temp_video_path, fourcc, fps, (width, height))
                 if out.isOpened():
                     print(f"Using codec: {codec}")
-                    break
-                else:
-                    out = None
+                    return out
             except Exception as e:
                 print(f"Codec {codec} failed: {e}")
                 continue
-        
-        if out is None or not out.isOpened():
-            cap.release()
-            raise Exception(f"Failed to initialize video writer. No compatible codec found.")
-
-        self.inference.reset_states()
-        
-        batch_size = 4
-        frames_batch = []
-        processed_count = 0
-        frames_written = 0
-        
-        pbar = tqdm(total=total_frames, desc="Processing Video (Batched)")
-        
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                if frames_batch:
-                    results = self.inference.process_batch(frames_batch)
-                    for i, (alpha, foreground) in enumerate(results):
-                        try:
-                            self._write_frame(out, foreground, alpha, bg_img_f, bg_stats, lighting_strength)
-                            frames_written += 1
-                        except Exception as e:
-                            print(f"Error writing frame: {e}")
-                        processed_count += 1
-                        pbar.update(1)
-                        if progress_callback:
-                            progress_callback(processed_count, total_frames)
-                break
+        return None
 
-            frames_batch.append(frame)
-            
-            if len(frames_batch) == batch_size:
-                results = self.inference.process_batch(frames_batch)
-                for i, (alpha, foreground) in enumerate(results):
-                    try:
-                        self._write_frame(out, foreground, alpha, bg_img_f, bg_stats, lighting_strength)
-                        frames_written += 1
-                    except Exception as e:
-                        print(f"Error writing frame: {e}")
-                    processed_count += 1
-                    pbar.update(1)
-                    if progress_callback:
-                        progress_callback(processed_count, total_frames)
-                frames_batch = []
-
-        cap.release()
-        out.release()
-        pbar.close()
-        
-        if frames_written == 0:
-            raise Exception("No frames were written to output video. Check model inference output.")
-        
-        print(f"Video processing complete. {frames_written} frames written.")
-        
+    def _finish_two_pass(self, ffmpeg_path, temp_video_path, audio_path, output_path):
+        """Legacy path: re-encode the temp video and mux the extracted audio."""
         # Verify temp video has content
         if os.path.exists(temp_video_path):
             temp_size = os.path.getsize(temp_video_path)
@@ -251,7 +628,6 @@ class VideoProcessor:
                         [ffmpeg_path, '-i', temp_video_path, '-i', audio_path, '-c:v', 'libx264', '-preset', 'fast', '-c:a', 'aac', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path],
                         stdout=subprocess.PIPE,
                         stderr=subprocess.PIPE,
-                        timeout=120
                     )
                     if result.returncode != 0:
                         print(f"FFmpeg error: {result.stderr.decode()}")
@@ -281,37 +657,3 @@ class VideoProcessor:
             # No audio, just move temp video to output
             if os.path.exists(temp_video_path):
                 os.rename(temp_video_path, output_path)
-
-    def _write_frame(self, out, foreground, alpha, bg_img_f, bg_stats, lighting_strength):
-        # Ensure correct range [0, 1] and shape
-        alpha = np.clip(alpha, 0, 1)
-        foreground = np.clip(foreground, 0, 1)
-        
-        target_h, target_w = bg_img_f.shape[:2]
-        
-        # Resize if model output doesn't match input exactly (unlikely but safe)
-        if alpha.shape[:2] != (target_h, target_w):
-            alpha = cv2.resize(alpha, (target_w, target_h))
-        if foreground.shape[:2] != (target_h, target_w):
-            foreground = cv2.resize(foreground, (target_w, target_h))
-
-        foreground_bgr_f = foreground[:, :, ::-1] # RGB to BGR
-
-        if lighting_strength > 0 and bg_stats is not None:
-            fg_u8 = (foreground_bgr_f * 255).astype(np.uint8)
-            fg_matched = self.apply_smart_lighting(fg_u8, bg_stats, strength=lighting_strength)
-            foreground_bgr_f = fg_matched.astype(np.float32) / 255.0
-
-        alpha = alpha[:, :, np.newaxis]
-        composite = (foreground_bgr_f * alpha + bg_img_f * (1 - alpha))
-        
-        final_frame = (np.clip(composite, 0, 1) * 255).astype(np.uint8)
-        
-        # Verify frame is valid before writing
-        if final_frame.shape != (target_h, target_w, 3):
-            raise ValueError(f"Invalid frame shape: {final_frame.shape}, expected ({target_h}, {target_w}, 3)")
-        
-        # Ensure frame is contiguous in memory (required by some codecs)
-        final_frame = np.ascontiguousarray(final_frame)
-        
-        out.write(final_frame)
@@ -1,6 +1,6 @@
 "use client";
 
-import { useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import FileUpload from "@/components/FileUpload";
 import VideoPreview from "@/components/VideoPreview";
 import BackgroundPicker from "@/components/BackgroundPicker";
@@ -15,9 +15,11 @@ interface VideoItem {
   lightingStrength: number;
   isProcessing: boolean;
   progress: number;
+  etaSeconds: number | null;
   taskId: string | null;
   processedVideoUrl: string | null;
   previewUrl: string | null;
+  previewSessionId: string | null;
   isPreviewLoading: boolean;
   error: string | null;
 }
@@ -29,6 +31,20 @@ export default function Home() {
 
   const activeVideo = videoList.find((v) => v.id === activeVideoId) || null;
 
+  // Jobs nobody is waiting for any more should not keep the server busy:
+  // running tasks are cancelled when the tab is closed
+  const videoListRef = useRef(videoList);
+  videoListRef.current = videoList;
+  useEffect(() => {
+    const cancelAll = () => {
+      for (const v of videoListRef.current) {
+        if (v.taskId) navigator.sendBeacon(`http://localhost:8000/cancel/${v.taskId}`);
+      }
+    };
+    window.addEventListener("pagehide", cancelAll);
+    return () => window.removeEventListener("pagehide", cancelAll);
+  }, []);
+
   const updateActiveVideo = (updates: Partial<VideoItem>) => {
     if (!activeVideoId) return;
     setVideoList((prev) =>
@@ -46,9 +62,11 @@ export default function Home() {
       lightingStrength: 0,
       isProcessing: false,
       progress: 0,
+      etaSeconds: null,
       taskId: null,
       processedVideoUrl: null,
       previewUrl: null,
+      previewSessionId: null,
       isPreviewLoading: false,
       error: null,
     }));
@@ -65,57 +83,78 @@ export default function Home() {
     }
   };
 
+  // Applies a task update; returns true once the task is finished
+  const applyStatus = (id: string, data: any) => {
+    if (data.status === "not_found") return true;
+
+    if (data.status === "completed") {
+      setVideoList((prev) =>
+        prev.map((v) =>
+          v.id === id ? { 
+            ...v, 
+            processedVideoUrl: `http://localhost:8000${data.output_url}`,
+            isProcessing: false,
+            taskId: null,
+            progress: 100
+          } : v
+        )
+      );
+      return true;
+    }
+    if (data.status === "cancelled") {
+      setVideoList((prev) =>
+        prev.map((v) =>
+          v.id === id ? { ...v, isProcessing: false, taskId: null, progress: 0, etaSeconds: null } : v
+        )
+      );
+      return true;
+    }
+    if (data.status === "failed") {
+      setVideoList((prev) =>
+        prev.map((v) =>
+          v.id === id ? { 
+            ...v, 
+            error: data.error,
+            isProcessing: false,
+            taskId: null
+          } : v
+        )
+      );
+      return true;
+    }
+    setVideoList((prev) =>
+      prev.map((v) =>
+        v.id === id ? { ...v, progress: data.progress || 0, etaSeconds: data.eta_seconds ?? null } : v
+      )
+    );
+    return false;
+  };
+
+  // Fallback when the event stream is unavailable
   const pollStatus = (id: string, taskId: string) => {
     const interval = setInterval(async () => {
       try {
         const response = await fetch(`http://localhost:8000/status/${taskId}`);
         if (!response.ok) return;
-        
-        const data = await response.json();
-        console.log(`Poll response for ${taskId}:`, data);
-        
-        // Stop polling if task not found
-        if (data.status === "not_found") {
-          clearInterval(interval);
-          return;
-        }
-        
-        setVideoList((prev) =>
-          prev.map((v) =>
-            v.id === id ? { ...v, progress: data.progress || 0 } : v
-          )
-        );
-        
-        if (data.status === "completed") {
-          setVideoList((prev) =>
-            prev.map((v) =>
-              v.id === id ? { 
-                ...v, 
-                processedVideoUrl: `http://localhost:8000${data.output_url}`,
-                isProcessing: false,
-                taskId: null,
-                progress: 100
-              } : v
-            )
-          );
-          clearInterval(interval);
-        } else if (data.status === "failed") {
-          setVideoList((prev) =>
-            prev.map((v) =>
-              v.id === id ? { 
-                ...v, 
-                error: data.error,
-                isProcessing: false,
-                taskId: null
-              } : v
-            )
-          );
-          clearInterval(interval);
-        }
+        if (applyStatus(id, await response.json())) clearInterval(interval);
       } catch (error) {
         console.error("Polling error:", error);
       }
-    }, 500); // Poll every 500ms instead of 1000ms
+    }, 2000);
+  };
+
+  // Progress is pushed by the server as it happens (server-sent events)
+  const watchStatus = (id: string, taskId: string) => {
+    const events = new EventSource(`http://localhost:8000/events/${taskId}`);
+    let finished = false;
+    events.onmessage = (event) => {
+      finished = applyStatus(id, JSON.parse(event.data));
+      if (finished) events.close();
+    };
+    events.onerror = () => {
+      events.close();
+      if (!finished) pollStatus(id, taskId);
+    };
   };
 
   const handlePreview = async () => {
@@ -123,22 +162,46 @@ export default function Home() {
     
     updateActiveVideo({ isPreviewLoading: true, processedVideoUrl: null });
     
-    const formData = new FormData();
-    formData.append("video", activeVideo.file);
-    if (activeVideo.backgroundFile) {
-      formData.append("background", activeVideo.backgroundFile);
-    }
-    formData.append("color_r", activeVideo.backgroundColor.r.toString());
-    formData.append("color_g", activeVideo.backgroundColor.g.toString());
-    formData.append("color_b", activeVideo.backgroundColor.b.toString());
-    formData.append("blur_radius", activeVideo.blurRadius.toString());
-    formData.append("lighting_strength", (activeVideo.lightingStrength / 100).toString());
-
-    try {
-      const response = await fetch("http://localhost:8000/preview", {
+    // Upload the video once per preview session; later previews only send settings
+    const createSession = async () => {
+      const sessionData = new FormData();
+      sessionData.append("video", activeVideo.file);
+      const response = await fetch("http://localhost:8000/preview/sessions", {
+        method: "POST",
+        body: sessionData,
+      });
+      if (!response.ok) {
+        const errData = await response.json();
+        throw new Error(errData.error || errData.detail || "Preview failed");
+      }
+      const data = await response.json();
+      updateActiveVideo({ previewSessionId: data.session_id });
+      return data.session_id as string;
+    };
+
+    const render = (sessionId: string) => {
+      const formData = new FormData();
+      formData.append("timestamp", "0");
+      if (activeVideo.backgroundFile) {
+        formData.append("background", activeVideo.backgroundFile);
+      }
+      formData.append("color_r", activeVideo.backgroundColor.r.toString());
+      formData.append("color_g", activeVideo.backgroundColor.g.toString());
+      formData.append("color_b", activeVideo.backgroundColor.b.toString());
+      formData.append("blur_radius", activeVideo.blurRadius.toString());
+      formData.append("lighting_strength", (activeVideo.lightingStrength / 100).toString());
+      return fetch(`http://localhost:8000/preview/sessions/${sessionId}/render`, {
         method: "POST",
         body: formData,
       });
+    };
+
+    try {
+      let response = await render(activeVideo.previewSessionId || (await createSession()));
+      if (response.status === 404) {
+        // Session expired on the server: upload again
+        response = await render(await createSession());
+      }
       if (!response.ok) {
         const errData = await response.json();
         throw new Error(errData.detail || "Preview failed");
@@ -152,6 +215,15 @@ export default function Home() {
     }
   };
 
+  const cancelTask = (taskId: string) =>
+    fetch(`http://localhost:8000/cancel/${taskId}`, { method: "POST" }).catch((error) =>
+      console.error("Cancel error:", error)
+    );
+
+  const handleCancel = () => {
+    if (activeVideo?.taskId) cancelTask(activeVideo.taskId);
+  };
+
   const handleProcessVideo = async (videoId?: string) => {
     const id = videoId || activeVideoId;
     const target = videoList.find(v => v.id === id);
@@ -159,7 +231,7 @@ export default function Home() {
 
     setVideoList((prev) =>
       prev.map((v) =>
-        v.id === id ? { ...v, isProcessing: true, progress: 1, processedVideoUrl: null } : v
+        v.id === id ? { ...v, isProcessing: true, progress: 1, etaSeconds: null, processedVideoUrl: null } : v
       )
     );
 
@@ -206,7 +278,7 @@ export default function Home() {
             v.id === id ? { ...v, taskId: data.task_id } : v
           )
         );
-        pollStatus(id, data.task_id);
+        watchStatus(id, data.task_id);
       }
     } catch (error) {
       console.error("Error:", error);
@@ -441,6 +513,17 @@ export default function Home() {
                       </div>
                       <p className="text-xl font-bold text-white mb-2">{activeVideo.progress}%</p>
                       <p className="text-blue-400 font-medium text-sm tracking-wide uppercase">AI Matting in progress...</p>
+                      {activeVideo.etaSeconds !== null && (
+                        <p className="text-zinc-400 text-sm mt-2">About {Math.ceil(activeVideo.etaSeconds)}s left</p>
+                      )}
+                      {activeVideo.taskId && (
+                        <button
+                          onClick={handleCancel}
+                          className="mt-6 px-4 py-2 rounded-lg text-sm font-medium bg-zinc-800 hover:bg-zinc-700 text-zinc-300 transition-colors"
+                        >
+                          Cancel
+                        </button>
+                      )}
                     </div>
                   )}
                   